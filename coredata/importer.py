@@ -2,19 +2,21 @@ import sys, os, datetime, time
 sys.path.append(".")
 os.environ['DJANGO_SETTINGS_MODULE'] = 'courses.settings'
 
-from coredata.queries import SIMSConn, get_reqmnt_designtn, import_person,\
+from coredata.queries import SIMSConn, get_reqmnt_designtn, import_person, get_names_many,\
     userid_to_emplid, cache_by_args, REQMNT_DESIGNTN_FLAGS, get_waitlist_info
 from coredata.models import Person, Semester, SemesterWeek, Unit,CourseOffering, Member, MeetingTime, Role, Holiday
 from coredata.models import CombinedOffering, EnrolmentHistory, CAMPUSES, COMPONENTS, INSTR_MODE
 from django.db import transaction, IntegrityError
+from django.db.models import F
 from django.conf import settings
 from django.core.cache import cache
 from django.urls import reverse
 from django.core.mail import mail_admins
 from grades.models import LetterActivity
+from grades.utils import offering_students_changed
 from grad.models import GradStudent, STATUS_ACTIVE, STATUS_APPLICANT, STATUS_GPA
 from ra.models import RAAppointment
-import itertools, random
+import itertools, random, collections
 
 today = datetime.date.today()
 past_cutoff = today - datetime.timedelta(days=30)
@@ -273,17 +275,65 @@ def _person_save(p):
         # try again now
         #p.save()
 
-imported_people = {}
+
+def grouper(iterable, n):
+    """
+    Collect data into lists of (at most) n items.
+    grouper('ABCDEFG', 3) --> ABC DEF G
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, n))
+        if not chunk:
+            return
+        yield chunk
+
+
+class PersonCache(object):
+    """
+    The Person objects the importer has already resolved, keyed by emplid: a size-bounded LRU, so a long-lived
+    celery worker doesn't accumulate everyone it has ever imported. The import tasks clear it when they start.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.people = collections.OrderedDict()
+
+    def __contains__(self, emplid):
+        return int(emplid) in self.people
+
+    def __len__(self):
+        return len(self.people)
+
+    def get(self, emplid):
+        emplid = int(emplid)
+        p = self.people.get(emplid)
+        if p is not None:
+            self.people.move_to_end(emplid)
+        return p
+
+    def add(self, p):
+        self.people[p.emplid] = p
+        self.people.move_to_end(p.emplid)
+        while len(self.people) > self.max_size:
+            self.people.popitem(last=False)
+
+    def clear(self):
+        self.people.clear()
+
+
+PERSON_CACHE_SIZE = 50000
+imported_people = PersonCache(PERSON_CACHE_SIZE)
 IMPORT_THRESHOLD = 3600*24*7 # import personal info infrequently
 NO_USERID_IMPORT_THRESHOLD = 3600*24*2 # import if we don't know their userid yet
+PERSON_QUERY_CHUNK = 1000 # emplids per Person.objects.filter(emplid__in=...) query
 def get_person(emplid, commit=True, force=False, grad_data=False):
     """
     Get/update personal info for this emplid and return (updated & saved) Person object.
     """
-    global imported_people
     # use imported_people as a cache
-    if emplid in imported_people:
-        return imported_people[emplid]
+    p = imported_people.get(emplid)
+    if p is not None:
+        return p
 
     # either get old or create new Person object
     p_old = Person.objects.filter(emplid=emplid)
@@ -293,9 +343,26 @@ def get_person(emplid, commit=True, force=False, grad_data=False):
     elif len(p_old)==1:
         p = p_old[0]
     else:
-        p = Person(emplid=emplid)
-    imported_people[emplid] = p
+        p = Person(emplid=int(emplid))
+
+    if not _person_import_due(p, force=force):
+        imported_people.add(p)
+        return p
 
+    # actually import their data
+    new_p = import_person(p, commit=commit, grad_data=grad_data)
+    if new_p:
+        imported_people.add(new_p)
+        return new_p
+    elif p_old:
+        imported_people.add(p)
+        return p
+
+
+def _person_import_due(p, force=False):
+    """
+    Is it time to re-import this Person's data from SIMS?
+    """
     if 'lastimport' in p.config:
         import_age = time.time() - p.config['lastimport']
     else:
@@ -303,24 +370,49 @@ def get_person(emplid, commit=True, force=False, grad_data=False):
 
     # active students with no userid: pay more attention to try to get their userid for login/email.
     if p.userid is None and import_age > NO_USERID_IMPORT_THRESHOLD:
-        new_p = import_person(p, commit=commit, grad_data=grad_data)
-        if new_p:
-            return new_p
-        elif p_old:
-            return p
+        return True
 
     # only import if data is older than IMPORT_THRESHOLD (unless forced)
     # Randomly occasionally import anyway, so new students don't stay bunched-up.
-    elif not force and import_age < IMPORT_THRESHOLD and random.random() < 0.99:
-        return p
+    return force or import_age >= IMPORT_THRESHOLD or random.random() >= 0.99
 
-    # actually import their data
-    else:
-        new_p = import_person(p, commit=commit, grad_data=grad_data)
-        if new_p:
-            return new_p
-        elif p_old:
-            return p
+
+def get_people(emplids, commit=True):
+    """
+    Get/update personal info for many emplids at once, as get_person() does for one.
+
+    Returns a dict of emplid -> Person, omitting anyone who can't be found. People we already have are fetched in
+    bulk, and the names of those due for a re-import (or new to us) are fetched from SIMS in one set-based query.
+    """
+    people = {}
+    missing = set()
+    for emplid in set(int(e) for e in emplids):
+        p = imported_people.get(emplid)
+        if p is None:
+            missing.add(emplid)
+        else:
+            people[emplid] = p
+
+    existing = {}
+    for chunk in grouper(sorted(missing), PERSON_QUERY_CHUNK):
+        existing.update((p.emplid, p) for p in Person.objects.filter(emplid__in=chunk))
+
+    due = set(emplid for emplid in missing if emplid not in existing or _person_import_due(existing[emplid]))
+    names = get_names_many(due) if due else {}
+
+    for emplid in missing:
+        p = existing.get(emplid)
+        if emplid in due:
+            new_p = None
+            if emplid in names:
+                new_p = import_person(p or Person(emplid=emplid), commit=commit, names=names[emplid])
+            p = new_p or p
+
+        if p is not None:
+            people[emplid] = p
+            imported_people.add(p)
+
+    return people
 
 
 def get_person_grad(emplid, commit=True, force=False):
@@ -425,13 +517,17 @@ def has_letter_activities(offering):
         las = LetterActivity.objects.filter(offering=offering, deleted=False)
         res = las.count() > 0
         cache.set(key, res, 12*60*60)
+        return res
+
 
+# these are: ["Faculty", "Tba", "Sessional"]. Ignore them: they're ugly.
+IGNORED_EMPLIDS = {200133427, 200133425, 200133426}
 
 def ensure_member(person, offering, role, cred, added_reason, career, labtut_section=None, grade=None, sched_print_instr=None):
     """
     Make sure this member exists with the right properties.
     """
-    if person.emplid in [200133427, 200133425, 200133426]:
+    if person.emplid in IGNORED_EMPLIDS:
         # these are: ["Faculty", "Tba", "Sessional"]. Ignore them: they're ugly.
         return
     
@@ -486,10 +582,12 @@ def import_instructors(offering):
     db.execute("SELECT EMPLID, INSTR_ROLE, SCHED_PRINT_INSTR FROM PS_CLASS_INSTR WHERE " \
                "CRSE_ID=%s AND CLASS_SECTION=%s AND STRM=%s AND INSTR_ROLE IN ('PI', 'SI')",
                ("%06i" % (int(offering.crse_id)), offering.section, offering.semester.name))
-    for emplid, _, sched_print_instr in db.rows():
-        if not emplid:
+    rows = [row for row in db.rows() if row[0]]
+    people = get_people(emplid for emplid, _, _ in rows)
+    for emplid, _, sched_print_instr in rows:
+        p = people.get(int(emplid))
+        if p is None:
             continue
-        p = get_person(emplid)
         ensure_member(p, offering, "INST", 0, "AUTO", "NONS", sched_print_instr=sched_print_instr)
 
 
@@ -523,8 +621,12 @@ def import_students(offering):
                "ON E.STRM=R.STRM AND E.ACAD_CAREER=R.ACAD_CAREER AND E.EMPLID=R.EMPLID AND E.CLASS_NBR=R.CLASS_NBR "
                "WHERE E.CLASS_NBR=%s AND E.STRM=%s AND E.STDNT_ENRL_STATUS='E' and "
                "E.ENRL_STATUS_REASON IN ('ENRL','EWAT')", (offering.class_nbr, offering.semester.name))
-    for emplid, acad_career, unt_taken, grade_official, grade_roster in db.rows():
-        p = get_person(emplid)
+    rows = db.rows()
+    people = get_people(emplid for emplid, _, _, _, _ in rows)
+    for emplid, acad_career, unt_taken, grade_official, grade_roster in rows:
+        p = people.get(int(emplid))
+        if p is None:
+            continue
         sec = labtut.get(emplid, None)
         grade = grade_official or grade_roster
         ensure_member(p, offering, "STUD", unt_taken, "AUTO", acad_career, labtut_section=sec, grade=grade)
@@ -563,12 +665,11 @@ def import_offering_members(offering, students=True):
 
 
 def import_semester_offerings(strm, students=True, extra_where='1=1'):
-    offering_map = crseid_offering_map(strm)
-
-    import_all_instructors(strm, extra_where=extra_where, offering_map=offering_map)
-    if students:
-        import_all_students(strm, extra_where=extra_where, offering_map=offering_map)
-    import_all_meeting_times(strm, extra_where=extra_where, offering_map=offering_map)
+    for offerings in import_offering_chunks(strm):
+        import_instructors_chunk(strm, offerings, extra_where=extra_where)
+        if students:
+            import_students_chunk(strm, offerings, extra_where=extra_where)
+        import_meeting_times_chunk(strm, offerings, extra_where=extra_where)
 
 
 def crseid_offering_map(strm):
@@ -580,47 +681,195 @@ def crseid_offering_map(strm):
             for o in CourseOffering.objects.filter(semester__name=strm)}
 
 
-@transaction.atomic
-def import_all_instructors(strm, extra_where='1=1', offering_map=None):
+STUDENT_IMPORT_CHUNK = 100 # offerings whose instructors, enrolments and meeting times are fetched and diffed together
+
+def import_offering_chunks(strm, offering_map=None):
+    """
+    The semester's offerings whose members and meeting times we import, in lists of (at most) STUDENT_IMPORT_CHUNK.
+
+    Combined offerings have a fake class_nbr, and get their members from import_combined, so they're left out (and
+    their AUTO instructors aren't dropped).
+    """
     if not offering_map:
         offering_map = crseid_offering_map(strm)
+    offerings = [o for o in set(offering_map.values()) if o.class_nbr and not o.flags.combined]
+    offerings.sort(key=lambda o: o.class_nbr)
+    return list(grouper(offerings, STUDENT_IMPORT_CHUNK))
 
-    Member.objects.filter(added_reason="AUTO", offering__semester__name=strm, role="INST").update(role='DROP')
+
+def chunk_offering_map(strm, offerings):
+    "As crseid_offering_map, for just these offerings."
+    return {(strm, "%06i" % (int(o.crse_id)), o.section): o for o in offerings}
+
+
+def import_all_instructors(strm, extra_where='1=1', offering_map=None):
+    for offerings in import_offering_chunks(strm, offering_map):
+        import_instructors_chunk(strm, offerings, extra_where=extra_where)
+
+
+@transaction.atomic
+def import_instructors_chunk(strm, offerings, extra_where='1=1'):
+    """
+    Import instructors for these offerings (all in semester strm), as import_instructors does for one.
+    """
+    offering_map = chunk_offering_map(strm, offerings)
+    crse_ids = sorted(set(crse_id for _, crse_id, _ in offering_map.keys()))
+
+    Member.objects.filter(added_reason="AUTO", offering__in=offerings, role="INST").update(role='DROP')
     db = SIMSConn()
     db.execute("SELECT CRSE_ID, CLASS_SECTION, STRM, EMPLID, INSTR_ROLE, SCHED_PRINT_INSTR FROM PS_CLASS_INSTR WHERE " \
-               "STRM=%s AND INSTR_ROLE IN ('PI', 'SI') AND " + extra_where,
-               (strm,))
+               "CRSE_ID IN %s AND STRM=%s AND INSTR_ROLE IN ('PI', 'SI') AND " + extra_where,
+               (crse_ids, strm))
 
-    for crse_id, class_section, strm, emplid, instr_role, sched_print_instr in db.rows():
-        if not emplid or (strm, crse_id, class_section) not in offering_map:
-            continue
+    rows = [row for row in db.rows() if row[3] and (row[2], row[0], row[1]) in offering_map]
+    people = get_people(row[3] for row in rows)
+    for crse_id, class_section, strm, emplid, instr_role, sched_print_instr in rows:
         offering = offering_map[(strm, crse_id, class_section)]
-        p = get_person(emplid)
+        p = people.get(int(emplid))
+        if p is None:
+            continue
         ensure_member(p, offering, "INST", 0, "AUTO", "NONS", sched_print_instr=sched_print_instr)
 
 
-@transaction.atomic
+MEMBER_UPDATE_FIELDS = ['role', 'labtut_section', 'credits', 'added_reason', 'career', 'official_grade', 'config']
+
 def import_all_students(strm, extra_where='1=1', offering_map=None):
-    if not offering_map:
-        offering_map = crseid_offering_map(strm)
+    """
+    Import student enrolments for every offering in the semester: the set-based equivalent of import_students.
+
+    Offerings are handled in chunks, so the >200k registrations in a semester are never all in memory at once. For
+    each chunk, enrolments from SIMS are compared with the existing Members and only the differences are written.
 
-    Member.objects.filter(added_reason="AUTO", offering__semester__name=strm, role="STUD").update(role='DROP')
+    extra_where restricts the enrolments fetched (as conditions on PS_STDNT_ENRL E). If given, students who aren't
+    found aren't dropped, since we can't tell that they're gone.
+    """
+    for offerings in import_offering_chunks(strm, offering_map):
+        import_students_chunk(strm, offerings, extra_where=extra_where)
+
+
+@transaction.atomic
+def import_students_chunk(strm, offerings, extra_where='1=1'):
+    """
+    Import student enrolments for these offerings (all in semester strm), as import_students does for one.
+    """
+    offering_by_nbr = {o.class_nbr: o for o in offerings}
+    class_nbrs = sorted(offering_by_nbr.keys())
     db = SIMSConn()
 
-    # TODO: remainder of this function not yet refactored. Needs to be broken up since >200k registrations shouldn't be
-    # processed at once.
+    # lab/tutorial sections: same query as import_students, but for every offering in the chunk.
+    query = "SELECT C1.CLASS_NBR, S.EMPLID, C2.CLASS_SECTION " \
+        "FROM PS_CLASS_TBL C1, PS_CLASS_TBL C2, PS_STDNT_ENRL S " \
+        "WHERE C1.SUBJECT=C2.SUBJECT AND C1.CATALOG_NBR=C2.CATALOG_NBR AND C2.STRM=C1.STRM " \
+        "AND S.CLASS_NBR=C2.CLASS_NBR AND S.STRM=C2.STRM AND S.ENRL_STATUS_REASON IN ('ENRL','EWAT') " \
+        "AND C1.CLASS_NBR IN %s AND C1.STRM=%s AND LEFT(C2.CLASS_SECTION, 2)=LEFT(C1.CLASS_SECTION, 2)"
+    db.execute(query, (class_nbrs, strm))
+    labtut = {}
+    for class_nbr, emplid, section in db:
+        offering = offering_by_nbr[int(class_nbr)]
+        if section == offering.section:
+            continue
+        labtut[(offering.id, int(emplid))] = section
 
+    # actual enrolments: (offering.id, emplid) -> (career, units, grade)
+    db.execute("SELECT E.CLASS_NBR, E.EMPLID, E.ACAD_CAREER, E.UNT_TAKEN, E.CRSE_GRADE_OFF, R.CRSE_GRADE_INPUT "
+               "FROM PS_STDNT_ENRL E LEFT JOIN PS_GRADE_ROSTER R "
+               "ON E.STRM=R.STRM AND E.ACAD_CAREER=R.ACAD_CAREER AND E.EMPLID=R.EMPLID AND E.CLASS_NBR=R.CLASS_NBR "
+               "WHERE E.CLASS_NBR IN %s AND E.STRM=%s AND E.STDNT_ENRL_STATUS='E' and "
+               "E.ENRL_STATUS_REASON IN ('ENRL','EWAT') AND " + extra_where, (class_nbrs, strm))
+    enrolments = {}
+    for class_nbr, emplid, acad_career, unt_taken, grade_official, grade_roster in db.rows():
+        offering = offering_by_nbr[int(class_nbr)]
+        enrolments[(offering.id, int(emplid))] = (acad_career, unt_taken, grade_official or grade_roster)
+
+    db.execute("SELECT E.CLASS_NBR, E.EMPLID, E.ENRL_DROP_DT FROM PS_STDNT_ENRL E "
+               "WHERE E.CLASS_NBR IN %s AND E.STRM=%s "
+               "AND E.ENRL_STATUS_REASON NOT IN ('ENRL','EWAT') AND E.ENRL_DROP_DT IS NOT NULL", (class_nbrs, strm))
+    drop_dates = {(offering_by_nbr[int(class_nbr)].id, int(emplid)): drop_dt for class_nbr, emplid, drop_dt in db}
+
+    # existing Members, by (offering.id, emplid). As in ensure_member, prefer a non-dropped entry if there are several.
+    members = {}
+    existing = Member.objects.filter(offering__in=offerings).annotate(emplid=F('person__emplid')).order_by('id')
+    for m in existing:
+        key = (m.offering_id, m.emplid)
+        if key not in members or (members[key].role == 'DROP' and m.role != 'DROP'):
+            members[key] = m
+
+    people = get_people(emplid for _, emplid in enrolments.keys())
+    letter_activities = {o.id: has_letter_activities(o) for o in offerings}
+
+    new_members = []
+    changed_members = {}
+    labtut_offerings = set()
+    for key, (career, units, grade) in enrolments.items():
+        offering_id, emplid = key
+        person = people.get(emplid)
+        if person is None or emplid in IGNORED_EMPLIDS:
+            continue
+
+        section = labtut.get(key, None)
+        if section:
+            labtut_offerings.add(offering_id)
+
+        values = {
+            'role': 'STUD',
+            'labtut_section': section,
+            'credits': units,
+            'added_reason': 'AUTO',
+            'career': career,
+            'official_grade': (grade or None) if letter_activities[offering_id] else None,
+        }
+        m = members.get(key)
+        if m is None:
+            new_members.append(Member(person=person, offering_id=offering_id, **values))
+            continue
+
+        if any(getattr(m, f) != v for f, v in values.items()):
+            for f, v in values.items():
+                setattr(m, f, v)
+            changed_members[m.id] = m
+
+    for key, m in members.items():
+        if extra_where == '1=1' and key not in enrolments and m.role == 'STUD' and m.added_reason == 'AUTO':
+            m.role = 'DROP'
+            changed_members[m.id] = m
+
+        # Record drop date so the discipline app can display "students who have dropped, but not too long ago".
+        if key in drop_dates:
+            d = drop_dates[key].isoformat()
+            if m.config.get('drop_date') != d:
+                m.config['drop_date'] = d
+                changed_members[m.id] = m
+
+    Member.objects.bulk_create(new_members, batch_size=1000)
+    Member.objects.bulk_update(changed_members.values(), MEMBER_UPDATE_FIELDS, batch_size=1000)
+    # bulk writes don't send signals, so expire what a Member save would have
+    for offering_id in set(m.offering_id for m in itertools.chain(new_members, changed_members.values())):
+        offering_students_changed(offering_id)
+
+    # if offering is being given lab/tutorial sections, flag it as having them
+    for o in offerings:
+        if o.id in labtut_offerings and not o.labtut():
+            o.set_labtut(True)
+            o.save_if_dirty()
 
 
-@transaction.atomic
 def import_all_meeting_times(strm, extra_where='1=1', offering_map=None):
-    if not offering_map:
-        offering_map = crseid_offering_map(strm)
+    for offerings in import_offering_chunks(strm, offering_map):
+        import_meeting_times_chunk(strm, offerings, extra_where=extra_where)
+
+
+@transaction.atomic
+def import_meeting_times_chunk(strm, offerings, extra_where='1=1'):
+    """
+    Import meeting times for these offerings (all in semester strm).
+    """
+    offering_map = chunk_offering_map(strm, offerings)
+    crse_ids = sorted(set(crse_id for _, crse_id, _ in offering_map.keys()))
 
     db = SIMSConn()
     db.execute("""SELECT CRSE_ID, CLASS_SECTION, STRM, MEETING_TIME_START, MEETING_TIME_END, FACILITY_ID, MON,TUES,WED,THURS,FRI,SAT,SUN,
-               START_DT, END_DT, STND_MTG_PAT FROM PS_CLASS_MTG_PAT WHERE STRM=%s AND """ + extra_where,
-               (strm,))
+               START_DT, END_DT, STND_MTG_PAT FROM PS_CLASS_MTG_PAT WHERE CRSE_ID IN %s AND STRM=%s AND """ + extra_where,
+               (crse_ids, strm))
     # keep track of meetings we've found, so we can remove old (non-importing semesters and changed/gone)
     found_mtg = set()
 
@@ -667,7 +916,7 @@ def import_all_meeting_times(strm, extra_where='1=1', offering_map=None):
 
     # delete any meeting times we haven't found in the DB
     if extra_where == '1=1':
-        MeetingTime.objects.filter(offering__semester__name=strm).exclude(id__in=found_mtg).delete()
+        MeetingTime.objects.filter(offering__in=offerings).exclude(id__in=found_mtg).delete()
 
 
 @transaction.atomic
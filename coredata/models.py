@@ -4,7 +4,7 @@ from django.db.models import Count
 from autoslug import AutoSlugField
 from courselib.slugs import make_slug
 from django.conf import settings
-import datetime, urllib.parse, decimal
+import datetime, urllib.parse, decimal, bisect, threading, time, weakref
 from django.urls import reverse
 from django.core.exceptions import ValidationError
 from django.core.cache import cache
@@ -128,6 +128,7 @@ GENDER_DESCR = dict(GENDER_CHOICES)
 
 ROLE_MAX_EXPIRY = 730  # maximum days in the future a role can expire (except LONG_LIVED_ROLES roles)
 LONG_LIVED_ROLES = ['FAC', 'SUPV'] # roles that don't allow access to anything, so may be longer lived
+ROLE_CACHE_TIMEOUT = 3600  # default seconds a user's Roles are cached (as settings.ROLE_CACHE_TIMEOUT)
 
 
 class Person(models.Model, ConditionalSaveMixin):
@@ -714,6 +715,13 @@ class Semester(models.Model):
     
     def offset(self, n):
         "The semester n semesters forward/back in time"
+        table = SemesterTable.get()
+        if n == 0:
+            return self
+        elif self.name in table:
+            return table.offset(self.name, n)
+
+        # not a semester we know: find by name from the DB
         if n > 0:
             try:
                 return Semester.objects.filter(name__gt=self.name).order_by('name')[n-1]
@@ -779,7 +787,7 @@ class Semester(models.Model):
     def get_semester(cls, date=None):
         if not date:
             date = datetime.date.today()
-        return Semester.objects.filter(start__lte=date).order_by('-start')[0]
+        return SemesterTable.get().get_semester(date)
 
     @classmethod
     def next_starting(cls):
@@ -787,13 +795,7 @@ class Semester(models.Model):
         The next semester that starts after now
         """
         today = datetime.date.today()
-        sems = Semester.objects.filter(start__gt=today).order_by('start')
-        if sems:
-            return sems[0]
-        else:
-            # just in case there's nothing in the future
-            sems = Semester.objects.order_by('-start')
-            return sems[0]
+        return SemesterTable.get().next_starting(today)
 
     @classmethod
     def first_relevant(cls):
@@ -817,7 +819,7 @@ class Semester(models.Model):
             sem = 7
         
         name = "%03d%1d" % ((year - 1900), sem)
-        return Semester.objects.get(name=name)
+        return SemesterTable.get().semester(name)
 
     @classmethod
     def range(cls, start, end):
@@ -825,14 +827,172 @@ class Semester(models.Model):
         Produce a list of semesters from start to end. 
         Semester.range( '1134', '1147' ) == [ '1134', '1137', '1141', '1144', '1147' ]
 
-        Will run forever or fail if the end semester is not a valid semester. 
+        Continues to the last semester we have if the end semester is not a valid semester.
+        """
+        return SemesterTable.get().range(start, end)
+
+
+SEMESTER_TABLE_GENERATION_KEY = 'semester-table-generation'
+SEMESTER_TABLE_CHECK = 60 # seconds between checks that another process hasn't changed a Semester
+
+class SemesterTable(object):
+    """
+    A snapshot of all Semesters, so semester arithmetic and lookups don't need queries. Semesters are rarely changed,
+    so one table (from SemesterTable.get()) is shared by the whole process: it is replaced when any Semester is saved
+    or deleted here, or within SEMESTER_TABLE_CHECK seconds of a change in another process.
+
+    While a transaction has uncommitted Semester changes, its lookups bypass the shared table (and build their own), so
+    a table that sees them can't outlive a rollback. Its pending _UncommittedSemesters callbacks mark it (and hold its
+    table): they run when the transaction commits, and Django discards them if it (or the savepoint that made the
+    change) rolls back.
+
+    Lookups return new Semester instances built from the table's (immutable) rows.
+    """
+    FIELDS = ['id', 'name', 'start', 'end']
+    _table = None
+
+    def __init__(self, rows, generation):
+        self.rows = tuple(sorted(rows, key=lambda r: r[1]))
+        self.index = {r[1]: i for i, r in enumerate(self.rows)}
+        # row indexes in order of start date, and those start dates for bisection
+        self.by_start = tuple(sorted(range(len(self.rows)), key=lambda i: (self.rows[i][2], self.rows[i][1])))
+        self.starts = [self.rows[i][2] for i in self.by_start]
+        self.generation = generation
+        self.checked = time.time()
+
+    @classmethod
+    def _current_generation(cls):
+        gen = cache.get(SEMESTER_TABLE_GENERATION_KEY)
+        if gen is None:
+            gen = int(time.time() * 1000)
+            if not cache.add(SEMESTER_TABLE_GENERATION_KEY, gen, None):
+                gen = cache.get(SEMESTER_TABLE_GENERATION_KEY, gen)
+        return gen
+
+    @classmethod
+    def get(cls):
+        pending = _pending_semester_callbacks.callbacks
+        if pending:
+            # the table is kept by the latest change, so rolling that back discards it
+            latest = max(pending, key=lambda c: c.order)
+            if latest.table is None:
+                latest.table = cls(Semester.objects.values_list(*cls.FIELDS), None)
+            return latest.table
+
+        table = cls._table
+        now = time.time()
+        if table is not None and now - table.checked > SEMESTER_TABLE_CHECK:
+            if cls._current_generation() == table.generation:
+                table.checked = now
+            else:
+                table = None
+
+        if table is None:
+            generation = cls._current_generation()
+            table = cls(Semester.objects.values_list(*cls.FIELDS), generation)
+            cls._table = table
+        return table
+
+    @classmethod
+    def expire(cls):
+        """
+        Forget the table in this process, and tell other processes to do the same.
         """
-        current_semester = Semester.objects.get(name=start)
-        while current_semester and current_semester.name != end:
-            yield str(current_semester.name)
-            current_semester = current_semester.offset(1) 
-        if current_semester:
-            yield str(current_semester.name)
+        cls._table = None
+        gen = cache.get(SEMESTER_TABLE_GENERATION_KEY, 0)
+        cache.set(SEMESTER_TABLE_GENERATION_KEY, max(int(time.time() * 1000), gen + 1), None)
+
+    @classmethod
+    def changed(cls):
+        """
+        Called when a Semester is saved or deleted: expire the table now, and again once the change is committed.
+        """
+        cls.expire()
+        if transaction.get_connection().in_atomic_block:
+            pending = _pending_semester_callbacks
+            # tables built since an earlier change in this transaction don't include this one
+            for c in pending.callbacks:
+                c.table = None
+            callback = _UncommittedSemesters(next(pending.order))
+            pending.callbacks.add(callback)
+            transaction.on_commit(callback)
+
+    def _semester(self, i):
+        return Semester.from_db('default', self.FIELDS, self.rows[i])
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.rows)
+
+    def semester(self, name):
+        "The semester with this name (or Semester.DoesNotExist)."
+        if name not in self.index:
+            raise Semester.DoesNotExist("No semester %r." % (name,))
+        return self._semester(self.index[name])
+
+    def offset(self, name, n):
+        "The semester n semesters after the one with this name (or None)."
+        i = self.index[name] + n
+        if 0 <= i < len(self.rows):
+            return self._semester(i)
+        return None
+
+    def get_semester(self, date):
+        "The semester that started most recently on or before this date."
+        i = bisect.bisect_right(self.starts, date) - 1
+        if i < 0:
+            raise IndexError("No semester starts by %s." % (date,))
+        return self._semester(self.by_start[i])
+
+    def next_starting(self, date):
+        "The next semester that starts after this date (or the last to start, if none do)."
+        i = bisect.bisect_right(self.starts, date)
+        if i < len(self.starts):
+            return self._semester(self.by_start[i])
+        # just in case there's nothing in the future
+        return self._semester(self.by_start[-1])
+
+    def range(self, start, end):
+        "Names of the semesters from start to end (inclusive), as Semester.range."
+        i = self.index.get(start)
+        if i is None:
+            raise Semester.DoesNotExist("No semester %r." % (start,))
+        for row in self.rows[i:]:
+            yield str(row[1])
+            if row[1] == end:
+                break
+
+
+class _UncommittedSemesters(object):
+    """
+    on_commit callback for a transaction that has changed Semesters: holds the SemesterTable used until then, and
+    expires the shared one when the transaction commits.
+    """
+    def __init__(self, order):
+        self.order = order
+        self.table = None
+
+    def __call__(self):
+        _pending_semester_callbacks.callbacks.discard(self)
+        SemesterTable.expire()
+
+
+class _PendingSemesterCallbacks(threading.local):
+    "The _UncommittedSemesters waiting for this thread's transaction: weakly held, so those Django discards vanish."
+    def __init__(self):
+        self.callbacks = weakref.WeakSet()
+        self.order = itertools.count()
+
+_pending_semester_callbacks = _PendingSemesterCallbacks()
+
+
+def _expire_semester_table(instance, **kwargs):
+    SemesterTable.changed()
+
+models.signals.post_save.connect(_expire_semester_table, sender=Semester)
+models.signals.post_delete.connect(_expire_semester_table, sender=Semester)
 
 class SemesterWeek(models.Model):
     """
@@ -1713,6 +1873,29 @@ class Role(models.Model):
     def all_roles(cls, userid):
         return set((r.role for r in Role.objects_fresh.filter(person__userid=userid)))
 
+    @staticmethod
+    def cache_key(userid):
+        return 'roles-%s' % (userid,)
+
+    @classmethod
+    def for_userid(cls, userid):
+        """
+        All of this user's Roles (including expired ones), with their units. Cached for settings.ROLE_CACHE_TIMEOUT
+        seconds (default ROLE_CACHE_TIMEOUT, or 0 to disable): callers must check the expiry themselves.
+        """
+        timeout = getattr(settings, 'ROLE_CACHE_TIMEOUT', ROLE_CACHE_TIMEOUT)
+        key = cls.cache_key(userid)
+        if timeout:
+            roles = cache.get(key)
+            if roles is not None:
+                return roles
+
+        roles = list(Role.objects.filter(person__userid=userid).select_related('unit'))
+        # roles read in a transaction may include its uncommitted (and maybe rolled-back) changes: don't share them
+        if timeout and not transaction.get_connection().in_atomic_block:
+            cache.set(key, roles, timeout)
+        return roles
+
     def expires_far(self):
         return self.expiry - datetime.date.today() < datetime.timedelta(days=182)
 
@@ -1802,6 +1985,16 @@ class Role(models.Model):
             r.delete()
 
 
+def _expire_cached_roles(instance, **kwargs):
+    # now, and again once committed, in case another request re-cached the old roles in between
+    key = Role.cache_key(instance.person.userid)
+    cache.delete(key)
+    transaction.on_commit(lambda: cache.delete(key))
+
+models.signals.post_save.connect(_expire_cached_roles, sender=Role)
+models.signals.post_delete.connect(_expire_cached_roles, sender=Role)
+
+
 class CombinedOffering(models.Model):
     """
     A model to represent a local fake CourseOffering that should be the result of combining members of two or more
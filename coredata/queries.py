@@ -327,6 +327,35 @@ def get_names(emplid):
     return last_name, first_name, middle_name, pref_first_name, title
 
 
+NAMES_QUERY_CHUNK = 1000 # emplids per PS_NAMES query in get_names_many
+
+@SIMS_problem_handler
+def get_names_many(emplids):
+    """
+    Basic personal info for many people at once, as get_names() returns for one.
+
+    Returns a dict of emplid (int) -> (last_name, first_name, middle_name, pref_first_name, title), with people SIMS
+    doesn't know omitted.
+    """
+    db = SIMSConn()
+    emplids = sorted(set(str(e) for e in emplids))
+    names = {}
+    for i in range(0, len(emplids), NAMES_QUERY_CHUNK):
+        db.execute("SELECT EMPLID, NAME_TYPE, NAME_PREFIX, LAST_NAME, FIRST_NAME, MIDDLE_NAME FROM PS_NAMES WHERE "
+                   "EMPLID IN %s AND EFF_STATUS='A' AND NAME_TYPE IN ('PRI','PRF') "
+                   "ORDER BY EMPLID, EFFDT", (emplids[i:i+NAMES_QUERY_CHUNK],))
+        # same logic as get_names: order by effdt so the latest values are left at the end
+        for emplid, name_type, prefix, last, first, middle in db:
+            _, first_name, _, pref_first_name, _ = names.get(int(emplid), (None,) * 5)
+            if name_type == 'PRI':
+                first_name = first
+            elif name_type == 'PRF':
+                pref_first_name = first
+            names[int(emplid)] = (last, first_name, middle, pref_first_name, prefix)
+
+    return names
+
+
 GRADFIELDS = ['ccredits', 'citizen', 'gpa', 'gender', 'visa']
 @cache_by_args
 @SIMS_problem_handler
@@ -1556,11 +1585,16 @@ def build_person(emplid, userid=None, commit=True):
     return import_person(p, commit=commit)
 
 
-def import_person(p, commit=True, grad_data=False):
+def import_person(p, commit=True, grad_data=False, names=None):
     """
     Import SIMS (+ userid) information about this Person. Return the Person or None if they can't be found.
+
+    names can be given as the get_names() result for this person, if it has already been fetched (e.g. by
+    get_names_many).
     """
-    last_name, legal_first_name, middle_name, pref_first_name, title = get_names(p.emplid)
+    if names is None:
+        names = get_names(p.emplid)
+    last_name, legal_first_name, middle_name, pref_first_name, title = names
     if last_name is None:
         # no name = no such person
         return None
@@ -171,6 +171,13 @@ import logging
 logger = logging.getLogger('coredata.importer')
 
 
+from celery.signals import task_prerun
+@task_prerun.connect
+def reset_person_cache(**kwargs):
+    # the importer's cache of Person objects lasts for one task, so it's never far out of date
+    importer.imported_people.clear()
+
+
 # adapted from https://docs.python.org/2/library/itertools.html
 # Used to chunk big lists into task-sized blocks.
 def grouper(iterable, n):
@@ -251,22 +258,24 @@ def import_offerings(continue_import=False):
 
 def get_import_offerings_tasks():
     """
-    Get all of the offerings to import, and build tasks (in groups) to do the work.
+    Get all of the offerings to import, and build tasks to import their members: instructors, students and meeting
+    times each get a task per chunk of importer.STUDENT_IMPORT_CHUNK offerings, so no task nears the time limit.
 
     Doesn't actually call the jobs: just returns celery tasks to be called.
     """
     #offerings = importer.import_offerings(extra_where="CT.SUBJECT='CMPT' and CT.CATALOG_NBR IN (' 383', ' 470')")
     offerings = importer.import_offerings(cancel_missing=True)
-    offerings = list(offerings)
-    offerings.sort()
+    semesters = sorted(set(o.semester.name for o in offerings))
 
-    offering_groups = grouper(offerings, 10)
-    slug_groups = ([o.slug for o in offerings] for offerings in offering_groups)
+    tasks = []
+    for strm in semesters:
+        for offerings in importer.import_offering_chunks(strm):
+            offering_ids = [o.id for o in offerings]
+            tasks.append(import_instructors_chunk.si(strm, offering_ids))
+            tasks.append(import_students_chunk.si(strm, offering_ids))
+            tasks.append(import_meeting_times_chunk.si(strm, offering_ids))
 
-    #tasks = [import_offering_group.si(slugs) for slugs in slug_groups]
-    #return tasks
-
-    offering_import_chain = celery.chain(*[import_offering_group.si(slugs) for slugs in slug_groups])
+    offering_import_chain = celery.chain(*tasks)
     return offering_import_chain
 
 from requests.exceptions import Timeout
@@ -282,6 +291,32 @@ def import_offering_group(self, slugs):
             raise self.retry(exc=exc)
 
 
+def _chunk_offerings(offering_ids):
+    return list(CourseOffering.objects.filter(id__in=offering_ids).select_related('semester'))
+
+
+@task(queue='sims')
+def import_instructors_chunk(strm, offering_ids):
+    logger.debug('Importing instructors for %i offerings in %s' % (len(offering_ids), strm))
+    importer.import_instructors_chunk(strm, _chunk_offerings(offering_ids))
+
+
+@task(bind=True, queue='sims', default_retry_delay=300)
+def import_students_chunk(self, strm, offering_ids):
+    logger.debug('Importing students for %i offerings in %s' % (len(offering_ids), strm))
+    try:
+        importer.import_students_chunk(strm, _chunk_offerings(offering_ids))
+    except Timeout as exc:
+        # elasticsearch timeout: have celery pause while it collects it thoughts, and retry
+        raise self.retry(exc=exc)
+
+
+@task(queue='sims')
+def import_meeting_times_chunk(strm, offering_ids):
+    logger.debug('Importing meeting times for %i offerings in %s' % (len(offering_ids), strm))
+    importer.import_meeting_times_chunk(strm, _chunk_offerings(offering_ids))
+
+
 @task(queue='sims')
 def import_combined_sections():
     logger.info('Importing combined sections from SIMS')
@@ -181,6 +181,50 @@ class CoredataTest(TestCase):
         s2 = Semester(name="1077", start=date(2007,9,4), end=date(2007,12,3))
         self.assertRaises(IntegrityError, s2.save)
         
+    def test_semester_table(self):
+        from coredata.models import SemesterTable
+        s = Semester.objects.get(name='1131')
+        SemesterTable.get()
+        with self.assertNumQueries(0):
+            self.assertEqual(s.next_semester().name, '1134')
+            self.assertEqual(s.offset(-2).name, '1124')
+            self.assertEqual(Semester.get_semester(date(2013, 1, 3)).name, '1127')
+            self.assertEqual(Semester.get_semester(date(2013, 1, 4)).name, '1131')
+            self.assertEqual(list(Semester.range('1137', '1147')), ['1137', '1141', '1144', '1147'])
+            self.assertIsNone(s.offset(1000))
+        self.assertRaises(IndexError, Semester.get_semester, date(2000, 1, 1))
+
+        # changes are seen after a save: by the transaction making them, and by everyone once it commits
+        with self.captureOnCommitCallbacks(execute=True):
+            s.start = date(2012, 12, 20)
+            s.save()
+            self.assertEqual(Semester.get_semester(date(2013, 1, 3)).name, '1131')
+        self.assertEqual(Semester.get_semester(date(2013, 1, 3)).name, '1131')
+        with self.captureOnCommitCallbacks(execute=True):
+            new = Semester(name="1171", start=date(2017,1,4), end=date(2017,4,3))
+            new.save()
+        self.assertEqual(Semester.objects.get(name='1167').next_semester(), new)
+        self.assertEqual(Semester.get_semester(date(2017, 2, 1)), new)
+
+        # ... and after a delete (which Semester.delete refuses, but a queryset can do)
+        with self.captureOnCommitCallbacks(execute=True):
+            Semester.objects.filter(id=new.id).delete()
+        self.assertNotIn('1171', SemesterTable.get())
+        with self.assertNumQueries(0):
+            self.assertNotIn('1171', SemesterTable.get())
+
+        # an uncommitted change isn't put in the shared table, so a rollback can't leave it behind
+        from django.db import transaction
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Semester(name="1174", start=date(2017,4,4), end=date(2017,9,3)).save()
+                self.assertIn('1174', SemesterTable.get())
+                self.assertIsNone(SemesterTable._table)
+                raise IntegrityError
+        self.assertNotIn('1174', SemesterTable.get())
+        with self.assertNumQueries(0):
+            self.assertNotIn('1174', SemesterTable.get())
+
     def test_semester_2(self):
         s = create_semester()
         wk = SemesterWeek(semester=s, week=1, monday=date(2007,9,3))
@@ -356,7 +400,56 @@ class SlowCoredataTest(TestCase):
         # courseoffering detail page
         url = reverse('browse:browse_courses_info', kwargs={'course_slug': TEST_COURSE_SLUG})
         response = basic_page_tests(self, client, url)
-    
+
+    def test_auth_context(self):
+        from django.test import RequestFactory, override_settings
+        from django.contrib.auth.models import User
+        from courselib.auth import has_role, has_global_role, is_instructor, is_course_member_by_slug, \
+            is_course_staff_by_slug, is_course_instr_by_slug, is_course_student_by_slug
+        Semester.current() # prime the semester table
+
+        request = RequestFactory().get('/')
+        request.user = User(username='ggbaker')
+        with self.assertNumQueries(1):
+            self.assertTrue(has_global_role('SYSA', request))
+            self.assertTrue(has_role(['SYSA', 'ADMN'], request))
+            self.assertFalse(has_role('ADMN', request))
+            self.assertFalse(is_instructor(request))
+        with self.assertNumQueries(1):
+            self.assertTrue(is_course_member_by_slug(request, TEST_COURSE_SLUG))
+            self.assertTrue(is_course_staff_by_slug(request, TEST_COURSE_SLUG))
+            self.assertTrue(is_course_instr_by_slug(request, TEST_COURSE_SLUG))
+            self.assertFalse(is_course_student_by_slug(request, TEST_COURSE_SLUG))
+        self.assertEqual(request.member.role, 'INST')
+
+        # impersonation changes the user: nothing should carry over
+        request.user = User(username='0aaa3')
+        self.assertFalse(is_course_staff_by_slug(request, TEST_COURSE_SLUG))
+        self.assertTrue(is_course_student_by_slug(request, TEST_COURSE_SLUG))
+
+        # roles are cached across requests, and expire when changed
+        from unittest import mock
+        from django.core.cache import cache
+        from django.db import connection
+        def is_sysadmin():
+            request = RequestFactory().get('/')
+            request.user = User(username='ggbaker')
+            return has_global_role('SYSA', request)
+        key = Role.cache_key('ggbaker')
+        cache.delete(key)
+        # ... but not when read in a transaction (as everything in this test is), which might be rolled back
+        self.assertTrue(is_sysadmin())
+        self.assertIsNone(cache.get(key))
+        with mock.patch.object(connection, 'in_atomic_block', False):
+            self.assertTrue(is_sysadmin())
+        with self.assertNumQueries(0):
+            self.assertTrue(is_sysadmin())
+        with override_settings(ROLE_CACHE_TIMEOUT=0), self.assertNumQueries(1):
+            self.assertTrue(is_sysadmin())
+
+        Role.objects.filter(person__userid='ggbaker', role='SYSA').get().delete()
+        self.assertFalse(is_sysadmin())
+
     def disabled_test_ajax(self):
         # disabled because haystack + tests aren't behaving well
         client = Client()
@@ -542,4 +635,158 @@ class DependencyTest(TestCase):
             return len(s)
 
         n = 100
-        self.assertEqual(f('乐' * n), n)
\ No newline at end of file
+        self.assertEqual(f('乐' * n), n)
+
+class FakeSIMSConn(object):
+    """
+    Stands in for SIMSConn in the importer: returns canned rows for each query the student import makes.
+    """
+    results = {}
+    queries = []
+
+    def execute(self, query, args):
+        FakeSIMSConn.queries.append(query)
+        for marker, rows in self.results.items():
+            if marker in query:
+                self._rows = list(rows)
+                return
+        self._rows = []
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def rows(self):
+        return list(self._rows)
+
+
+class ImportStudentsTest(TestCase):
+    def setUp(self):
+        self.semester, self.offering = create_offering()
+        self.people = []
+        for i in range(4):
+            p = Person(emplid=301000000 + i, userid='stud%i' % (i,), last_name='Student', first_name=str(i))
+            p.config['lastimport'] = 2e9 # far enough in the future that nobody is due for a re-import
+            p.save()
+            self.people.append(p)
+
+    def test_import_all_students(self):
+        from unittest import mock
+        from coredata import importer
+        o = self.offering
+        p0, p1, p2, p3 = self.people
+        # p0 stays enrolled with different credits; p1 is gone from SIMS; p2 is new; p3 had a manual entry.
+        m0 = Member(person=p0, offering=o, role='STUD', credits=3, career='UGRD', added_reason='AUTO')
+        m0.save()
+        m1 = Member(person=p1, offering=o, role='STUD', credits=3, career='UGRD', added_reason='AUTO')
+        m1.save()
+        m3 = Member(person=p3, offering=o, role='STUD', credits=3, career='UGRD', added_reason='UNK')
+        m3.save()
+        self.assertFalse(o.labtut())
+
+        FakeSIMSConn.queries = []
+        FakeSIMSConn.results = {
+            'C2.CLASS_SECTION': [(o.class_nbr, str(p2.emplid), 'D101'), (o.class_nbr, str(p0.emplid), 'D100')],
+            'CRSE_GRADE_OFF': [
+                (o.class_nbr, str(p0.emplid), 'UGRD', 4, None, None),
+                (o.class_nbr, str(p2.emplid), 'GRAD', 3, 'A', None),
+            ],
+            'ENRL_DROP_DT': [(o.class_nbr, str(p1.emplid), date(2026, 10, 1))],
+        }
+        importer.imported_people.clear()
+        with mock.patch('coredata.importer.SIMSConn', FakeSIMSConn), \
+                mock.patch('coredata.importer.random.random', return_value=0.5):
+            importer.import_all_students(self.semester.name)
+
+        # one query of each kind for the whole (one-chunk) semester
+        self.assertEqual(len(FakeSIMSConn.queries), 3)
+
+        m0 = Member.objects.get(id=m0.id)
+        self.assertEqual((m0.role, m0.credits, m0.labtut_section), ('STUD', 4, None))
+        m1 = Member.objects.get(id=m1.id)
+        self.assertEqual(m1.role, 'DROP')
+        self.assertEqual(m1.config['drop_date'], '2026-10-01')
+        m2 = Member.objects.get(person=p2, offering=o)
+        self.assertEqual((m2.role, m2.career, m2.labtut_section, m2.added_reason), ('STUD', 'GRAD', 'D101', 'AUTO'))
+        self.assertIsNone(m2.official_grade) # no letter activities: grade not needed
+        self.assertEqual(Member.objects.get(id=m3.id).role, 'STUD')
+        self.assertTrue(CourseOffering.objects.get(id=o.id).labtut())
+
+        # a second import with the same data finds nothing to change
+        with mock.patch('coredata.importer.SIMSConn', FakeSIMSConn), \
+                mock.patch('coredata.models.Member.objects.bulk_update') as bulk_update:
+            importer.import_all_students(self.semester.name)
+        bulk_update.assert_called_once()
+        self.assertEqual(list(bulk_update.call_args[0][0]), [])
+        self.assertEqual(Member.objects.filter(offering=o).count(), 4)
+
+    def test_import_offering_chunks(self):
+        from unittest import mock
+        from coredata import importer
+        o = self.offering
+        strm = self.semester.name
+        p0, p1, _, _ = self.people
+        m0 = Member(person=p0, offering=o, role='INST', credits=0, career='NONS', added_reason='AUTO')
+        m0.save()
+        self.assertEqual(importer.import_offering_chunks(strm), [[o]])
+
+        FakeSIMSConn.queries = []
+        FakeSIMSConn.results = {
+            'PS_CLASS_INSTR': [('%06i' % (o.crse_id,), o.section, strm, str(p1.emplid), 'PI', 'Y')],
+        }
+        importer.imported_people.clear()
+        with mock.patch('coredata.importer.SIMSConn', FakeSIMSConn):
+            importer.import_instructors_chunk(strm, [o])
+        self.assertEqual(Member.objects.get(id=m0.id).role, 'DROP')
+        self.assertEqual(Member.objects.get(person=p1, offering=o).role, 'INST')
+
+        # combined offerings get their members elsewhere: they aren't in any chunk
+        o.flags.combined = True
+        o.save()
+        self.assertEqual(importer.import_offering_chunks(strm), [])
+
+    def test_get_people(self):
+        from unittest import mock
+        from coredata import importer
+        fresh, stale = self.people[0:2]
+        stale.config['lastimport'] = 0
+        stale.save()
+        names = {
+            stale.emplid: ('Renamed', 'Legal', 'M', 'Preferred', 'Dr'),
+            301000099: ('New', 'Person', None, None, None),
+        }
+
+        importer.imported_people.clear()
+        with mock.patch('coredata.importer.get_names_many', return_value=names) as get_names_many, \
+                mock.patch('coredata.queries.emplid_to_userid', return_value=None), \
+                mock.patch('coredata.importer.random.random', return_value=0.5):
+            people = importer.get_people([fresh.emplid, str(stale.emplid), 301000099, 301000098])
+
+        # one set-based SIMS lookup for everyone who needed importing; unknown emplids omitted
+        get_names_many.assert_called_once_with({stale.emplid, 301000099, 301000098})
+        self.assertEqual(set(people.keys()), {fresh.emplid, stale.emplid, 301000099})
+        self.assertEqual(people[fresh.emplid].last_name, 'Student')
+        stale = Person.objects.get(id=stale.id)
+        self.assertEqual((stale.last_name, stale.first_name, stale.middle_name, stale.title),
+                         ('Renamed', 'Preferred', 'M', 'Dr'))
+        self.assertEqual(stale.config['legal_first_name_do_not_use'], 'Legal')
+        self.assertEqual(Person.objects.get(emplid=301000099).name(), 'Person New')
+
+        # now cached: no more queries
+        with self.assertNumQueries(0):
+            self.assertEqual(importer.get_person(301000099).last_name, 'New')
+            self.assertEqual(set(importer.get_people([fresh.emplid, 301000099])), {fresh.emplid, 301000099})
+
+    def test_person_cache(self):
+        from coredata.importer import PersonCache
+        cache = PersonCache(2)
+        p0, p1, p2, _ = self.people
+        cache.add(p0)
+        cache.add(p1)
+        self.assertIs(cache.get(str(p0.emplid)), p0)
+        cache.add(p2) # evicts p1, the least-recently used
+        self.assertEqual(len(cache), 2)
+        self.assertNotIn(p1.emplid, cache)
+        self.assertIn(p0.emplid, cache)
+        self.assertIsNone(cache.get(p1.emplid))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
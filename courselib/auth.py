@@ -4,7 +4,6 @@ from django.http import HttpResponseRedirect
 from django.shortcuts import render
 from django.utils.http import urlencode
 from django.utils.safestring import mark_safe
-from django.db.models import Q
 from coredata.models import Role, CourseOffering, Member, Semester
 from onlineforms.models import FormGroup, Form
 from privacy.models import needs_privacy_signature, privacy_redirect, needs_privacy_signature_da, privacy_da_redirect
@@ -68,13 +67,61 @@ def ForbiddenResponse(request, errormsg=None, exception=None):
 def NotFoundResponse(request, errormsg=None, exception=None):
     return HttpError(request, status=404, title="Not Found", error="The requested resource cannot be found.", errormsg=errormsg)
 
+class AuthContext(object):
+    """
+    The user's Roles and course memberships, each loaded at most once per request, so the permission checks below can
+    be answered from memory however many of them a view makes.
+    """
+    def __init__(self, userid):
+        self.userid = userid
+        self._roles = None
+        self._memberships = {}
+
+    @classmethod
+    def for_request(cls, request):
+        userid = request.user.username
+        context = getattr(request, '_auth_context', None)
+        if context is None or context.userid != userid:
+            # new request, or the user changed under us (i.e. impersonation)
+            context = cls(userid)
+            request._auth_context = context
+        return context
+
+    def roles(self, allowed=None, fresh=True):
+        """
+        The user's Roles, optionally limited to those in the allowed list. Expired roles are included only if not fresh.
+        """
+        if self._roles is None:
+            self._roles = Role.for_userid(self.userid) if self.userid else []
+        today = datetime.date.today()
+        return [r for r in self._roles
+                if (not fresh or r.expiry >= today) and (allowed is None or r.role in allowed)]
+
+    def memberships(self, course_slug):
+        """
+        The user's memberships in this (non-cancelled) offering, including drops and ungraded offerings: the checks
+        filter further.
+        """
+        if course_slug not in self._memberships:
+            if self.userid:
+                memberships = Member.objects.select_related('offering', 'offering__semester', 'person') \
+                    .exclude(offering__component="CAN") \
+                    .filter(offering__slug=course_slug, person__userid=self.userid)
+                self._memberships[course_slug] = list(memberships)
+            else:
+                self._memberships[course_slug] = []
+        return self._memberships[course_slug]
+
+    def graded_memberships(self, course_slug, roles):
+        return [m for m in self.memberships(course_slug) if m.role in roles and m.offering.graded]
+
+
 def has_global_role(role, request, **kwargs):
     """
     Return True is the given user has the specified role
     """
-    perms = Role.objects_fresh.filter(person__userid=request.user.username, role=role, unit__label="UNIV")
-    count = perms.count()
-    return count>0
+    roles = AuthContext.for_request(request).roles([role])
+    return any(r.unit.label == "UNIV" for r in roles)
 
 def requires_role(role, get_only=None, login_url=None):
     """
@@ -100,10 +147,9 @@ def has_role(role, request, get_only=None, **kwargs):
         else:
             allowed.append(get_only)
 
-    roles = Role.objects_fresh.filter(person__userid=request.user.username, role__in=allowed).select_related('unit')
+    roles = AuthContext.for_request(request).roles(allowed)
     request.units = set(r.unit for r in roles)
-    count = roles.count()
-    return count > 0
+    return bool(roles)
 
 def requires_global_role(role, login_url=None):
     """
@@ -119,9 +165,8 @@ def is_course_member_by_slug(request, course_slug, **kwargs):
     """
     Return True if user is any kind of member (non-dropped) from course indicated by 'course_slug' keyword.
     """
-    memberships = Member.objects.select_related('offering', 'offering__semester', 'person').exclude(role="DROP").exclude(offering__component="CAN")\
-        .filter(offering__slug=course_slug, person__userid=request.user.username, offering__graded=True)
-    memberships = list(memberships)
+    memberships = [m for m in AuthContext.for_request(request).memberships(course_slug)
+                   if m.role != "DROP" and m.offering.graded]
     if memberships:
         request.member = memberships[0]
         return True
@@ -142,9 +187,8 @@ def is_course_student_by_slug(request, course_slug, **kwargs):
     """
     Return True if user is student from course indicated by 'course_slug' keyword.
     """
-    memberships = Member.objects.filter(offering__slug=course_slug, person__userid=request.user.username, role="STUD", offering__graded=True).exclude(offering__component="CAN")
-    count = memberships.count()
-    return count>0
+    memberships = AuthContext.for_request(request).graded_memberships(course_slug, ["STUD"])
+    return bool(memberships)
 
 def requires_course_student_by_slug(function=None, login_url=None):
     """
@@ -161,18 +205,12 @@ def is_course_staff_by_slug(request, course_slug, expires=True, **kwargs):
     Return True if user is a staff member (instructor, TA, approver) from course indicated by 'course_slug' keyword.
     TAs should only have access to courses they TAed up to a semester ago.
     """
-    if expires:
+    memberships = AuthContext.for_request(request).graded_memberships(course_slug, ['INST', 'APPR', 'TA'])
+    if expires and any(m.role == 'TA' for m in memberships):
         max_semester_name_for_tas = Semester.current().offset_name(-1)
-        ta_query = Q(role='TA') & Q(offering__semester__name__gte=max_semester_name_for_tas)
-    else:
-        ta_query = Q(role='TA')
-
-    memberships = Member.objects.filter(
-        Q(role__in=['INST', 'APPR']) | ta_query,
-        offering__slug=course_slug,
-        person__userid=request.user.username, offering__graded=True
-    ).exclude(offering__component="CAN")
-    memberships = list(memberships)
+        memberships = [m for m in memberships
+                       if m.role != 'TA' or m.offering.semester.name >= max_semester_name_for_tas]
+
     if memberships:
         request.member = memberships[0]
     return bool(memberships)
@@ -191,10 +229,8 @@ def is_course_instr_by_slug(request, course_slug, **kwargs):
     """
     Return True if user is a staff member (instructor, TA, approver) from course indicated by 'course_slug' keyword.
     """
-    memberships = Member.objects.filter(offering__slug=course_slug, person__userid=request.user.username,
-            role__in=['INST', 'APPR'], offering__graded=True).exclude(offering__component="CAN")
-    count = memberships.count()
-    return count>0
+    memberships = AuthContext.for_request(request).graded_memberships(course_slug, ['INST', 'APPR'])
+    return bool(memberships)
 
 def requires_course_instr_by_slug(function=None, login_url=None):
     """
@@ -213,8 +249,8 @@ def is_form_admin_by_slug(request, form_slug, **kwargs):
     owner_ids = [f['owner'] for f in Form.objects.filter(slug=form_slug).values('owner')]
     groups = FormGroup.objects.filter(members__userid=request.user.username)
     #  If you're a Form Admin, also add membership to all formgroups within your unit(s).
-    admin_roles = Role.objects_fresh.filter(person__userid=request.user.username, role='FORM').select_related('unit')
-    admin_groups = FormGroup.objects.filter(unit__in=(r.unit for r in admin_roles))
+    admin_roles = AuthContext.for_request(request).roles(['FORM'])
+    admin_groups = FormGroup.objects.filter(unit__in=[r.unit_id for r in admin_roles])
     groups |= admin_groups
     request.formgroups = set(groups)
     return groups.filter(id__in=owner_ids).count() > 0
@@ -235,8 +271,8 @@ def has_formgroup(request, **kwargs):
     """
     groups = FormGroup.objects.filter(members__userid=request.user.username)
     #  If you're a Form Admin, also add membership to all formgroups within your unit(s).
-    admin_roles = Role.objects_fresh.filter(person__userid=request.user.username, role='FORM').select_related('unit')
-    admin_groups = FormGroup.objects.filter(unit__in=(r.unit for r in admin_roles))
+    admin_roles = AuthContext.for_request(request).roles(['FORM'])
+    admin_groups = FormGroup.objects.filter(unit__in=[r.unit_id for r in admin_roles])
     groups |= admin_groups
     request.formgroups = set(groups)
     return groups.count() > 0
@@ -254,24 +290,24 @@ def is_discipline_user(request, course_slug, **kwargs):
     Return True if user is a discipline user (instructor, approver or discipline admin)
     """
     # departmental discipline admins    
+    context = AuthContext.for_request(request)
     roles = set()
-    offerings = CourseOffering.objects.filter(slug=course_slug)
-    if offerings:
-        offering = offerings[0]
+    memberships = context.memberships(course_slug)
+    if memberships:
+        offering = memberships[0].offering
     else:
-        return False
+        offerings = CourseOffering.objects.filter(slug=course_slug)
+        if offerings:
+            offering = offerings[0]
+        else:
+            return False
 
-    perms = Role.objects_fresh.filter(person__userid=request.user.username, role='DISC', unit=offering.owner).count()
-    perms += Role.objects_fresh.filter(person__userid=request.user.username, role='DISC', unit__label='UNIV').count()
-    if perms>0:
+    perms = [r for r in context.roles(['DISC']) if r.unit_id == offering.owner_id or r.unit.label == 'UNIV']
+    if perms:
         roles.add("DEPT")
 
     # instructors
-    memberships = Member.objects.filter(offering__slug=course_slug, person__userid=request.user.username,
-            role__in=['INST', 'APPR']).exclude(offering__component="CAN")
-    count = memberships.count()
-    
-    if count>0:
+    if any(m.role in ['INST', 'APPR'] for m in memberships):
         roles.add("INSTR")
     
     # record why we have permission in the session
@@ -294,10 +330,9 @@ def is_instructor(request, **kwargs):
     """
     Return True if the user is an instructor
     """
-    roles = Role.objects.filter(person__userid=request.user.username, role__in=['FAC','SESS','COOP'])
-    perms = roles.count()
+    roles = AuthContext.for_request(request).roles(['FAC','SESS','COOP'], fresh=False)
     request.units = [r.unit for r in roles]
-    return perms>0
+    return bool(roles)
 
 def requires_instructor(function=None, login_url=None):
     """
@@ -24,3 +24,65 @@ def upload_path(*path_components):
     # make sure filenames are entirely ASCII
     components = [c.encode('ascii', 'ignore').decode('ascii') for c in components]
     return os.path.join(*components)
+
+
+# Content-addressed store for submitted files (if settings.SUBMISSION_DEDUP): each distinct file's contents is kept
+# once, as content/ab/cd/abcd...(sha256), and the files under their usual upload_path names are hard links to it. The
+# store's copy's link count is the reference count: an entry with no other links is unreferenced.
+CONTENT_STORE_DIR = 'content'
+
+
+def content_store_path(sha256):
+    return os.path.join(settings.SUBMISSION_PATH, CONTENT_STORE_DIR, sha256[0:2], sha256[2:4], sha256)
+
+
+def deduplicate_file(path, sha256):
+    """
+    Put the file at path (whose contents have this sha256 hex digest) into the content-addressed store: if those
+    contents are already stored, path is replaced by a link to the stored copy. Returns True if that happened (and
+    the disk space was saved).
+
+    Raises OSError if the file can't be linked (e.g. the store is on another filesystem).
+    """
+    stored = content_store_path(sha256)
+    os.makedirs(os.path.dirname(stored), mode=0o700, exist_ok=True)
+    try:
+        # new contents: this file becomes the stored copy
+        os.link(path, stored)
+        return False
+    except FileExistsError:
+        pass
+
+    if os.path.samefile(path, stored):
+        return False
+    tmp = path + '.dedup'
+    os.link(stored, tmp)
+    os.replace(tmp, path)
+    return True
+
+
+def content_references(sha256):
+    """
+    Number of files sharing the stored copy of these contents (0 if they aren't stored).
+    """
+    try:
+        return os.stat(content_store_path(sha256)).st_nlink - 1
+    except FileNotFoundError:
+        return 0
+
+
+def remove_unreferenced_content():
+    """
+    Remove the stored copies that no submitted file refers to any more. Returns (files removed, bytes freed).
+    """
+    removed = 0
+    freed = 0
+    for dirpath, _, filenames in os.walk(os.path.join(settings.SUBMISSION_PATH, CONTENT_STORE_DIR)):
+        for fn in filenames:
+            path = os.path.join(dirpath, fn)
+            st = os.stat(path)
+            if st.st_nlink == 1:
+                os.unlink(path)
+                removed += 1
+                freed += st.st_size
+    return removed, freed
@@ -0,0 +1,230 @@
+"""
+Helpers for responses that are generated as they're sent, so large downloads don't have to be built in memory first.
+"""
+
+import collections
+import csv
+import logging
+import os
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+
+logger = logging.getLogger(__name__)
+
+# approximate size of the chunks sent to the client
+CHUNK_SIZE = 64 * 1024
+
+# files that are already compressed, so are stored in ZIP files as-is
+COMPRESSED_EXTENSIONS = {
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.jar', '.whl',
+    '.pdf', '.png', '.jpg', '.jpeg', '.gif', '.webp', '.mp3', '.mp4', '.mov', '.avi',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp',
+}
+
+# files larger than this aren't read ahead into memory by ZipStream: they're streamed from disk when their turn comes
+READ_AHEAD_MAX_SIZE = 16 * 1024 * 1024
+
+
+class _EchoBuffer(object):
+    """
+    File-like object for csv.writer that just returns what's written.
+    """
+    def write(self, value):
+        return value
+
+
+def csv_chunks(rows):
+    """
+    Generate CSV output for the rows, in chunks of about CHUNK_SIZE characters.
+    """
+    writer = csv.writer(_EchoBuffer())
+    chunk = []
+    size = 0
+    for row in rows:
+        line = writer.writerow(row)
+        chunk.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def streaming_csv_response(rows, filename, disposition='attachment'):
+    """
+    StreamingHttpResponse that sends the rows (an iterable of lists) as CSV as they are generated.
+    """
+    response = StreamingHttpResponse(csv_chunks(rows), content_type='text/csv')
+    response['Content-Disposition'] = '%s; filename="%s"' % (disposition, filename)
+    return response
+
+
+class _ByteBuffer(object):
+    """
+    Unseekable file-like object that collects what's written until it's taken.
+    """
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        self.size = 0
+        return data
+
+
+def _read_file(filename):
+    """
+    Read the whole file: returns (contents, seconds it took).
+    """
+    start = time.time()
+    with open(filename, 'rb') as fh:
+        data = fh.read()
+    return data, time.time() - start
+
+
+class ZipStream(object):
+    """
+    A ZIP file that is generated as it's iterated. Files are added with .write() and .writestr() (with the same
+    arguments as a zipfile.ZipFile), but files on disk aren't read until their part of the archive is produced.
+    Work that adds more files can be put off until the archive gets to it with .defer().
+
+    While the archive is written, a pool of threads reads the next read_ahead files (settings.ZIP_READ_AHEAD, default
+    8) into memory, so slow storage is read in parallel instead of one file at a time. Throughput is logged and left in
+    self.stats when the archive is finished.
+
+    Files are deflated, except types listed in COMPRESSED_EXTENSIONS, which are stored.
+    """
+    def __init__(self, read_ahead=None, read_threads=None):
+        self._entries = collections.deque()
+        self.read_ahead = getattr(settings, 'ZIP_READ_AHEAD', 8) if read_ahead is None else read_ahead
+        self.read_threads = getattr(settings, 'ZIP_READ_THREADS', 4) if read_threads is None else read_threads
+        self.stats = None
+
+    def write(self, filename, arcname=None):
+        # stat the file now: a missing file fails here, as with ZipFile.write
+        zinfo = zipfile.ZipInfo.from_file(filename, arcname)
+        self._entries.append((zinfo, filename, None))
+
+    def writestr(self, arcname, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        zinfo = zipfile.ZipInfo(filename=arcname, date_time=time.localtime(time.time())[:6])
+        zinfo.external_attr = 0o600 << 16
+        self._entries.append((zinfo, None, data))
+
+    def defer(self, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) when the archive reaches this point: anything it adds goes here in the archive.
+        """
+        self._entries.append((None, func, (args, kwargs)))
+
+    def _read_ahead(self, pool, pending, reads):
+        """
+        Start reading the next self.read_ahead files in pending (that aren't already being read).
+        """
+        seen = 0
+        for entry in pending:
+            if seen >= self.read_ahead:
+                break
+            zinfo, source, _ = entry
+            if zinfo is None or source is None or zinfo.file_size > READ_AHEAD_MAX_SIZE:
+                continue
+            seen += 1
+            if id(entry) not in reads:
+                reads[id(entry)] = pool.submit(_read_file, source)
+
+    def __iter__(self):
+        stats = {'files': 0, 'bytes': 0, 'read_time': 0.0, 'read_wait': 0.0, 'elapsed': 0.0}
+        start = time.time()
+        buf = _ByteBuffer()
+        pending = self._entries
+        reads = {} # id(entry) -> Future for the file's contents
+        pool = ThreadPoolExecutor(max_workers=self.read_threads) if self.read_ahead > 0 else None
+        try:
+            with zipfile.ZipFile(buf, 'w') as z:
+                while pending:
+                    if pool:
+                        self._read_ahead(pool, pending, reads)
+                    entry = pending.popleft()
+                    zinfo, source, data = entry
+                    if zinfo is None:
+                        # deferred work: put whatever it adds at the front of the queue
+                        self._entries = collections.deque()
+                        args, kwargs = data
+                        source(*args, **kwargs)
+                        pending.extendleft(reversed(self._entries))
+                        self._entries = pending
+                        continue
+
+                    if os.path.splitext(zinfo.filename)[1].lower() not in COMPRESSED_EXTENSIONS:
+                        zinfo.compress_type = zipfile.ZIP_DEFLATED
+
+                    read = reads.pop(id(entry), None)
+                    if source is not None and read is not None:
+                        waiting = time.time()
+                        data, read_time = read.result()
+                        stats['read_wait'] += time.time() - waiting
+                        stats['read_time'] += read_time
+                        source = None
+
+                    if source is None:
+                        view = memoryview(data)
+                        with z.open(zinfo, 'w') as dest:
+                            for pos in range(0, len(data), CHUNK_SIZE):
+                                dest.write(view[pos:pos+CHUNK_SIZE])
+                                if buf.size >= CHUNK_SIZE:
+                                    yield buf.take()
+                        stats['bytes'] += len(data)
+                    else:
+                        # too big to read ahead: copy from disk as we go
+                        reading = time.time()
+                        with open(source, 'rb') as src, z.open(zinfo, 'w') as dest:
+                            while True:
+                                block = src.read(CHUNK_SIZE)
+                                if not block:
+                                    break
+                                dest.write(block)
+                                stats['bytes'] += len(block)
+                                if buf.size >= CHUNK_SIZE:
+                                    yield buf.take()
+                        stats['read_time'] += time.time() - reading
+                    stats['files'] += 1
+
+                    if buf.size >= CHUNK_SIZE:
+                        yield buf.take()
+
+            yield buf.take()
+        finally:
+            if pool:
+                pool.shutdown(wait=False, cancel_futures=True)
+
+        stats['elapsed'] = time.time() - start
+        self.stats = stats
+        logger.info('ZIP of %i files, %.1f MB in %.1fs (%.1f MB/s); %.1fs reading files, %.1fs waiting for reads'
+                    % (stats['files'], stats['bytes'] / 1e6, stats['elapsed'],
+                       stats['bytes'] / 1e6 / max(stats['elapsed'], 0.001), stats['read_time'], stats['read_wait']))
+
+
+def streaming_zip_response(zipstream, filename):
+    """
+    StreamingHttpResponse that sends the ZipStream as it is generated.
+    """
+    response = StreamingHttpResponse(iter(zipstream), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="%s"' % (filename,)
+    return response
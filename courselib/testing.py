@@ -4,6 +4,7 @@ import html5lib
 import datetime
 from django.urls import reverse
 from django.core.management import call_command
+from django.core.cache import cache
 
 from django.test import TestCase
 
@@ -99,6 +100,8 @@ def freshen_roles():
     """
     expiry = datetime.date.today() + datetime.timedelta(days=365)
     Role.objects.all().update(expiry=expiry)
+    # the update doesn't send the signals that forget cached roles
+    cache.delete_many([Role.cache_key(userid) for userid in Role.objects.values_list('person__userid', flat=True)])
 
 
 from django.conf import settings
@@ -394,6 +394,8 @@ if not FORCE_CAS and (DEPLOY_MODE != 'production' or DEBUG) and hostname != 'cou
 # For security reasons, when we're live, we don't want to keep potentially 
 #  sensitive user data in /tmp for longer than the space of one run. 
 REPORT_CACHE_LOCATION = "/tmp/report_cache"
+REPORT_CACHE_MAX_SIZE = 1024**3 # bytes of cached query results to keep
+REPORT_WORKERS = 4 # scheduled reports to run at the same time
 REPORT_CACHE_CLEAR = True
 if DEPLOY_MODE == 'production':
     REPORT_CACHE_CLEAR = True
@@ -1,15 +1,16 @@
 from django.db import models
-from coredata.models import Person, CourseOffering, Member
+from coredata.models import Person, CourseOffering, Member, MeetingTime, Holiday, Role
 from django.utils.safestring import mark_safe
 from pytz import timezone
 from django.conf import settings
-from django.core.mail import EmailMultiAlternatives
+from django.core.cache import cache
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.urls import reverse
 from autoslug.settings import slugify
 from courselib.json_fields import JSONField, config_property
 from courselib.branding import product_name
 from courselib.storage import UploadedFileStorage, upload_path
-import random, hashlib, os, datetime
+import random, hashlib, os, datetime, time
 
 
 def _rfc_format(dt):
@@ -59,7 +60,7 @@ class NewsItem(models.Model):
 
         # see if this user wants news by email
         ucs = UserConfig.objects.filter(user=self.user, key="newsitems")
-        if ucs and 'email' in ucs[0].value and not ucs[0].value['email']:
+        if ucs and not _wants_news_email(ucs[0].value):
             # user has requested no email
             pass
         else:
@@ -94,8 +95,18 @@ class NewsItem(models.Model):
         """
         Email this news item to the user.
         """
+        msg = self.email_message()
+        if msg:
+            msg.send()
+
+    def email_message(self, content_xhtml=None):
+        """
+        Build the email of this news item for the user (or None if they have no email address).
+
+        content_xhtml can be given if the content has already been rendered.
+        """
         if not self.user.email():
-            return
+            return None
 
         headers = {
                 'Precedence': 'bulk',
@@ -128,14 +139,15 @@ class NewsItem(models.Model):
             html_content = '<h3>%s: <a href="%s">%s</a></h3>\n' % (self.course.name(), url, self.title)
         else:
             html_content = '<h3><a href="%s">%s</a></h3>\n' % (url, self.title)
-        html_content += self.content_xhtml()
+        html_content += content_xhtml if content_xhtml is not None else self.content_xhtml()
         html_content += '\n<p style="font-size: smaller; border-top: 1px solid black;">You received this email from %s. If you do not wish to receive\nthese notifications by email, you can <a href="%s">change your email settings</a>.</p>' \
                         % (product_name(hint='course'), settings.BASE_ABS_URL + reverse('config:news_config'))
         
         msg = EmailMultiAlternatives(subject, text_content, from_email, [to_email], headers=headers)
         msg.attach_alternative(html_content, "text/html")
-        msg.send()
-        
+        return msg
+
+
     def content_xhtml(self):
         """
         Render content field as XHTML.
@@ -177,15 +189,59 @@ class NewsItem(models.Model):
         newsitem_kwargs.
         """
         # randomize order in the hopes of throwing off any spam filters
-        members = Member.objects.exclude(role="DROP").exclude(role="APPR").filter(**member_kwargs)
+        members = Member.objects.exclude(role="DROP").exclude(role="APPR").filter(**member_kwargs) \
+            .select_related('person')
         members = list(members)
         random.shuffle(members)
 
         markup = newsitem_kwargs.pop('markup', 'textile')
+        items = []
         for m in members:
             n = NewsItem(user=m.person, **newsitem_kwargs)
             n.markup = markup
-            n.save()
+            items.append(n)
+
+        cls.publish(items)
+
+    @classmethod
+    def publish(cls, items):
+        """
+        Save many (unsaved) news items, and email them to the users who want that: the bulk equivalent of .save()
+        on each.
+
+        The emails are handed to the mail backend together, so (with Celery) they are sent in batches, each over one
+        SMTP connection.
+        """
+        items = cls.objects.bulk_create(items, batch_size=1000)
+
+        user_ids = set(n.user_id for n in items)
+        no_email = set(uc.user_id for uc in UserConfig.objects.filter(user_id__in=user_ids, key="newsitems")
+                       if not _wants_news_email(uc.value))
+
+        # typically all of the items have the same content: render it once.
+        rendered = {}
+        messages = []
+        for n in items:
+            if n.user_id in no_email:
+                continue
+            key = (n.content, n.markup)
+            if key not in rendered:
+                rendered[key] = n.content_xhtml()
+            msg = n.email_message(content_xhtml=rendered[key])
+            if msg:
+                messages.append(msg)
+
+        if messages:
+            get_connection().send_messages(messages)
+
+        return items
+
+
+def _wants_news_email(value):
+    """
+    Does this "newsitems" UserConfig value allow news by email?
+    """
+    return not ('email' in value and not value['email'])
 
 
 class UserConfig(models.Model):
@@ -202,6 +258,195 @@ class UserConfig(models.Model):
         return "%s: %s='%s'" % (self.user.userid, self.key, self.value)
 
 
+# Cached calendar data: each offering's events are cached (by dashboard.views) under a generation number that is
+# bumped when anything they're built from changes. Holidays have their own generation, since they affect everyone.
+
+def _calendar_generation_key(offering_id):
+    if offering_id is None:
+        return "calendar-generation-holidays"
+    return "calendar-generation-%i" % (offering_id,)
+
+def calendar_generations(offering_ids):
+    """
+    The current calendar generations for these offerings (offering_id None for holidays), as a dict. Generations are
+    millisecond timestamps of the last change, so they double as last-modified times.
+    """
+    keys = {_calendar_generation_key(oid): oid for oid in offering_ids}
+    found = cache.get_many(list(keys.keys()))
+    gens = {}
+    for key, oid in keys.items():
+        gen = found.get(key)
+        if gen is None:
+            # nothing cached for this generation, so anything built now is new.
+            gen = int(time.time() * 1000)
+            if not cache.add(key, gen, None):
+                gen = cache.get(key, gen)
+        gens[oid] = gen
+    return gens
+
+def expire_calendar(offering_id):
+    """
+    Expire the cached calendar events for this offering (or offering_id None for holidays, which affect all).
+    """
+    key = _calendar_generation_key(offering_id)
+    gen = max(int(time.time() * 1000), cache.get(key, 0) + 1)
+    cache.set(key, gen, None)
+
+def calendar_feed_key(userid):
+    return "calendar-feed-" + userid
+
+def expire_calendar_feed(person):
+    """
+    Forget the cached membership/token summary behind this person's calendar feed.
+    """
+    if person.userid:
+        cache.delete(calendar_feed_key(person.userid))
+
+
+def _expire_offering_calendar(instance, **kwargs):
+    if instance.offering_id:
+        expire_calendar(instance.offering_id)
+
+def _expire_holiday_calendar(instance, **kwargs):
+    expire_calendar(None)
+
+def _expire_offering_self_calendar(instance, **kwargs):
+    expire_calendar(instance.id)
+
+def _expire_member_calendar_feed(instance, **kwargs):
+    expire_calendar_feed(instance.person)
+
+def _expire_userconfig_calendar_feed(instance, **kwargs):
+    if instance.key == 'calendar-config':
+        expire_calendar_feed(instance.user)
+
+for signal in [models.signals.post_save, models.signals.post_delete]:
+    signal.connect(_expire_offering_calendar, sender=MeetingTime)
+    signal.connect(_expire_holiday_calendar, sender=Holiday)
+    signal.connect(_expire_member_calendar_feed, sender=Member)
+    signal.connect(_expire_userconfig_calendar_feed, sender=UserConfig)
+models.signals.post_save.connect(_expire_offering_self_calendar, sender=CourseOffering)
+# activities are in grades.models (which imports this module): it connects their signals.
+
+
+DASHBOARD_SUMMARY_TIMEOUT = 3600 # changes the signals can't see (like bulk-imported memberships) show up within this time
+
+def dashboard_summary_key(person_id):
+    return "dashboard-summary-%i" % (person_id,)
+
+DASHBOARD_GENERATION_KEY = "dashboard-summary-generation"
+def _dashboard_generation():
+    """
+    Generation of all dashboard summaries: bumped by changes that affect everyone (semester dates).
+    """
+    gen = cache.get(DASHBOARD_GENERATION_KEY)
+    if gen is None:
+        gen = int(time.time() * 1000)
+        if not cache.add(DASHBOARD_GENERATION_KEY, gen, None):
+            gen = cache.get(DASHBOARD_GENERATION_KEY, gen)
+    return gen
+
+class DashboardSummary(object):
+    """
+    What the dashboard front page needs to know about a user: their course menu, and which parts of the system they
+    should have links to. Built by for_userid, which caches it per person.
+    """
+    def __init__(self, userid):
+        from grad.models import GradStudent, Supervisor, STATUS_ACTIVE
+        from onlineforms.models import FormGroup
+        from ra.models import RAAppointment, RARequest
+        from reports.models import AccessRule
+
+        self.userid = userid
+        self.date = datetime.date.today()
+        self.memberships, self.excluded = Member.get_memberships(userid)
+        self.roles = Role.all_roles(userid)
+        self.is_grad = GradStudent.objects.filter(person__userid=userid, current_status__in=STATUS_ACTIVE).exists()
+        self.has_grads = Supervisor.objects.filter(supervisor__userid=userid, supervisor_type__in=['SEN','COM','COS'], removed=False).exists()
+        self.form_groups = FormGroup.objects.filter(members__userid=userid).exists()
+        self.has_ras = RAAppointment.objects.filter(hiring_faculty__userid=userid, deleted=False).exists()
+        self.has_ra_requests = RARequest.objects.filter(models.Q(supervisor__userid=userid) | models.Q(author__userid=userid), deleted=False, draft=False).exists()
+        self.has_reports = AccessRule.objects.filter(person__userid=userid).exists()
+
+        # Only CMPT admins should see the one different TA module.  They can now also see the other module as we hope to
+        # transition them over.
+        self.cmpt_taadmn = Role.objects_fresh.filter(person__userid=userid, role='TAAD', unit__label='CMPT').exists()
+
+        # the menu depends on the offerings' activities (and details): their calendar generations change with those.
+        self.generations = calendar_generations(self.offering_ids())
+        self.dashboard_generation = _dashboard_generation()
+
+    def offering_ids(self):
+        return [m.offering_id for m in self.memberships]
+
+    def is_current(self, userid):
+        return self.userid == userid and self.date == datetime.date.today() \
+            and self.dashboard_generation == _dashboard_generation() \
+            and calendar_generations(self.offering_ids()) == self.generations
+
+    @classmethod
+    def for_userid(cls, userid):
+        person_id = Person.objects.filter(userid=userid).values_list('id', flat=True).first()
+        if person_id is None:
+            return cls(userid)
+
+        key = dashboard_summary_key(person_id)
+        summary = cache.get(key)
+        if summary is None or not summary.is_current(userid):
+            summary = cls(userid)
+            cache.set(key, summary, DASHBOARD_SUMMARY_TIMEOUT)
+        return summary
+
+    def context(self):
+        """
+        The template context for dashboard/index.html that comes from this summary.
+        """
+        return {
+            'memberships': self.memberships,
+            'staff_memberships': [m for m in self.memberships if m.role in ['INST', 'TA', 'APPR']], # for docs link
+            'is_instructor': any(m.role == 'INST' for m in self.memberships), # For TUGs link
+            'roles': self.roles,
+            'is_grad': self.is_grad,
+            'has_grads': self.has_grads,
+            'has_ras': self.has_ras,
+            'has_ra_requests': self.has_ra_requests,
+            'excluded': self.excluded,
+            'form_groups': self.form_groups,
+            'cmpt_taadmn': self.cmpt_taadmn,
+            'has_reports': self.has_reports,
+        }
+
+
+def _expire_dashboard_summary(person_field):
+    def expire(instance, **kwargs):
+        person_id = getattr(instance, person_field)
+        if person_id:
+            cache.delete(dashboard_summary_key(person_id))
+    return expire
+
+# the models (and the field referring to the affected Person) the dashboard summary is built from
+DASHBOARD_SUMMARY_SOURCES = [
+    ('coredata.Member', 'person_id'),
+    ('coredata.Role', 'person_id'),
+    ('grad.GradStudent', 'person_id'),
+    ('grad.Supervisor', 'supervisor_id'),
+    ('onlineforms.FormGroupMember', 'person_id'),
+    ('ra.RAAppointment', 'hiring_faculty_id'),
+    ('ra.RARequest', 'supervisor_id'),
+    ('ra.RARequest', 'author_id'),
+    ('reports.AccessRule', 'person_id'),
+]
+for sender, person_field in DASHBOARD_SUMMARY_SOURCES:
+    receiver = _expire_dashboard_summary(person_field)
+    for signal in [models.signals.post_save, models.signals.post_delete]:
+        signal.connect(receiver, sender=sender, weak=False)
+
+def _expire_all_dashboard_summaries(instance, **kwargs):
+    cache.set(DASHBOARD_GENERATION_KEY, max(int(time.time() * 1000), _dashboard_generation() + 1), None)
+
+models.signals.post_save.connect(_expire_all_dashboard_summaries, sender='coredata.Semester')
+
+
 def _sig_upload_to(instance, filename):
     """
     path to upload case attachment
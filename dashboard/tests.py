@@ -1,6 +1,6 @@
 from coredata.tests import create_offering
 from coredata.models import Person, Member, CourseOffering, Role, Semester
-from dashboard.models import UserConfig, NewsItem
+from dashboard.models import UserConfig, NewsItem, new_feed_token
 from courselib.testing import TEST_COURSE_SLUG, Client, validate_content, create_test_offering, test_views, \
     freshen_roles
 from django.test import TestCase
@@ -8,7 +8,7 @@ from django.urls import reverse
 from django.core.management import call_command
 from haystack.query import SearchQuerySet
 from pages.models import Page, PageVersion
-import re, datetime
+import re, datetime, json
 
 
 class DashboardTest(TestCase):
@@ -35,6 +35,37 @@ class DashboardTest(TestCase):
 
         validate_content(self, response.content, "index page")
 
+    def test_front_page_summary(self):
+        from dashboard.models import DashboardSummary
+        s = CourseOffering.objects.get(slug=TEST_COURSE_SLUG).semester
+        today = datetime.date.today()
+        s.start = today - datetime.timedelta(days=100)
+        s.end = today + datetime.timedelta(days=100)
+        s.save()
+        person = Member.objects.filter(offering__slug=TEST_COURSE_SLUG, role="STUD")[0].person
+        Role.objects.filter(person=person).delete()
+
+        summary = DashboardSummary.for_userid(person.userid)
+        self.assertIn(TEST_COURSE_SLUG, [m.offering.slug for m in summary.memberships])
+        self.assertEqual(summary.roles, set())
+
+        # warm: one query to find the person
+        with self.assertNumQueries(1):
+            summary = DashboardSummary.for_userid(person.userid)
+            self.assertEqual(summary.roles, set())
+
+        # changes to the underlying data are noticed
+        unit = CourseOffering.objects.get(slug=TEST_COURSE_SLUG).owner
+        Role(person=person, role='ADVS', unit=unit, expiry=today + datetime.timedelta(days=30)).save()
+        self.assertEqual(DashboardSummary.for_userid(person.userid).roles, {'ADVS'})
+        Member.objects.filter(person=person, offering__slug=TEST_COURSE_SLUG).update(role='DROP')
+        summary = DashboardSummary.for_userid(person.userid) # signal-less update: still cached
+        self.assertIn(TEST_COURSE_SLUG, [m.offering.slug for m in summary.memberships])
+        m = Member.objects.get(person=person, offering__slug=TEST_COURSE_SLUG)
+        m.save()
+        summary = DashboardSummary.for_userid(person.userid)
+        self.assertNotIn(TEST_COURSE_SLUG, [m.offering.slug for m in summary.memberships])
+
 
     def test_course_page(self):
         """
@@ -320,6 +351,106 @@ class DatetimeTest(TestCase):
         test_views(self, c, '', ['dashboard:index', 'news:news_list'], {})
 
 
+class NewsItemTest(TestCase):
+    def setUp(self):
+        self.offering = create_test_offering()
+        self.students = []
+        for i in range(10):
+            p = Person(first_name='Student', last_name=str(i), emplid=20000100 + i, userid='stud%i' % (i,))
+            p.save()
+            Member(offering=self.offering, person=p, role='STUD').save()
+            self.students.append(p)
+
+    def test_for_members(self):
+        from django.core import mail
+        o = self.offering
+        instr = Member.objects.get(offering=o, role='INST').person
+        UserConfig(user=self.students[0], key='newsitems', value={'email': False}).save()
+        UserConfig(user=self.students[1], key='newsitems', value={'email': True}).save()
+        Member(offering=o, person=self.students[2], role='DROP').save()
+
+        mail.outbox = []
+        with self.assertNumQueries(3): # members, bulk insert, preferences
+            NewsItem.for_members(member_kwargs={'offering': o}, newsitem_kwargs={
+                'author': instr, 'course': o, 'source_app': 'dashboard', 'title': 'Hello',
+                'content': 'Some **content**', 'url': '', 'markup': 'markdown'})
+
+        # the DROP entry is ignored: instructor, original student, and the 10 new students get the item
+        self.assertEqual(NewsItem.objects.filter(course=o, title='Hello').count(), 12)
+        recipients = sorted(m.to[0] for m in mail.outbox)
+        self.assertEqual(len(recipients), 11)
+        self.assertNotIn(self.students[0].full_email(), recipients)
+        self.assertIn(self.students[1].full_email(), recipients)
+        self.assertIn('<strong>content</strong>', mail.outbox[0].alternatives[0][0])
+        self.assertEqual(mail.outbox[0].subject, '%s: Hello' % (o.name(),))
+
+
+class CalendarTest(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        from coredata.models import MeetingTime
+        cache.clear()
+        self.offering = o = create_test_offering()
+        today = datetime.date.today()
+        o.semester.start = today - datetime.timedelta(days=30)
+        o.semester.end = today + datetime.timedelta(days=60)
+        o.semester.save()
+        MeetingTime(offering=o, weekday=today.weekday(), start_time=datetime.time(10, 30), end_time=datetime.time(11, 20),
+                    start_day=o.semester.start, end_day=o.semester.end, room='AQ 3150', meeting_type='LEC').save()
+        MeetingTime(offering=o, weekday=today.weekday(), start_time=datetime.time(14, 30), end_time=datetime.time(15, 20),
+                    start_day=o.semester.start, end_day=o.semester.end, room='AQ 5005', meeting_type='LAB',
+                    labtut_section='D101').save()
+        self.student = Member.objects.get(offering=o, role='STUD').person
+        self.token = new_feed_token()
+        UserConfig(user=self.student, key='calendar-config', value={'token': self.token}).save()
+
+    def test_ical(self):
+        from grades.models import NumericActivity
+        o = self.offering
+        url = reverse('calendar:calendar_ical', kwargs={'token': self.token, 'userid': self.student.userid})
+        c = Client()
+        response = c.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'LOCATION:%s AQ 3150' % (o.get_campus_display(),))
+        self.assertNotContains(response, 'AQ 5005') # not the student's lab section
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+
+        # an unchanged feed: 304, from the cache alone (the only query is the request log entry)
+        with self.assertNumQueries(1):
+            response = c.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+        with self.assertNumQueries(1):
+            response = c.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEqual(response.status_code, 304)
+        with self.assertNumQueries(1):
+            response = c.get(url)
+            self.assertEqual(response.status_code, 200)
+
+        # changes to the offering's activities change the feed
+        NumericActivity(offering=o, name='Assignment 1', short_name='A1', max_grade=10, position=1, status='RLS',
+                        due_date=datetime.datetime.now() + datetime.timedelta(days=7)).save()
+        response = c.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertContains(response, 'SUMMARY:%s: Assignment 1 due' % (o.name(),))
+
+        # the same events for the calendar page's AJAX data
+        c.login_user(self.student.userid)
+        today = datetime.date.today()
+        response = c.get(reverse('calendar:calendar_data'), {'start': (today - datetime.timedelta(days=1)).isoformat(),
+                                                             'end': (today + datetime.timedelta(days=8)).isoformat()})
+        events = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(sorted(e['category'] for e in events), ['DUE', 'LEC', 'LEC'])
+
+        # ... as do changes to the token.
+        uc = UserConfig.objects.get(user=self.student, key='calendar-config')
+        uc.value = {'token': new_feed_token()}
+        uc.save()
+        response = c.get(url)
+        self.assertEqual(response.status_code, 404)
+
+
 class FulltextTest(TestCase):
     """
     Tests of the full-text indexing and searching.
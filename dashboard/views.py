@@ -2,10 +2,13 @@ from django.shortcuts import render, get_object_or_404
 from django.http import HttpResponse, HttpResponseRedirect, HttpResponsePermanentRedirect, Http404, HttpResponseForbidden
 from django.urls import reverse
 from django.contrib.auth.decorators import login_required
-from django.db.models import Count, Q
+from django.db.models import Count
 from django.template import TemplateDoesNotExist
 from django.views.decorators.gzip import gzip_page
 from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 from django.contrib import messages
 from coredata.models import Member, CourseOffering, Person, Role, Semester, MeetingTime, Holiday
 from grades.models import Activity, NumericActivity
@@ -14,16 +17,13 @@ from courselib.auth import requires_course_staff_by_slug, NotFoundResponse, \
     has_role, requires_global_role
 from courselib.auth import get_person
 from courselib.branding import product_name
-from dashboard.models import NewsItem, UserConfig, Signature, new_feed_token
+from dashboard.models import NewsItem, UserConfig, Signature, new_feed_token, calendar_generations, calendar_feed_key, \
+    DashboardSummary
 from dashboard.forms import FeedSetupForm, NewsConfigForm, SignatureForm, PhotoAgreementForm
-from grad.models import GradStudent, Supervisor, STATUS_ACTIVE
 from discuss.models import DiscussionTopic
-from onlineforms.models import FormGroup
 from pages.models import Page, ACL_ROLES
-from ra.models import RAAppointment, RARequest
-from reports.models import AccessRule
 from log.models import LogEntry
-import datetime, json, urllib.parse
+import datetime, json, urllib.parse, hashlib
 from courselib.auth import requires_role
 from icalendar import Calendar, Event
 from haystack.query import SearchQuerySet
@@ -38,35 +38,8 @@ from urllib.error import HTTPError
 @login_required
 def index(request):
     userid = request.user.username
-    memberships, excluded = Member.get_memberships(userid)
-    staff_memberships = [m for m in memberships if m.role in ['INST', 'TA', 'APPR']] # for docs link
-    is_instructor = len([m for m in memberships if m.role == 'INST']) > 0  # For TUGs link
-    news_list = _get_news_list(userid, 5)
-    roles = Role.all_roles(userid)
-    is_grad = GradStudent.objects.filter(person__userid=userid, current_status__in=STATUS_ACTIVE).exists()
-    has_grads = Supervisor.objects.filter(supervisor__userid=userid, supervisor_type__in=['SEN','COM','COS'], removed=False).exists()
-    form_groups = FormGroup.objects.filter(members__userid=request.user.username).exists()
-    has_ras = RAAppointment.objects.filter(hiring_faculty__userid=request.user.username, deleted=False).exists()
-    has_ra_requests = RARequest.objects.filter(Q(supervisor__userid=request.user.username) | Q(author__userid=request.user.username), deleted=False, draft=False).exists()
-    has_reports = AccessRule.objects.filter(person__userid=request.user.username).exists()
-
-    # Only CMPT admins should see the one different TA module.  They can now also see the other module as we hope to
-    # transition them over.
-    cmpt_taadmn = Role.objects_fresh.filter(person__userid=userid, role='TAAD', unit__label='CMPT').exists()
-
-    context = {'memberships': memberships,
-               'staff_memberships': staff_memberships,
-               'news_list': news_list,
-               'roles': roles,
-               'is_grad':is_grad,
-               'has_grads': has_grads,
-               'has_ras': has_ras,
-               'has_ra_requests': has_ra_requests,
-               'excluded': excluded,
-               'form_groups': form_groups,
-               'cmpt_taadmn': cmpt_taadmn,
-               'is_instructor': is_instructor,
-               'has_reports': has_reports}
+    context = DashboardSummary.for_userid(userid).context()
+    context['news_list'] = _get_news_list(userid, 5)
     return render(request, "dashboard/index.html", context)
 
 @login_required
@@ -308,7 +281,8 @@ def _offerings_calendar_data(offerings, labsecs, start, end, local_tz, dt_string
     """
     Get calendar data for this set of offerings and lab sections.
     
-    Used both in _calendar_event_data and by the course browser (coredata.views.browse_courses_info)
+    Used by the course browser (coredata.views.browse_courses_info). The dashboard calendars use the cached
+    per-offering events from _offering_calendar_events instead.
     """
 
     # holidays and cancellations
@@ -381,52 +355,158 @@ def _offerings_calendar_data(offerings, labsecs, start, end, local_tz, dt_string
 
 
 
-def _calendar_event_data(user, start, end, local_tz, dt_string, colour=False,
-        due_before=datetime.timedelta(minutes=1), due_after=datetime.timedelta(minutes=0)):
+CALENDAR_EVENTS_TIMEOUT = 7*24*3600 # cached events are expired by generation: this just lets unused ones go
+CALENDAR_FEED_TIMEOUT = 3600 # membership changes by the (signal-less) bulk import show up in feeds within this time
+
+def _holiday_calendar_events():
     """
-    Data needed to render either calendar AJAX or iCalendar.  Yields series of event dictionaries.
+    Events for all holidays (cached until a Holiday changes).
+    """
+    gen = calendar_generations([None])[None]
+    key = 'calendar-holidays-%i-%s' % (gen, ICAL_SEQUENCE)
+    events = cache.get(key)
+    if events is not None:
+        return events
+
+    events = []
+    for h in Holiday.objects.all():
+        events.append({
+            'id': "holiday-" + str(h.id) + "-" + h.date.strftime("%Y%m%d") + "-" + ICAL_SEQUENCE + "@courses.cs.sfu.ca",
+            'title': "%s (%s)" % (h.description, h.get_holiday_type_display()),
+            'start': h.date,
+            'end': h.date,
+            'allDay': True,
+            'category': 'HOLIDAY',
+            'color': _holiday_colour(h),
+            })
+    cache.set(key, events, CALENDAR_EVENTS_TIMEOUT)
+    return events
+
+
+def _build_offering_calendar_events(offering_ids, local_tz):
+    """
+    Build the meeting time and due date events for these offerings, for all time. Returns dict of offering_id -> list.
+    """
+    cancellations = set(Holiday.objects.filter(holiday_type__in=['FULL', 'CLAS']).values_list('date', flat=True))
+    events = {oid: [] for oid in offering_ids}
+
+    for mt in MeetingTime.objects.filter(offering_id__in=offering_ids).select_related('offering'):
+        for date in _weekday_range(mt.start_day, mt.end_day, mt.weekday): # for every day the class happens...
+            if date in cancellations:
+                continue
+            st = local_tz.localize(datetime.datetime.combine(date, mt.start_time))
+            en = local_tz.localize(datetime.datetime.combine(date, mt.end_time))
+            events[mt.offering_id].append({
+                'id': mt.offering.slug.replace("-","") + "-" + str(mt.id) + "-" + st.strftime("%Y%m%dT%H%M%S") + "-" + ICAL_SEQUENCE + "@courses.cs.sfu.ca",
+                'title': mt.offering.name() + " " + mt.get_meeting_type_display(),
+                'start': st,
+                'end': en,
+                'location': mt.offering.get_campus_display() + " " + mt.room,
+                'allDay': False,
+                'url': urllib.parse.urljoin(settings.BASE_ABS_URL, _meeting_url(mt)),
+                'category': mt.meeting_type,
+                'color': _meeting_colour(mt),
+                'labtut_section': mt.labtut_section,
+                })
+
+    activities = Activity.objects.filter(offering_id__in=offering_ids, deleted=False, due_date__isnull=False) \
+        .select_related('offering')
+    for a in activities:
+        events[a.offering_id].append({
+            'id': a.offering.slug.replace("-","") + "-" + str(a.id) + "-" + a.slug.replace("-","") + "-" + a.due_date.strftime("%Y%m%dT%H%M%S") + "-" + ICAL_SEQUENCE + "@courses.cs.sfu.ca",
+            'title': '%s: %s due' % (a.offering.name(), a.name),
+            'due': local_tz.localize(a.due_date),
+            'allDay': False,
+            'url': urllib.parse.urljoin(settings.BASE_ABS_URL, _activity_url(a)),
+            'category': 'DUE',
+            'color': _activity_colour(a),
+            })
+
+    return events
+
+
+def _offering_calendar_events(offering_ids, local_tz, generations=None):
+    """
+    The events for these offerings, as a dict of offering_id -> list of events, from the cache where possible.
+
+    Each offering's events are cached under its calendar generation (and the holidays' generation, since they cancel
+    classes), so they are rebuilt only after a MeetingTime, Activity, Holiday or the offering itself changes.
+    """
+    if generations is None:
+        generations = calendar_generations(list(offering_ids) + [None])
+    keys = {oid: 'calendar-events-%i-%i-%i-%s' % (oid, generations[oid], generations[None], ICAL_SEQUENCE)
+            for oid in offering_ids}
+    found = cache.get_many(list(keys.values()))
+
+    events = {oid: found[key] for oid, key in keys.items() if key in found}
+    missing = [oid for oid in offering_ids if oid not in events]
+    if missing:
+        built = _build_offering_calendar_events(missing, local_tz)
+        cache.set_many({keys[oid]: built[oid] for oid in missing}, CALENDAR_EVENTS_TIMEOUT)
+        events.update(built)
+    return events
+
+
+def _calendar_sections(user, start, end):
+    """
+    The offerings whose events should be in the user's calendar between start and end: dict of offering_id -> the
+    user's lab/tutorial section.
     """
     memberships = Member.objects.filter(person=user, offering__graded=True).exclude(role="DROP").exclude(role="APPR")\
         .exclude(offering__component="CAN").filter(offering__semester__start__lte=end,
                                                    offering__semester__end__gte=start-datetime.timedelta(days=30))
             # start - 30 days to make sure we catch exam/end of semester events
-    classes = set((m.offering for m in memberships))
-    labsecs = dict(((m.offering_id, m.labtut_section) for m in memberships))
+    return dict(memberships.values_list('offering_id', 'labtut_section'))
 
-    # get all events from _offerings_calendar_data
-    for res in _offerings_calendar_data(classes, labsecs, start, end, local_tz, dt_string, colour):
-        yield res
 
-    # add every assignment with a due datetime
-    for m in memberships:
-        for a in m.offering.activity_set.filter(deleted=False):
-            if not a.due_date:
+def _calendar_events(sections, start, end, local_tz, dt_string, colour=False,
+        due_before=datetime.timedelta(minutes=1), due_after=datetime.timedelta(minutes=0), generations=None):
+    """
+    Select the events for these sections (as returned by _calendar_sections) between start and end from the cached
+    holiday and offering events. Yields series of event dictionaries.
+    """
+    def output(e, st, en):
+        data = {k: v for k, v in e.items() if k not in ('due', 'labtut_section', 'color')}
+        if dt_string:
+            st = st.isoformat()
+            en = en.isoformat()
+        data['start'] = st
+        data['end'] = en
+        if colour:
+            data['color'] = e['color']
+        return data
+
+    for e in _holiday_calendar_events():
+        if start.date() <= e['start'] <= end.date():
+            yield output(e, e['start'], e['end'])
+
+    offering_events = _offering_calendar_events(sections.keys(), local_tz, generations=generations)
+    for offering_id, labsec in sections.items():
+        for e in offering_events[offering_id]:
+            if 'due' in e:
+                st = e['due'] - due_before
+                en = e['due'] + due_after
+            elif e['labtut_section'] in [None, labsec]:
+                # only output whole-course events and this student's lab section.
+                st = e['start']
+                en = e['end']
+            else:
                 continue
-            st = local_tz.localize(a.due_date - due_before)
-            en = end = local_tz.localize(a.due_date + due_after)
+
             if en < start or st > end:
                 continue
-            
-            ident = a.offering.slug.replace("-","") + "-" + str(a.id) + "-" + a.slug.replace("-","") + "-" + a.due_date.strftime("%Y%m%dT%H%M%S") + "-" + ICAL_SEQUENCE + "@courses.cs.sfu.ca"
-            title = '%s: %s due' % (a.offering.name(), a.name)
-            if dt_string:
-                st = st.isoformat()
-                en = en.isoformat()
-            
-            e = {
-                'id': ident,
-                'title': title,
-                'start': st,
-                'end': en,
-                'allDay': False,
-                #'className': 'ev-due',
-                'url': urllib.parse.urljoin(settings.BASE_ABS_URL, _activity_url(a)),
-                'category': 'DUE',
-                }
-            if colour:
-                e['color'] = _activity_colour(a)
-            yield e
-    
+            yield output(e, st, en)
+
+
+def _calendar_event_data(user, start, end, local_tz, dt_string, colour=False,
+        due_before=datetime.timedelta(minutes=1), due_after=datetime.timedelta(minutes=0)):
+    """
+    Data needed to render either calendar AJAX or iCalendar.  Yields series of event dictionaries.
+    """
+    sections = _calendar_sections(user, start, end)
+    return _calendar_events(sections, start, end, local_tz, dt_string, colour=colour, due_before=due_before,
+                            due_after=due_after)
+
 
 def _ical_datetime(utc, dt):
     if isinstance(dt, datetime.datetime):
@@ -438,29 +518,51 @@ def _ical_datetime(utc, dt):
 def calendar_ical(request, token, userid):
     """
     Return an iCalendar for this user, authenticated by the token in the URL
+
+    Calendar clients poll this frequently, so it's assembled from cached data, and answered with a 304 if the
+    client's copy (by ETag or Last-Modified) is still current.
     """
     local_tz = pytz.timezone(settings.TIME_ZONE)
     utc = pytz.utc
-    user = get_object_or_404(Person, userid=userid)
-    
+    now = datetime.datetime.now()
+    start = local_tz.localize(now - datetime.timedelta(days=180))
+    end = local_tz.localize(now + datetime.timedelta(days=365))
+
+    key = calendar_feed_key(userid)
+    feed = cache.get(key)
+    if feed is None:
+        user = get_object_or_404(Person, userid=userid)
+        config = _get_calendar_config(user)
+        feed = {'token': config.get('token'), 'sections': _calendar_sections(user, start, end)}
+        cache.set(key, feed, CALENDAR_FEED_TIMEOUT)
+
     # make sure the token in the URL (32 hex characters) matches the token stored in the DB
-    config = _get_calendar_config(user)
-    if 'token' not in config or config['token'] != token:
+    if not feed['token'] or feed['token'] != token:
         # no token set or wrong token provided
         return NotFoundResponse(request)
     #else:
         # authenticated
 
-    now = datetime.datetime.now()
-    start = local_tz.localize(now - datetime.timedelta(days=180))
-    end = local_tz.localize(now + datetime.timedelta(days=365))
-    
+    # the feed changes if the sections or anything in them change, or the date range moves (daily)
+    sections = feed['sections']
+    generations = calendar_generations(list(sections.keys()) + [None])
+    today = now.date()
+    etag = hashlib.sha1(repr((ICAL_SEQUENCE, userid, token, today, sorted(sections.items()),
+                              [generations[oid] for oid in sorted(sections.keys())], generations[None])
+                             ).encode('utf-8')).hexdigest()
+    etag = quote_etag(etag)
+    last_modified = int(max(max(generations.values()) / 1000,
+                            datetime.datetime.combine(today, datetime.time.min).timestamp()))
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if not_modified is not None:
+        return not_modified
+
     cal = Calendar()
     cal.add('version', '2.0')
     cal.add('prodid', '-//SFU CourSys//courses.cs.sfu.ca//')
     cal.add('X-PUBLISHED-TTL', 'PT1D')
     
-    for data in _calendar_event_data(user, start, end, local_tz, dt_string=False):
+    for data in _calendar_events(sections, start, end, local_tz, dt_string=False, generations=generations):
         e = Event()
         e['uid'] = str(data['id'])
         e.add('summary', data['title'])
@@ -486,6 +588,8 @@ def calendar_ical(request, token, userid):
         cal.add_component(e)
 
     resp = HttpResponse(cal.to_ical(), content_type="text/calendar")
+    resp['ETag'] = etag
+    resp['Last-Modified'] = http_date(last_modified)
     return resp
 
 
@@ -512,6 +616,10 @@ def calendar_data(request):
 
     user = get_object_or_404(Person, userid=request.user.username)
     local_tz = pytz.timezone(settings.TIME_ZONE)
+    if st.tzinfo is None:
+        st = local_tz.localize(st)
+    if en.tzinfo is None:
+        en = local_tz.localize(en)
     start = st - datetime.timedelta(days=1)
     end = en + datetime.timedelta(days=1)
 
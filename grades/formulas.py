@@ -10,10 +10,14 @@
 #   act_dict = activities_dictionary(activities)        
 # then pass it into the evaluator along with a Member object for the student:
 #   result = eval_parse(parsed_expr, act_dict, member, visible)
+# or, to evaluate for many students at once (with a single query for all of the grades):
+#   results = eval_parse_all(parsed_expr, activity, act_dict, members, visible)
 
 from pyparsing import ParseException
+import copy
+import functools
 import itertools
-from grades.models import NumericActivity
+from grades.models import NumericActivity, NumericGrade
 
 class EvalException(Exception):
     pass
@@ -113,6 +117,19 @@ def create_parser():
 
 parser = create_parser()
 
+# number of distinct formulas whose parse trees are kept in each process
+PARSE_CACHE_SIZE = 1000
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_formula(expr):
+    """
+    Run the (slow) grammar on the formula text.
+
+    The result depends only on the text, so it's cached and shared by every course using the formula. It must not be
+    modified: parse() works on a copy.
+    """
+    return parser.parseString(expr)[0]
+
 def fix_used_acts(parsed, course, activity):
     """
     Fix the list of used activities: True is a flag for "all other activities that contribute to final percent"
@@ -130,7 +147,7 @@ def parse(expr, course, activity):
     """
     Parse expression and return parse tree.
     """
-    parsed = parser.parseString(expr)[0]
+    parsed = copy.deepcopy(_parse_formula(expr))
     fix_used_acts(parsed, course, activity)
     return parsed
 
@@ -280,6 +297,172 @@ def eval_parse(tree, activity, act_dict, member, visible):
         raise EvalException("Unknown element in parse tree: %s" % (tree,))
     
 
+def grade_matrix(acts, member_ids=None):
+    """
+    Fetch all grades for the given NumericActivities with a single query (only for these members, if given).
+
+    Returns a dictionary mapping (activity.id, member.id) to the grade value as visible_grade would return it (i.e.
+    0.0 for "no grade"). Missing entries should be treated as 0.0.
+    """
+    grades = NumericGrade.objects.filter(activity_id__in=[a.id for a in acts])
+    if member_ids is not None:
+        grades = grades.filter(member_id__in=member_ids)
+    grades = grades.values_list('activity_id', 'member_id', 'value', 'flag')
+    return dict(
+        ((activity_id, member_id), 0.0 if flag == 'NOGR' else float(value))
+        for activity_id, member_id, value, flag in grades)
+
+
+def compile_parse(tree, activity, act_dict, visible):
+    """
+    Compile the parse tree into a function that evaluates the formula for many students at once.
+
+    The returned function takes a list of member ids and a grade matrix (as returned by grade_matrix) and returns the
+    list of results, in the same order as the member ids. Each operation is done column-wise (over all students),
+    but with exactly the arithmetic eval_parse does, so the results are identical to calling it for each student.
+
+    Throws EvalException if there's a problem with the expression tree (possibly only when the function is called).
+
+    Throws KeyError for unknown column.
+    """
+    calculating_leak = activity.calculation_leak()
+
+    def constant(value):
+        return lambda member_ids, grades: [value] * len(member_ids)
+
+    def grade_column(act):
+        if not calculating_leak and visible and act.status != 'RLS':
+            return constant(0.0)
+        return lambda member_ids, grades: [grades.get((act.id, m), 0.0) for m in member_ids]
+
+    def final_column(act):
+        grade = grade_column(act)
+        max_grade = float(act.max_grade)
+        percent = float(act.percent)
+        return lambda member_ids, grades: [g/max_grade * percent for g in grade(member_ids, grades)]
+
+    t = tree[0]
+    if t == 'sign' and tree[2] == '+':
+        return compile_parse(tree[3], activity, act_dict, visible)
+    elif t == 'sign' and tree[2] == '-':
+        operand = compile_parse(tree[3], activity, act_dict, visible)
+        return lambda member_ids, grades: [-v for v in operand(member_ids, grades)]
+    elif t == 'col':
+        act = act_dict[tree[2]]
+        part = tree[3]
+        if part=="val":
+            return grade_column(act)
+        elif part=="max":
+            return constant(float(act.max_grade))
+        elif part=="per":
+            if act.percent:
+                return constant(float(act.percent))
+            else:
+                return constant(0.0)
+        elif part=="fin":
+            if act.percent and float(act.max_grade):
+                return final_column(act)
+            else:
+                return constant(0.0)
+        else:
+            raise EvalException("Unknown column modifier in parse tree: %s" % (part,))
+
+    elif t == 'num':
+        return constant(tree[2])
+    elif t == 'expr':
+        first = compile_parse(tree[2], activity, act_dict, visible)
+        rest = [(operator, compile_parse(operand, activity, act_dict, visible))
+                for operator, operand in zip(tree[3::2], tree[4::2])]
+        for operator, _ in rest:
+            if operator not in ["+", "-", "*", "/"]:
+                raise EvalException("Unknown operator in parse tree: %s"%(operator,))
+
+        def evaluate(member_ids, grades):
+            vals = first(member_ids, grades)
+            for operator, operand in rest:
+                operands = operand(member_ids, grades)
+                if operator == "+":
+                    vals = [val + op for val, op in zip(vals, operands)]
+                elif operator == "-":
+                    vals = [val - op for val, op in zip(vals, operands)]
+                elif operator == "*":
+                    vals = [val * op for val, op in zip(vals, operands)]
+                elif operator == "/":
+                    vals = [0.0 if op==0 else val / op for val, op in zip(vals, operands)]
+            return vals
+        return evaluate
+
+    elif t == 'func':
+        func = tree[2]
+        args = [compile_parse(t, activity, act_dict, visible) for t in tree[3:]]
+
+        def rows(member_ids, grades):
+            # the arguments' values, one tuple per student
+            return zip(*(arg(member_ids, grades) for arg in args))
+
+        if func == 'SUM':
+            return lambda member_ids, grades: [sum(row) for row in rows(member_ids, grades)]
+        elif func == 'MAX':
+            return lambda member_ids, grades: [max(row) for row in rows(member_ids, grades)]
+        elif func == 'MIN':
+            return lambda member_ids, grades: [min(row) for row in rows(member_ids, grades)]
+        elif func == 'COUNT':
+            return lambda member_ids, grades: [sum(1 for g in row if g > 0.0) for row in rows(member_ids, grades)]
+        elif func == 'AVG':
+            if len(tree) == 3:
+                return constant(0)
+            return lambda member_ids, grades: [sum(row) / (len(tree)-3) for row in rows(member_ids, grades)]
+        elif func == 'BEST':
+            def evaluate(member_ids, grades):
+                results = []
+                for row in rows(member_ids, grades):
+                    # round first argument to an int: it's the number of best items to pick
+                    n = int(round(row[0]) + 0.1)
+                    if n < 1:
+                        raise EvalException('Bad number of "best" selected, %i.'%(n,))
+                    if n > len(tree)-4:
+                        raise EvalException("Not enough arguments to choose %i best."%(n,))
+                    marks = sorted(row[1:])
+                    results.append(sum(marks[-n:]))
+                return results
+            return evaluate
+        else:
+            raise EvalException("Unknown function in parse tree: %s"%(func,))
+    elif t == 'flag':
+        flag = tree[2]
+        if flag == 'activitytotal':
+            # total [activity.final] for all activities
+            fix_used_acts(tree, activity.offering, activity)
+            acts = [act_dict[label] for label in tree[1]]
+            finals = [final_column(act) for act in acts if float(act.max_grade)]
+
+            def evaluate(member_ids, grades):
+                totals = [0.0] * len(member_ids)
+                for final in finals:
+                    totals = [total + f for total, f in zip(totals, final(member_ids, grades))]
+                return totals
+            return evaluate
+        else:
+            raise EvalException("Unknown flag in parse tree: %s" % (flag,))
+    else:
+        raise EvalException("Unknown element in parse tree: %s" % (tree,))
+
+
+def eval_parse_all(tree, activity, act_dict, members, visible):
+    """
+    Evaluate an expression for all of the given members at once, fetching all of the grades it needs with a single
+    query. Results are identical to calling eval_parse for each member.
+
+    Returns a dictionary of member.id -> result.
+
+    Throws EvalException/KeyError as eval_parse does.
+    """
+    evaluate = compile_parse(tree, activity, act_dict, visible)
+    grades = grade_matrix(set(act_dict[label] for label in cols_used(tree)))
+    member_ids = [m.id for m in members]
+    return dict(zip(member_ids, evaluate(member_ids, grades)))
+
+
 def create_display(tree, act_dict):
     if isinstance(tree, str):
         return str(tree)
@@ -0,0 +1,159 @@
+"""
+The whole gradebook for an offering (every student's grade on every activity), for the all-grades table, CSV and
+export.
+
+Grades are fetched with (at most) one query for numeric and one for letter grades, and cached per activity: the cache
+for an activity is cleared whenever one of its grades is saved.
+"""
+
+from django.core.cache import cache
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from coredata.models import Member
+from grades.models import all_activities_filter, NumericGrade, LetterGrade, FLAGS
+
+GRADEBOOK_CACHE_TIMEOUT = 3600
+
+
+def _activity_grades_key(activity_id):
+    return 'gradebook-activity-%i' % (activity_id,)
+
+
+def invalidate_activity_grades(activity_id):
+    """
+    Forget the cached grades for this activity: must be called whenever any of its grades change.
+    """
+    cache.delete(_activity_grades_key(activity_id))
+
+
+def _activity_grades(activities):
+    """
+    Grades for these activities: dictionary of activity.id -> {member.id: (grade, flag)}, where grade is the
+    numeric grade (as a string) or letter grade.
+    """
+    keys = dict((_activity_grades_key(a.id), a) for a in activities)
+    grades = dict((keys[k].id, g) for k, g in cache.get_many(list(keys.keys())).items())
+
+    missing = dict((a.id, {}) for a in activities if a.id not in grades)
+    numeric_ids = [a.id for a in activities if a.id in missing and a.is_numeric()]
+    letter_ids = [a.id for a in activities if a.id in missing and not a.is_numeric()]
+    if numeric_ids:
+        gs = NumericGrade.objects.filter(activity_id__in=numeric_ids).values_list('activity_id', 'member_id', 'value', 'flag')
+        for activity_id, member_id, value, flag in gs:
+            missing[activity_id][member_id] = (str(value), flag)
+    if letter_ids:
+        gs = LetterGrade.objects.filter(activity_id__in=letter_ids).values_list('activity_id', 'member_id', 'letter_grade', 'flag')
+        for activity_id, member_id, letter_grade, flag in gs:
+            missing[activity_id][member_id] = (letter_grade, flag)
+
+    if missing:
+        cache.set_many(dict((_activity_grades_key(activity_id), g) for activity_id, g in missing.items()),
+                       GRADEBOOK_CACHE_TIMEOUT)
+    grades.update(missing)
+    return grades
+
+
+class GradeCell(object):
+    """
+    One student's grade on one activity, with enough of the NumericGrade/LetterGrade interface for display.
+    """
+    __slots__ = ['activity', 'grade', 'flag', 'comment']
+
+    def __init__(self, activity, grade, flag):
+        self.activity = activity
+        self.grade = grade
+        self.flag = flag
+        self.comment = None
+
+    def get_flag_display(self):
+        return FLAGS[self.flag]
+
+    def display_staff_short(self):
+        if self.activity.is_numeric():
+            if self.flag == 'NOGR':
+                return ''
+            else:
+                return "%.1f" % (float(self.grade))
+        else:
+            if self.flag == 'NOGR':
+                return '\u2014'
+            else:
+                return "%s" % (self.grade)
+
+    def export_value(self):
+        "Value for the grades CSV"
+        if self.flag == 'NOGR':
+            return ''
+        return self.grade
+
+    def display_staff_html(self):
+        "HTML for the all-grades table"
+        gtext = escape(self.display_staff_short())
+
+        stext = ''
+        if self.flag not in ['GRAD', 'NOGR', 'CALC']:
+            stext = '(' + self.get_flag_display() + ')'
+
+        if self.comment:
+            ctext = escape(self.comment)
+            stext = '(' + self.get_flag_display() + ')'
+        else:
+            ctext = ''
+
+        if ctext and stext:
+            return mark_safe(gtext + '<span class="more"><span title="' + ctext + '"><img src="/media/icons/information.png" alt="[I]" /></span><br/>' + stext + '</span>')
+        elif stext:
+            return mark_safe(gtext + '<span class="more"><br/>' + stext + '</span>')
+        else:
+            return mark_safe(gtext)
+
+
+class GradebookMatrix(object):
+    """
+    Students (rows) by activities (columns): self.matrix[i][j] is the GradeCell for self.students[i] on
+    self.activities[j], or None if they have no grade.
+    """
+    def __init__(self, course, activities=None, students=None):
+        self.course = course
+        if activities is None:
+            activities = all_activities_filter(offering=course)
+        if students is None:
+            students = Member.objects.filter(offering=course, role="STUD").select_related('person', 'offering')
+        self.activities = list(activities)
+        self.students = list(students)
+
+        grades = _activity_grades(self.activities)
+        self.student_index = dict((s.id, i) for i, s in enumerate(self.students))
+        self.matrix = [[None] * len(self.activities) for _ in self.students]
+        for j, a in enumerate(self.activities):
+            for member_id, (grade, flag) in grades[a.id].items():
+                i = self.student_index.get(member_id)
+                if i is not None:
+                    self.matrix[i][j] = GradeCell(a, grade, flag)
+
+    def rows(self):
+        """
+        Iterate through (student, [GradeCell or None for each activity]).
+        """
+        return zip(self.students, self.matrix)
+
+    def load_comments(self):
+        """
+        Fill in the grades' comments (which aren't cached, since they can be large).
+        """
+        activity_index = dict((a.id, j) for j, a in enumerate(self.activities))
+        numeric_ids = [a.id for a in self.activities if a.is_numeric()]
+        letter_ids = [a.id for a in self.activities if not a.is_numeric()]
+        for GradeClass, ids in [(NumericGrade, numeric_ids), (LetterGrade, letter_ids)]:
+            if not ids:
+                continue
+            comments = GradeClass.objects.filter(activity_id__in=ids).exclude(comment__isnull=True).exclude(comment='') \
+                .values_list('activity_id', 'member_id', 'comment')
+            for activity_id, member_id, comment in comments:
+                i = self.student_index.get(member_id)
+                if i is None:
+                    continue
+                cell = self.matrix[i][activity_index[activity_id]]
+                if cell:
+                    cell.comment = comment
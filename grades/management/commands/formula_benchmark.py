@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from grades.models import CalNumericActivity
+from grades.formulas import parser, parse, _parse_formula
+from pyparsing import ParseException
+import time
+
+
+class Command(BaseCommand):
+    help = 'Time the formula grammar, uncached and cached, on formulas from real courses.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=500, help='number of formulas to take from the database')
+        parser.add_argument('--repeat', type=int, default=5, help='times to parse each formula')
+
+    def handle(self, *args, **options):
+        acts = list(CalNumericActivity.objects.filter(deleted=False).select_related('offering')
+                    .order_by('-id')[:options['count']])
+        formulas = []
+        for a in acts:
+            try:
+                parser.parseString(a.formula)
+            except ParseException:
+                continue
+            formulas.append(a)
+        if not formulas:
+            print("No formulas found.")
+            return
+
+        repeat = options['repeat']
+        start = time.time()
+        for _ in range(repeat):
+            for a in formulas:
+                parser.parseString(a.formula)
+        uncached = time.time() - start
+
+        _parse_formula.cache_clear()
+        start = time.time()
+        for _ in range(repeat):
+            for a in formulas:
+                parse(a.formula, a.offering, a)
+        cached = time.time() - start
+
+        n = len(formulas) * repeat
+        print("%i formulas (%i distinct), each parsed %i times" % (len(formulas), len(set(a.formula for a in formulas)), repeat))
+        print("grammar only: %.3f ms/formula" % (uncached / n * 1000))
+        print("cached parse: %.3f ms/formula (including [[activitytotal]] lookups)" % (cached / n * 1000))
+        print(_parse_formula.cache_info())
@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from coredata.models import Person, Member
+from grades.models import NumericActivity, NumericGrade
+from grades.utils import create_StudentActivityInfo_list
+import time
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Time create_StudentActivityInfo_list on made-up classes of increasing size. Nothing is left in the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,2000,5000', help='comma-separated class sizes to try')
+        parser.add_argument('--repeat', type=int, default=3, help='times to build each list')
+
+    def handle(self, *args, **options):
+        activity = NumericActivity.objects.filter(deleted=False).select_related('offering').first()
+        if not activity:
+            raise CommandError("Need at least one numeric activity in the database.")
+        sizes = [int(n) for n in options['sizes'].split(',')]
+        try:
+            with transaction.atomic():
+                self._run(activity, sizes, options['repeat'])
+                raise _Rollback()
+        except _Rollback:
+            pass
+
+    def _run(self, activity, sizes, repeat):
+        offering = activity.offering
+        Member.objects.filter(offering=offering, role='STUD').update(role='DROP')
+        NumericGrade.objects.filter(activity=activity).delete()
+
+        added = 0
+        for n in sorted(sizes):
+            people = [Person(emplid=900000000 + i, userid='bench%i' % (i), last_name='Bench', first_name=str(i))
+                      for i in range(added, n)]
+            Person.objects.bulk_create(people)
+            people = Person.objects.filter(emplid__in=[p.emplid for p in people])
+            members = Member.objects.bulk_create([Member(person=p, offering=offering, role='STUD', career='UGRD',
+                                                         added_reason='UNK') for p in people])
+            members = Member.objects.filter(offering=offering, role='STUD', person__in=people)
+            # grade about 90% of them, like a real class
+            NumericGrade.objects.bulk_create([NumericGrade(activity=activity, member=m, value=i % 20, flag='GRAD')
+                                              for i, m in enumerate(members) if i % 10])
+            added = n
+
+            start = time.time()
+            for _ in range(repeat):
+                infos = create_StudentActivityInfo_list(offering, activity)
+            elapsed = (time.time() - start) / repeat
+            assert len(infos) == n
+            print("%6i students: %.1f ms" % (n, elapsed * 1000))
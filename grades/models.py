@@ -1,7 +1,7 @@
 from django.db import models
 from autoslug import AutoSlugField
 from coredata.models import Member, CourseOffering, Person
-from dashboard.models import NewsItem
+from dashboard.models import NewsItem, expire_calendar
 from django.db import transaction
 from django.db.models import Count
 from django.urls import reverse
@@ -10,7 +10,7 @@ from datetime import datetime, timedelta, date
 from courselib.json_fields import JSONField
 from courselib.json_fields import getter_setter
 from courselib.slugs import make_slug
-import decimal, json
+import decimal, json, threading
 
 COMMENT_LENGTH = 5000
 
@@ -135,6 +135,11 @@ class Activity(models.Model):
         
         super(Activity, self).save(*args, **kwargs)
 
+        # formulas or activities may have changed: dependencies between calculated activities must be rebuilt
+        from grades.utils import invalidate_calculated_activity_graph, activity_grades_changed
+        invalidate_calculated_activity_graph(self.offering)
+        activity_grades_changed(self.id)
+
         if newsitem and old and self.status == 'RLS' and old != None and old.status != 'RLS':
             from grades.tasks import send_grade_released_news, create_grade_released_history
 
@@ -469,6 +474,24 @@ class CalLetterActivity(LetterActivity):
 # MUST have deepest subclasses first (i.e. nothing *after* a class is one of its subclasses)
 ACTIVITY_TYPES = [CalNumericActivity, NumericActivity, CalLetterActivity, LetterActivity]
 
+
+def connect_activity_signal(signal, receiver):
+    """
+    Connect the receiver to the signal for every kind of activity: model signals are sent with the concrete class as
+    sender, so connecting for Activity alone would miss most of them.
+    """
+    for ActivityType in [Activity] + ACTIVITY_TYPES:
+        signal.connect(receiver, sender=ActivityType)
+
+
+# signal for calendar cache invalidation: due dates are in the offering's calendar events
+def expire_activity_calendar(instance, **kwargs):
+    if instance.offering_id:
+        expire_calendar(instance.offering_id)
+
+connect_activity_signal(models.signals.post_save, expire_activity_calendar)
+connect_activity_signal(models.signals.post_delete, expire_activity_calendar)
+
 def all_activities_filter(offering, slug=None):
     """
     Return all activities as their most specific class.
@@ -503,6 +526,48 @@ def all_activities_filter(offering, slug=None):
     return activities
 
 
+def _grade_changed(grade):
+    """
+    Clear cached data that depends on this NumericGrade/LetterGrade's activity.
+    """
+    from grades.utils import activity_grades_changed
+    activity_grades_changed(grade.activity_id)
+
+
+def _member_changed(instance, **kwargs):
+    """
+    Clear cached summary stats for the offering: they count only students' grades.
+    """
+    from grades.utils import offering_students_changed
+    offering_students_changed(instance.offering_id)
+
+models.signals.post_save.connect(_member_changed, sender=Member)
+models.signals.post_delete.connect(_member_changed, sender=Member)
+
+
+# activity.id -> set of member.id whose dependent calculated grades need updating, collected per thread so all of the
+# grades saved in a transaction (e.g. a whole mark import) are recalculated by one task.
+_pending_recalculations = threading.local()
+
+def _recalculate_dependents(grade):
+    """
+    Update the calculated grades that depend on this (manually-entered) NumericGrade/LetterGrade, once it's committed.
+    """
+    if not hasattr(_pending_recalculations, 'members'):
+        _pending_recalculations.members = {}
+    activity_id = grade.activity_id
+    _pending_recalculations.members.setdefault(activity_id, set()).add(grade.member_id)
+    transaction.on_commit(lambda: _start_recalculation(activity_id))
+
+def _start_recalculation(activity_id):
+    # the first callback for the activity takes all of its members: the rest find nothing left to do. (After a rollback,
+    # members may be left here to be recalculated with the next commit, which is harmless.)
+    from grades.tasks import recalculate_dependent_grades
+    member_ids = _pending_recalculations.members.pop(activity_id, None)
+    if member_ids:
+        recalculate_dependent_grades(activity_id, sorted(member_ids))
+
+
 class NumericGrade(models.Model):
     """
     Individual numeric grade for a NumericActivity.
@@ -566,6 +631,7 @@ class NumericGrade(models.Model):
             self.value = 0
 
         super(NumericGrade, self).save()
+        _grade_changed(self)
 
         entered_by = get_entry_person(entered_by)
         if bool(mark) and not mark.id:
@@ -575,6 +641,7 @@ class NumericGrade(models.Model):
             gh = GradeHistory(activity=self.activity, member=self.member, entered_by=entered_by, activity_status=self.activity.status,
                               numeric_grade=self.value, grade_flag=self.flag, comment=self.comment, mark=mark, group=group)
             gh.save()
+            _recalculate_dependents(self)
         else:
             assert (self.flag == 'CALC') or (is_temporary and self.flag=='NOGR')
 
@@ -652,12 +719,14 @@ class LetterGrade(models.Model):
         newsitem controls the posting of a NewsItem for the student.
         """
         super(LetterGrade, self).save()
+        _grade_changed(self)
 
         entered_by = get_entry_person(entered_by)
         if entered_by:
             gh = GradeHistory(activity=self.activity, member=self.member, entered_by=entered_by, activity_status=self.activity.status,
                               letter_grade=self.letter_grade, grade_flag=self.flag, comment=self.comment, mark=None, group=group)
             gh.save()
+            _recalculate_dependents(self)
         else:
             assert self.flag == 'CALC'
 
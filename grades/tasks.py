@@ -1,5 +1,6 @@
 from courselib.celerytasks import task
 from django.conf import settings
+from coredata.models import Member
 from dashboard.models import NewsItem
 from grades.models import Activity, NumericGrade, LetterGrade, GradeHistory
 import itertools
@@ -43,10 +44,23 @@ def create_grade_released_history_task(activity_id, entered_by_id):
     _create_grade_released_history(activity_id, entered_by_id)
 
 
+def _recalculate_dependent_grades(activity_id, member_ids):
+    from grades.utils import recalculate_dependent_grades
+    activity = Activity.objects.select_related('offering').get(id=activity_id)
+    members = list(Member.objects.filter(id__in=member_ids).select_related('person'))
+    recalculate_dependent_grades(activity, members)
+
+@task(queue='fast')
+def recalculate_dependent_grades_task(activity_id, member_ids):
+    _recalculate_dependent_grades(activity_id, member_ids)
+
+
 # let these work with or without Celery
 if settings.USE_CELERY:
     send_grade_released_news = send_grade_released_news_task.delay
     create_grade_released_history = create_grade_released_history_task.delay
+    recalculate_dependent_grades = recalculate_dependent_grades_task.delay
 else:
     send_grade_released_news = _send_grade_released_news
     create_grade_released_history = _create_grade_released_history
+    recalculate_dependent_grades = _recalculate_dependent_grades
@@ -1,17 +1,23 @@
 # coding=utf-8
 
-from grades.formulas import parse, cols_used, eval_parse, EvalException, ParseException
+from grades.formulas import parse, cols_used, eval_parse, eval_parse_all, EvalException, ParseException
 from grades.models import Activity, NumericActivity, LetterActivity, CalNumericActivity, CalLetterActivity, \
     NumericGrade, LetterGrade, GradeHistory, all_activities_filter, ACTIVITY_STATUS, sorted_letters, \
     median_letters
-from grades.utils import activities_dictionary, generate_grade_range_stat
+from grades.gradebook import GradebookMatrix
+from grades.utils import activities_dictionary, generate_grade_range_stat, calculate_numeric_grade, \
+    generate_numeric_activity_stat, generate_letter_activity_stat, \
+    calculate_letter_grade, dependent_calculated_activities, create_StudentActivityInfo_list
 from coredata.models import Person, Member, CourseOffering, Unit
 from dashboard.models import UserConfig
 from submission.models import StudentSubmission
 from coredata.tests import create_offering
-import pickle, datetime, decimal, json
+import pickle, datetime, decimal, json, random, statistics, io, zipfile
+from unittest import mock
 
 from django.conf import settings
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
 from courselib.testing import *
 
 # TODO: test activity modifiers ([A1.max], [A1.percent], [A1.final])
@@ -80,12 +86,22 @@ class GradesTest(TestCase):
         self.assertEqual(tree, tree2)
         # check that it found the right list of columns used
         self.assertEqual(cols_used(tree), set(['A1', 'A2', 'Assignment #1']))
+
+        # cached parse trees are copies that are safe to modify
+        tree = parse("[[activitytotal]] + 1", c, ca)
+        self.assertEqual(cols_used(tree), set(['A1', 'A2', '\u00b6']))
+        cols_used(tree).add('Foo')
+        tree2 = parse("[[activitytotal]] + 1", c, ca)
+        self.assertEqual(cols_used(tree2), set(['A1', 'A2', '\u00b6']))
+        self.assertEqual(cols_used(parse("[[activitytotal]] + 1", c, None)), set(['A1', 'A2', '\u00b6']))
         
         # test parsing and evaluation to make sure we get the right values out
         for expr, correct in test_formulas:
             tree = parse(expr, c, ca)
             res = eval_parse(tree, ca, act_dict, m, False)
             self.assertAlmostEqual(correct, res, msg="Incorrect result for %s"%(expr,))
+            res_all = eval_parse_all(tree, ca, act_dict, [m], False)
+            self.assertEqual(res_all, {m.id: res})
 
         # test some badly-formed stuff for appropriate exceptions
         tree = parse("1 + BEST(3, [A1], [A2])", c, ca)
@@ -149,6 +165,239 @@ class GradesTest(TestCase):
         res = eval_parse(tree, ca, act_dict, m, True)
         self.assertAlmostEqual(res, 7.229166666)
 
+    def test_formulas_whole_class(self):
+        """
+        Test that whole-class formula evaluation matches the per-student evaluation, with a constant number of queries.
+        """
+        c = CourseOffering.objects.get(slug=self.course_slug)
+        students = list(c.member_set.filter(role="STUD"))
+        self.assertGreater(len(students), 5)
+
+        a1 = NumericActivity(name="Assignment #1", short_name="A1", status="RLS", offering=c, position=1, max_grade=15, percent=10)
+        a1.save()
+        a2 = NumericActivity(name="Assignment 2", short_name="A2", status="URLS", offering=c, position=2, max_grade=40, percent=20)
+        a2.save()
+        a3 = NumericActivity(name="Zero", short_name="Z", status="RLS", offering=c, position=3, max_grade=0, percent=5)
+        a3.save()
+        ca = CalNumericActivity(name="Final Grade", short_name="FG", status="RLS", offering=c, position=4, max_grade=100)
+        ca.save()
+
+        rand = random.Random(1234)
+        for i, m in enumerate(students):
+            # leave some students with no grade, or "no grade" flags
+            if i % 5 != 0:
+                NumericGrade(activity=a1, member=m, value=rand.randint(0, 150)/10, flag="GRAD").save(entered_by='ggbaker')
+            if i % 4 != 1:
+                flag = "NOGR" if i % 3 == 0 else "GRAD"
+                NumericGrade(activity=a2, member=m, value=rand.randint(0, 400)/10, flag=flag).save(entered_by='ggbaker')
+            NumericGrade(activity=a3, member=m, value=rand.randint(0, 3), flag="GRAD").save(entered_by='ggbaker')
+
+        formulas = [f for f, _ in test_formulas if '\u00b6' not in f] + [
+            "[A1]/[A1.max]*[A1.percent] + [A2.final] + [Z.final]",
+            "COUNT([A1], [A2], [Z]) + AVG([A1], [A2]/3, 7.5)",
+            "BEST(2, [A1], [A2], [Z]) / ([Z] - 1)",
+            "BEST([Z]+1, [A1], [A2], [Z], 1, 2)",
+            "MIN([A1], [A2]) * MAX([A1], -[Z])",
+            "[[activitytotal]]",
+            "[[activitytotal]] * 2 - SUM([A1], [A2.percent])",
+        ]
+        activities = NumericActivity.objects.filter(offering=c)
+        act_dict = activities_dictionary(activities)
+        for visible in [True, False]:
+            for calculation_leak in [True, False]:
+                ca.set_calculation_leak(calculation_leak)
+                for expr in formulas:
+                    tree = parse(expr, c, ca)
+                    res_all = eval_parse_all(tree, ca, act_dict, students, visible)
+                    for m in students:
+                        res = eval_parse(tree, ca, act_dict, m, visible)
+                        self.assertEqual(res_all[m.id], res, msg="Incorrect result for %s" % (expr,))
+
+        # a problem for any student: the same exceptions as the per-student evaluation
+        tree = parse("BEST([Z], [A1], [A2])", c, ca)
+        self.assertRaises(EvalException, eval_parse_all, tree, ca, act_dict, students, True)
+        tree = parse("[Foo] /2", c, ca)
+        self.assertRaises(KeyError, eval_parse_all, tree, ca, act_dict, students, True)
+
+        # all grades fetched at once, independent of class size
+        tree = parse("BEST(2, [A1], [A2], [Z]) + [A1.final]", c, ca)
+        with self.assertNumQueries(1):
+            eval_parse_all(tree, ca, act_dict, students, True)
+
+        # ... and the whole-class calculation saves the same values
+        ca.formula = "BEST(2, [A1], [A2], [Z]) + [A1.final]"
+        ca.set_calculation_leak(False)
+        ca.save()
+        calculate_numeric_grade(c, ca)
+        for m in students:
+            g = NumericGrade.objects.get(activity=ca, member=m)
+            self.assertEqual(g.flag, "CALC")
+            self.assertEqual(g.value, decimal.Decimal(str(eval_parse(tree, ca, act_dict, m, True))).quantize(decimal.Decimal('0.01')))
+
+        # manually-set grades are left alone; recalculating with nothing changed writes nothing
+        g = NumericGrade.objects.get(activity=ca, member=students[0])
+        g.value = 123
+        g.flag = "GRAD"
+        g.save(entered_by='ggbaker')
+        ignored, _ = calculate_numeric_grade(c, ca)
+        self.assertEqual(ignored, 1)
+        self.assertEqual(NumericGrade.objects.get(activity=ca, member=students[0]).value, 123)
+        with CaptureQueriesContext(connection) as queries:
+            ignored, _ = calculate_numeric_grade(c, ca)
+        self.assertEqual(ignored, 1)
+        self.assertFalse([q for q in queries if q['sql'].startswith(('INSERT', 'UPDATE'))])
+
+        # changed component grade: updated calculated value
+        g = NumericGrade.objects.get(activity=a1, member=students[1])
+        g.value = 15
+        g.save(entered_by='ggbaker')
+        calculate_numeric_grade(c, ca)
+        g = NumericGrade.objects.get(activity=ca, member=students[1])
+        self.assertEqual(g.value, decimal.Decimal(str(eval_parse(tree, ca, act_dict, students[1], True))).quantize(decimal.Decimal('0.01')))
+
+    def test_dependent_recalculation(self):
+        """
+        Test that calculated grades that depend on a changed grade are recalculated.
+        """
+        s, c = create_offering()
+        students = []
+        for userid in ["0aaa0", "0aaa1", "0aaa2"]:
+            m = Member(person=Person.objects.get(userid=userid), offering=c, role="STUD", credits=3, added_reason="UNK")
+            m.save()
+            students.append(m)
+        a1 = NumericActivity(name="Assignment 1", short_name="A1", status="RLS", offering=c, position=1, max_grade=10, percent=50)
+        a1.save()
+        a2 = NumericActivity(name="Assignment 2", short_name="A2", status="RLS", offering=c, position=2, max_grade=10, percent=50)
+        a2.save()
+        total = CalNumericActivity(name="Total", short_name="Total", status="RLS", offering=c, position=3, max_grade=100,
+                                   formula="[[activitytotal]]")
+        total.save()
+        letter = CalLetterActivity(name="Letter", short_name="L", status="RLS", offering=c, position=4, numeric_activity=total,
+                                   exam_activity=a2)
+        letter.save()
+        other = CalNumericActivity(name="Other", short_name="Other", status="RLS", offering=c, position=5, max_grade=10,
+                                   formula="[A2]")
+        other.save()
+
+        self.assertEqual([a.id for a in dependent_calculated_activities(c, a1)], [total.id, letter.id])
+        self.assertEqual(set(a.id for a in dependent_calculated_activities(c, a2)), set([total.id, letter.id, other.id]))
+        self.assertEqual(dependent_calculated_activities(c, letter), [])
+
+        for m in students:
+            NumericGrade(activity=a1, member=m, value=5, flag="GRAD").save(entered_by='ggbaker')
+            NumericGrade(activity=a2, member=m, value=10, flag="GRAD").save(entered_by='ggbaker')
+        calculate_numeric_grade(c, total)
+        calculate_letter_grade(c, letter)
+        m = students[0]
+        self.assertEqual(NumericGrade.objects.get(activity=total, member=m).value, 75)
+        self.assertEqual(LetterGrade.objects.get(activity=letter, member=m).letter_grade, 'B')
+
+        # changing a grade updates that student's calculated grades (but not never-calculated activities)
+        g = NumericGrade.objects.get(activity=a1, member=m)
+        g.value = 10
+        with self.captureOnCommitCallbacks(execute=True):
+            g.save(entered_by='ggbaker')
+        self.assertEqual(NumericGrade.objects.get(activity=total, member=m).value, 100)
+        self.assertEqual(LetterGrade.objects.get(activity=letter, member=m).letter_grade, 'A+')
+        self.assertEqual(NumericGrade.objects.get(activity=total, member=students[1]).value, 75)
+        self.assertFalse(NumericGrade.objects.filter(activity=other).exists())
+
+        # grades saved together are recalculated together, by one task
+        from grades import tasks
+        with mock.patch.object(tasks, 'recalculate_dependent_grades', wraps=tasks.recalculate_dependent_grades) as recalc:
+            with self.captureOnCommitCallbacks(execute=True):
+                for st in students[1:]:
+                    g = NumericGrade.objects.get(activity=a1, member=st)
+                    g.value = 0
+                    g.save(entered_by='ggbaker')
+        recalc.assert_called_once_with(a1.id, sorted(st.id for st in students[1:]))
+        self.assertEqual(NumericGrade.objects.get(activity=total, member=students[1]).value, 50)
+        self.assertEqual(NumericGrade.objects.get(activity=total, member=students[2]).value, 50)
+        self.assertEqual(NumericGrade.objects.get(activity=total, member=m).value, 100)
+
+        # manually-set grades are left alone
+        g = NumericGrade.objects.get(activity=total, member=m)
+        g.value = 40
+        g.flag = "GRAD"
+        g.save(entered_by='ggbaker')
+        g = NumericGrade.objects.get(activity=a2, member=m)
+        g.value = 0
+        with self.captureOnCommitCallbacks(execute=True):
+            g.save(entered_by='ggbaker')
+        self.assertEqual(NumericGrade.objects.get(activity=total, member=m).value, 40)
+        self.assertEqual(LetterGrade.objects.get(activity=letter, member=m).letter_grade, 'F')
+
+    def test_gradebook(self):
+        """
+        Test the whole-offering gradebook matrix and its caching.
+        """
+        s, c = create_offering()
+        students = []
+        for userid in ["0aaa0", "0aaa1", "0aaa2"]:
+            m = Member(person=Person.objects.get(userid=userid), offering=c, role="STUD", credits=3, added_reason="UNK")
+            m.save()
+            students.append(m)
+        na = NumericActivity(name="Assignment 1", short_name="A1", status="RLS", offering=c, position=1, max_grade=10)
+        na.save()
+        la = LetterActivity(name="Project", short_name="Proj", status="RLS", offering=c, position=2)
+        la.save()
+        NumericGrade(activity=na, member=students[0], value="7.25", flag="GRAD", comment="good").save(entered_by='ggbaker')
+        NumericGrade(activity=na, member=students[1], value=0, flag="NOGR").save(entered_by='ggbaker')
+        LetterGrade(activity=la, member=students[0], letter_grade="B+", flag="DISH").save(entered_by='ggbaker')
+
+        gradebook = GradebookMatrix(c)
+        self.assertEqual([a.id for a in gradebook.activities], [na.id, la.id])
+        rows = list(gradebook.rows())
+        self.assertEqual([s.id for s, _ in rows], [m.id for m in students])
+        self.assertEqual([cell and cell.export_value() for cell in rows[0][1]], ['7.25', 'B+'])
+        self.assertEqual(rows[0][1][0].display_staff_short(), '7.2')
+        self.assertEqual(rows[0][1][1].display_staff_html(), 'B+<span class="more"><br/>(academic dishonesty)</span>')
+        self.assertEqual([cell and cell.export_value() for cell in rows[1][1]], ['', None])
+        self.assertEqual(rows[2][1], [None, None])
+        gradebook.load_comments()
+        self.assertEqual(rows[0][1][0].comment, 'good')
+
+        # cached: no queries to rebuild
+        with self.assertNumQueries(0):
+            GradebookMatrix(c, activities=gradebook.activities, students=gradebook.students)
+
+        # ... until a grade change is committed
+        g = NumericGrade.objects.get(activity=na, member=students[1])
+        g.value = 3
+        g.flag = "GRAD"
+        with self.captureOnCommitCallbacks(execute=True):
+            g.save(entered_by='ggbaker')
+            with self.assertNumQueries(0):
+                GradebookMatrix(c, activities=gradebook.activities, students=gradebook.students)
+        with self.assertNumQueries(1):
+            gradebook = GradebookMatrix(c, activities=gradebook.activities, students=gradebook.students)
+        self.assertEqual(gradebook.matrix[1][0].export_value(), '3.00')
+
+        # CSV output
+        client = Client()
+        client.login_user("ggbaker")
+        Member(person=Person.objects.get(userid="ggbaker"), offering=c, role="INST", added_reason="UNK").save()
+        response = client.get(reverse('offering:all_grades_csv', kwargs={'course_slug': c.slug}))
+        lines = b''.join(response.streaming_content).decode('utf-8').strip().split('\r\n')
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[0].endswith(',A1,Proj'))
+        self.assertTrue(lines[1].endswith(',7.25,B+'))
+        self.assertTrue(lines[2].endswith(',3.00,'))
+        self.assertTrue(lines[3].endswith(',,'))
+        response = client.get(reverse('offering:grade_history', kwargs={'course_slug': c.slug}))
+        lines = b''.join(response.streaming_content).decode('utf-8').strip().split('\r\n')
+        self.assertEqual(lines[0], 'Date/Time,Activity,Student,Entered By,Numeric Grade,Letter Grade,Status,Group')
+        self.assertEqual(len(lines), 5)
+        self.assertTrue(lines[1].endswith(',A1,0aaa1,ggbaker,3.00,,graded,'))
+        response = basic_page_tests(self, client, reverse('offering:all_grades', kwargs={'course_slug': c.slug}))
+        self.assertContains(response, '<td class="num">7.2<span class="more"><span title="good">')
+
+        # the everything-export is a streamed ZIP containing the same CSV
+        response = client.get(reverse('offering:export_all', kwargs={'course_slug': c.slug}))
+        z = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertIn('grades.csv', z.namelist())
+        self.assertTrue(z.read('grades.csv').decode('utf-8').strip().split('\r\n')[1].endswith(',7.25,B+'))
+
     def test_activities(self):
         """
         Test activity classes: subclasses, selection, sorting.
@@ -393,6 +642,122 @@ class GradesTest(TestCase):
         expect = [('<0%',8), ('0\u201310%',0), ('10\u201320%',0), ('20\u201330%',0), ('30\u201340%',0), ('40\u201350%',0), ('50\u201360%',0), ('60\u201370%',0),('70\u201380%',0),('80\u201390%',0),('90\u2013100%',0)]
         self.assertEqual(res, expect)
 
+    def test_activity_stats(self):
+        """
+        Test the activity summary stats, calculated by the database and cached.
+        """
+        s, c = create_offering()
+        na = NumericActivity(name="Assignment 1", short_name="A1", status="RLS", offering=c, position=1, max_grade=10)
+        na.save()
+        la = LetterActivity(name="Project", short_name="Proj", status="RLS", offering=c, position=2)
+        la.save()
+        values = ['0', '5', '7.5', '10', '10', '12', None]
+        letters = ['A', 'B', 'A', 'F', 'A+', 'B', None]
+        students = []
+        for i, (v, l) in enumerate(zip(values, letters)):
+            m = Member(person=Person.objects.get(userid="0aaa%i" % (i)), offering=c, role="STUD", credits=3, added_reason="UNK")
+            m.save()
+            students.append(m)
+            NumericGrade(activity=na, member=m, value=v or 0, flag="GRAD" if v else "NOGR").save(entered_by='ggbaker')
+            LetterGrade(activity=la, member=m, letter_grade=l or 'A', flag="GRAD" if l else "NOGR").save(entered_by='ggbaker')
+        # a dropped student doesn't count
+        m = Member(person=Person.objects.get(userid="0aaa10"), offering=c, role="DROP", credits=3, added_reason="UNK")
+        m.save()
+        NumericGrade(activity=na, member=m, value=1, flag="GRAD").save(entered_by='ggbaker')
+
+        stats, _ = generate_numeric_activity_stat(na, 'INST')
+        self.assertEqual(stats.count, 6)
+        self.assertEqual(stats.average, '7.42')
+        self.assertEqual(stats.min, '0.00')
+        self.assertEqual(stats.max, '12.00')
+        self.assertEqual(stats.median, '8.75')
+        self.assertEqual(stats.stddev, '%.2f' % (statistics.pstdev([0, 5, 7.5, 10, 10, 12])))
+        self.assertEqual([(r.grade_range, r.stud_count) for r in stats.grade_range_stat_list],
+                         [(r.grade_range, r.stud_count) for r in generate_grade_range_stat([0, 50, 75, 100, 100, 120])])
+
+        stats, _ = generate_letter_activity_stat(la, 'INST')
+        self.assertEqual(stats.count, 6)
+        self.assertEqual((stats.median, stats.max, stats.min), ('A/B', 'A+', 'F'))
+
+        # cached until a grade changes
+        with self.assertNumQueries(0):
+            generate_numeric_activity_stat(na, 'INST')
+            generate_letter_activity_stat(la, 'INST')
+        g = NumericGrade.objects.get(activity=na, member=students[0])
+        g.value = 10
+        with self.captureOnCommitCallbacks(execute=True):
+            g.save(entered_by='ggbaker')
+        stats, _ = generate_numeric_activity_stat(na, 'INST')
+        self.assertEqual((stats.min, stats.median), ('5.00', '10.00'))
+        g = LetterGrade.objects.get(activity=la, member=students[3])
+        g.letter_grade = 'C'
+        with self.captureOnCommitCallbacks(execute=True):
+            g.save(entered_by='ggbaker')
+        stats, _ = generate_letter_activity_stat(la, 'INST')
+        self.assertEqual(stats.min, 'C')
+
+        # ... but not before the change commits: stats read (and re-cached) from the old grades must not outlive it
+        g = NumericGrade.objects.get(activity=na, member=students[1])
+        g.value = 1
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                g.save(entered_by='ggbaker')
+                with self.assertNumQueries(0):
+                    stats, _ = generate_numeric_activity_stat(na, 'INST')
+                self.assertEqual(stats.min, '5.00')
+        stats, _ = generate_numeric_activity_stat(na, 'INST')
+        self.assertEqual(stats.min, '1.00')
+        g.value = 5
+        with self.captureOnCommitCallbacks(execute=True):
+            g.save(entered_by='ggbaker')
+
+        # ... or a student drops
+        students[0].role = 'DROP'
+        with self.captureOnCommitCallbacks(execute=True):
+            students[0].save()
+        stats, _ = generate_numeric_activity_stat(na, 'INST')
+        self.assertEqual((stats.count, stats.min), (5, '5.00'))
+        stats, _ = generate_letter_activity_stat(la, 'INST')
+        self.assertEqual(stats.count, 5)
+
+        # out of zero: everything in the top bin
+        na.max_grade = 0
+        with self.captureOnCommitCallbacks(execute=True):
+            na.save()
+        stats, _ = generate_numeric_activity_stat(na, 'INST')
+        self.assertEqual([(r.grade_range, r.stud_count) for r in stats.grade_range_stat_list][-1], ('90\u2013100%', 5))
+
+    def test_student_activity_info(self):
+        """
+        Test create_StudentActivityInfo_list: everyone's grade, in a fixed number of queries.
+        """
+        s, c = create_offering()
+        na = NumericActivity(name="Assignment 1", short_name="A1", status="RLS", offering=c, position=1, max_grade=10)
+        na.save()
+        la = LetterActivity(name="Project", short_name="Proj", status="RLS", offering=c, position=2)
+        la.save()
+        students = []
+        for i in range(6):
+            m = Member(person=Person.objects.get(userid="0aaa%i" % (i)), offering=c, role="STUD", credits=3, added_reason="UNK")
+            m.save()
+            students.append(m)
+            if i % 3:
+                NumericGrade(activity=na, member=m, value=i, flag="GRAD" if i % 2 else "EXCU").save(entered_by='ggbaker')
+                LetterGrade(activity=la, member=m, letter_grade='B', flag="GRAD").save(entered_by='ggbaker')
+
+        with self.assertNumQueries(3):
+            infos = create_StudentActivityInfo_list(c, na)
+            names = [i.student.person.name() for i in infos]
+        self.assertEqual(len(infos), 6)
+        by_member = dict((i.student.id, i) for i in infos)
+        self.assertEqual([(by_member[m.id].grade_status, by_member[m.id].numeric_grade) for m in students[:3]],
+                         [('no grade', None), ('graded', 1), ('excused', 2)])
+
+        infos = create_StudentActivityInfo_list(c, la, student=students[1])
+        self.assertEqual([(i.student, i.grade_status, i.letter_grade) for i in infos], [(students[1], 'graded', 'B')])
+        infos = create_StudentActivityInfo_list(c, la, student=students[0])
+        self.assertEqual([(i.grade_status, i.letter_grade) for i in infos], [('no grade', None)])
+
     def test_calc_letter(self):
         """
         Test calculated letter functionality
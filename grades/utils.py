@@ -6,16 +6,24 @@ from grades.models import Activity, NumericActivity, LetterActivity, NumericGrad
                           LetterGrade, ACTIVITY_TYPES, FLAGS, \
                           CalNumericActivity,CalLetterActivity, median_letters, min_letters, max_letters,sorted_letters
 from coredata.models import CourseOffering, Member
-from grades.formulas import parse, activities_dictionary, cols_used, eval_parse, EvalException
+from grades.gradebook import invalidate_activity_grades
+from grades.formulas import parse, activities_dictionary, cols_used, eval_parse, eval_parse_all, EvalException, \
+    compile_parse, grade_matrix
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q, Count, Avg, Min, Max, StdDev
 from pyparsing import ParseException
-import math
 import decimal
+import time
 
 ORDER_TYPE = {'UP': 'up', 'DN': 'down'}
 _NO_GRADE = '\u2014'
 _DECIMAL_PLACE = 2
 _SUPPORTED_GRADE_RANGE = [10]
 
+# number of grades to create/update per query when saving calculated grades
+BULK_BATCH_SIZE = 500
+
 # Course should have this number to student to display the activity statistics, including histogram
 STUD_NUM_TO_DISP_ACTSTAT = 10
 
@@ -198,50 +206,159 @@ def create_StudentActivityInfo_list(course, activity, student=None):
     # verify if the course contains the activity
     if not Activity.objects.filter(slug=activity.slug, offering=course):
         return
-    student_list = Member.objects.filter(offering=course, role='STUD')
+    student_list = Member.objects.filter(offering=course, role='STUD').select_related('person')
     if student:
         if not isinstance(student, Member):
             raise TypeError('Member type is required')
-        if student in student_list:
+        if student_list.filter(id=student.id).exists():
             student_list = [student]
         else:
             return
 
-    student_activity_info_list = []
-
     if isinstance(activity, NumericActivity):
-        # select_ralated field for fast template rendering
-        #numeric_grade_list = NumericGrade.objects.filter(activity=activity).select_related('member', 'member__person')
-        numeric_grade_list = activity.numericgrade_set.all().select_related('member', 'member__person', 'activity')
-        for student in student_list:
-            student_grade_status = None
-            for numeric_grade in numeric_grade_list:
-                if numeric_grade.member == student:
-                    student_grade_status = numeric_grade.get_flag_display()
-                    student_grade = numeric_grade.value
-                    break
-            if not student_grade_status:
-                student_grade_status = FLAGS['NOGR']
-                student_grade = None
+        grade_list = NumericGrade.objects.filter(activity=activity).values_list('member_id', 'value', 'flag')
+    elif isinstance(activity, LetterActivity):
+        grade_list = LetterGrade.objects.filter(activity=activity).values_list('member_id', 'letter_grade', 'flag')
+    else:
+        return []
+    if student:
+        grade_list = grade_list.filter(member=student)
+    # member.id -> (grade, flag), so each student's grade is a dictionary lookup
+    grades = dict((member_id, (grade, flag)) for member_id, grade, flag in grade_list)
+
+    student_activity_info_list = []
+    numeric = isinstance(activity, NumericActivity)
+    for student in student_list:
+        if student.id in grades:
+            student_grade, flag = grades[student.id]
+            student_grade_status = FLAGS[flag]
+        else:
+            student_grade_status = FLAGS['NOGR']
+            student_grade = None
+        if numeric:
             student_activity_info_list.append(StudentActivityInfo(student, activity,
                                                                   student_grade_status, student_grade, None))
-    elif isinstance(activity, LetterActivity):
-        # select_ralated field for fast template rendering
-        letter_grade_list = LetterGrade.objects.filter(activity=activity).select_related('member', 'member__person')
-        for student in student_list:
-            student_grade_status = None
-            for letter_grade in letter_grade_list:
-                if letter_grade.member == student:
-                    student_grade_status = letter_grade.get_flag_display()
-                    student_grade = letter_grade.letter_grade
-                    break
-            if not student_grade_status:
-                student_grade_status = FLAGS['NOGR']
-                student_grade = None
+        else:
             student_activity_info_list.append(StudentActivityInfo(student, activity,
                                                                   student_grade_status, None, student_grade))
     return student_activity_info_list
 
+def _activity_stats_key(activity_id):
+    return 'activity-stats-%i' % (activity_id,)
+
+def _students_generation_key(offering_id):
+    return 'offering-students-generation-%i' % (offering_id,)
+
+def _students_generation(offering_id):
+    """
+    The current generation of the offering's list of students: cached summary stats (which count only students' grades)
+    are only used if they were calculated in this generation.
+    """
+    key = _students_generation_key(offering_id)
+    gen = cache.get(key)
+    if gen is None:
+        # start from the clock, so a counter that has been evicted from the cache doesn't reuse old generations
+        gen = int(time.time() * 1000)
+        if not cache.add(key, gen, None):
+            gen = cache.get(key, gen)
+    return gen
+
+def offering_students_changed(offering_id):
+    """
+    Forget the summary stats for all of the offering's activities: must be called when a Member is added, removed, or
+    changes role, since only students are counted.
+
+    As with activity_grades_changed, this happens when the transaction commits.
+    """
+    key = _students_generation_key(offering_id)
+    def forget():
+        try:
+            cache.incr(key)
+        except ValueError:
+            # no generation yet: nothing cached under it
+            cache.add(key, int(time.time() * 1000), None)
+    transaction.on_commit(forget)
+
+def _cached_activity_stats(activity):
+    "The stats cached for the activity (or None), if they were calculated with the current list of students."
+    cached = cache.get(_activity_stats_key(activity.id))
+    if cached is not None and cached[0] == _students_generation(activity.offering_id):
+        return cached[1]
+    return None
+
+def _cache_activity_stats(activity, stats):
+    cache.set(_activity_stats_key(activity.id), (_students_generation(activity.offering_id), stats), 3600)
+
+def activity_grades_changed(activity_id):
+    """
+    Forget everything cached about the activity's grades (gradebook column, summary stats): must be called whenever
+    they change.
+
+    This happens when the transaction commits: forgetting any earlier would let another request re-cache the old grades
+    before the new ones are visible to it.
+    """
+    def forget():
+        invalidate_activity_grades(activity_id)
+        cache.delete(_activity_stats_key(activity_id))
+    transaction.on_commit(forget)
+
+def _grade_range_bins(max_grade):
+    """
+    Q objects selecting the grades in each bin of the histogram (as generated by generate_grade_range_stat), for
+    an activity out of max_grade (which must not be zero).
+    """
+    bounds = [max_grade * i / 10 for i in range(10)]
+    bins = [Q(value__lt=0)]
+    bins.extend(Q(value__gte=low, value__lt=high) for low, high in zip(bounds, bounds[1:]))
+    bins.append(Q(value__gte=bounds[-1], value__lte=max_grade))
+    bins.append(Q(value__gt=max_grade))
+    return bins
+
+def numeric_activity_summary(activity):
+    """
+    Summary of the students' grades on the numeric activity: a dictionary with the count, average, min, max, median,
+    stddev and histogram bin counts, calculated by the database.
+
+    Cached until the activity's grades or the offering's students change.
+    """
+    summary = _cached_activity_stats(activity)
+    if summary is not None:
+        return summary
+
+    grades = NumericGrade.objects.filter(activity=activity, member__role='STUD').exclude(flag="NOGR")
+    aggregates = {'count': Count('id'), 'average': Avg('value'), 'min': Min('value'), 'max': Max('value'),
+                  'stddev': StdDev('value')}
+    if activity.max_grade != 0:
+        bins = _grade_range_bins(activity.max_grade)
+        aggregates.update(('bin%i' % (i), Count('id', filter=q)) for i, q in enumerate(bins))
+    res = grades.aggregate(**aggregates)
+
+    count = res['count']
+    if activity.max_grade != 0:
+        histogram = [res['bin%i' % (i)] for i in range(len(bins))]
+    else:
+        # everything is 100%
+        histogram = [0] * 12
+        histogram[-2] = count
+    summary = {'count': count, 'histogram': histogram}
+    if count:
+        # the middle one or two grades
+        middle = list(grades.order_by('value').values_list('value', flat=True)[(count - 1) // 2:count // 2 + 1])
+        if count % 2 == 0:
+            median = (middle[0] + middle[1]) / 2
+        else:
+            median = middle[0]
+        summary.update({
+            'average': float(res['average']),
+            'min': res['min'],
+            'max': res['max'],
+            'median': median,
+            'stddev': float(res['stddev']),
+        })
+
+    _cache_activity_stats(activity, summary)
+    return summary
+
 def generate_numeric_activity_stat(activity, role):
     """
     This function fetch statistics of the numeric activity.
@@ -249,8 +366,8 @@ def generate_numeric_activity_stat(activity, role):
     if role == 'STUD' and activity.status != 'RLS':
         return None, 'Summary statistics disabled for unreleased activities.'
 
-    student_grade_list = fetch_students_numeric_grade(activity)
-    if not student_grade_list:
+    summary = numeric_activity_summary(activity)
+    if not summary['count']:
         if role == 'STUD':
             return None, 'Summary statistics disabled for small classes.'
         else:
@@ -258,34 +375,15 @@ def generate_numeric_activity_stat(activity, role):
     if role == 'STUD' and not activity.showstats():
         return None, 'Summary stats disabled by instructor.'
 
-    student_grade_list.sort()
-    student_grade_list_count = len(student_grade_list)
-    average = sum(student_grade_list)
-    average = float(average) / student_grade_list_count
-
-    if student_grade_list_count % 2 == 0:
-        median = (student_grade_list[(student_grade_list_count - 1) // 2] +
-                    student_grade_list[(student_grade_list_count) // 2]) / 2
-    else:
-        median = student_grade_list[(student_grade_list_count - 1) // 2]
-
-    stddev = math.sqrt(sum([(float(student_grade) - average) ** 2 for student_grade in student_grade_list]) / student_grade_list_count)
-
-    # normalize the grade into 100 based in order to generate the grade range stat
-    if activity.max_grade == 0:
-        normalized_student_grade_list = [100 for student_grade in student_grade_list]
-    else:
-        normalized_student_grade_list = [ float(student_grade)/float(activity.max_grade)*100
-                                        for student_grade in student_grade_list ]
     if role == 'STUD' and not activity.showhisto():
         grade_range_stat_list = []
     else:
-        grade_range_stat_list = generate_grade_range_stat(normalized_student_grade_list)
+        grade_range_stat_list = _grade_range_stat_list(summary['histogram'])
 
-    stats = ActivityStat(format_number(average, _DECIMAL_PLACE), format_number(student_grade_list[0], _DECIMAL_PLACE),
-                        format_number(student_grade_list[student_grade_list_count - 1], _DECIMAL_PLACE),
-                        format_number(median, _DECIMAL_PLACE),
-                        format_number(stddev, _DECIMAL_PLACE), grade_range_stat_list, student_grade_list_count)
+    stats = ActivityStat(format_number(summary['average'], _DECIMAL_PLACE), format_number(summary['min'], _DECIMAL_PLACE),
+                        format_number(summary['max'], _DECIMAL_PLACE),
+                        format_number(summary['median'], _DECIMAL_PLACE),
+                        format_number(summary['stddev'], _DECIMAL_PLACE), grade_range_stat_list, summary['count'])
 
     reason_msg = ''
     if role == 'STUD' and (stats is None or stats.count < STUD_NUM_TO_DISP_ACTSTAT):
@@ -302,8 +400,8 @@ def generate_letter_activity_stat(activity, role):
     if role == 'STUD' and activity.status != 'RLS':
         return None, 'Summary statistics disabled for unreleased activities.'
 
-    student_grade_list = fetch_students_letter_grade(activity)
-    sorted_grades = sorted_letters(student_grade_list) 
+    student_grade_list = letter_activity_grades(activity)
+    sorted_grades = sorted_letters(student_grade_list)
     if not sorted_grades:
         if role == 'STUD':
             return None, 'Summary statistics disabled for small classes.'
@@ -350,22 +448,31 @@ def generate_grade_range_stat(student_grade_list, grade_range=10):
         return
     EPS = 1e-6
 
-    stats = [GradeRangeStat("<0%", 0)] \
-            + [GradeRangeStat("%i\u2013%i%%" % (i*grade_range,(i+1)*grade_range), 0) for i in range(grade_range)] \
-            + [GradeRangeStat(">100%", 0)]
+    counts = [0] * (grade_range + 2)
     for g in student_grade_list:
         # extreme cases:
         if g < 0:
-            stats[0].stud_count += 1
+            counts[0] += 1
         elif g > 100:
-            stats[-1].stud_count += 1
+            counts[-1] += 1
         else:
             # other grade_range bins:
             bin = int(g//10 + EPS)
             if bin == grade_range:
                 # move 100% down into x-100 bin
                 bin -= 1
-            stats[bin+1].stud_count += 1
+            counts[bin+1] += 1
+
+    return _grade_range_stat_list(counts, grade_range)
+
+
+def _grade_range_stat_list(counts, grade_range=10):
+    """
+    Build the list of GradeRangeStat from the count in each bin: <0%, the grade_range bins, >100%.
+    """
+    stats = [GradeRangeStat("<0%", counts[0])] \
+            + [GradeRangeStat("%i\u2013%i%%" % (i*grade_range,(i+1)*grade_range), counts[i+1]) for i in range(grade_range)] \
+            + [GradeRangeStat(">100%", counts[-1])]
 
     # remove extreme bins if not used
     if stats[0].stud_count == 0:
@@ -415,50 +522,62 @@ def generate_grade_range_stat_lettergrade(student_lettergrade_list,grade_range=1
 
     return grade_range_stat_list
 
-def fetch_students_numeric_grade(activity):
-    """
-    This function return a list of all students' grade in a course activity.
+def letter_activity_grades(activity):
     """
-    student_list = activity.offering.members.filter(person__role='STUD')
-    grade_list = NumericGrade.objects.filter(activity=activity).exclude(flag="NOGR")\
-                        .select_related('member','member__person') 
+    This function return a list of all students' grade in a course activity (excluding "no grade"s).
 
-    student_grade_list = []
-    for student in student_list:
-    #student_found = False
-        for grade in grade_list:
-            if grade.member.person == student:
-            #student_found = True
-                student_grade_list.append(grade.value)
-                break
-        #if not student_found:
-        #    student_grade_list.append(_DEFAULT_NUMERIC_GRADE)
+    The number of each letter is calculated by the database, and cached until the activity's grades or the offering's
+    students change.
+    """
+    counts = _cached_activity_stats(activity)
+    if counts is None:
+        counts = dict(LetterGrade.objects.filter(activity=activity, member__role='STUD').exclude(flag="NOGR")
+                      .order_by().values_list('letter_grade').annotate(Count('id')))
+        _cache_activity_stats(activity, counts)
 
-    return student_grade_list
+    return [letter for letter, count in counts.items() for _ in range(count)]
 
-def fetch_students_letter_grade(activity):
+def _round_calculated(result):
+    """
+    Convert a calculated result to decimal, rounded as the database will store it, so unchanged grades can be detected.
     """
-    This function return a list of all students' grade in a course activity. If student does not
-    have any grade yet, the numeric grade is default to 0.
+    places = decimal.Decimal(1).scaleb(-NumericGrade._meta.get_field('value').decimal_places)
+    return decimal.Decimal(str(result)).quantize(places)
+
+def save_calculated_grades(GradeClass, activity, results, field):
     """
+    Save calculated grades for the whole class in bulk.
 
+    results is a dictionary of member.id -> calculated value, to be stored in the grade's field. Grades are created
+    or updated with bulk queries in a single transaction; grades whose value didn't change are left alone. Like
+    GradeClass.save(entered_by=None, newsitem=False), no GradeHistory or NewsItems are created.
 
-    student_list = activity.offering.members.filter(person__role='STUD')
-    grade_list = LetterGrade.objects.filter(activity=activity).exclude(flag="NOGR")\
-                        .select_related('member','member__person') 
+    Manually-set grades (i.e. those not flagged "CALC") are ignored: returns the number ignored.
+    """
+    existing = dict((g.member_id, g) for g in GradeClass.objects.filter(activity=activity, member_id__in=results.keys()))
 
-    student_grade_list = []
-    for student in student_list:
-        #student_found = False
-        for grade in grade_list:
-            if grade.member.person == student:
-                #student_found = True
-                student_grade_list.append(grade.letter_grade)
-                break
-        #if not student_found:
-        #    student_grade_list.append(_DEFAULT_NUMERIC_GRADE)
+    ignored = 0
+    new_grades = []
+    changed_grades = []
+    for member_id, result in results.items():
+        grade = existing.get(member_id)
+        if grade is None:
+            new_grades.append(GradeClass(activity=activity, member_id=member_id, flag='CALC', **{field: result}))
+        elif grade.flag != "CALC":
+            # ignore manually-set grades
+            ignored += 1
+        elif result != getattr(grade, field):
+            # only save when the value changes
+            setattr(grade, field, result)
+            changed_grades.append(grade)
+
+    with transaction.atomic():
+        GradeClass.objects.bulk_create(new_grades, batch_size=BULK_BATCH_SIZE)
+        GradeClass.objects.bulk_update(changed_grades, [field], batch_size=BULK_BATCH_SIZE)
+    if new_grades or changed_grades:
+        activity_grades_changed(activity.id)
 
-    return student_grade_list
+    return ignored
 
 def calculate_letter_grade(course, activity):
     """
@@ -474,32 +593,8 @@ def calculate_letter_grade(course, activity):
 
     # calculate for all student
     student_list = Member.objects.filter(offering=course, role='STUD')
-    letter_grade_list = LetterGrade.objects.filter(activity = activity).select_related('member') 
-
-    ignored = 0
-    for s in student_list:
-        # calculate grade
-
-        result = generate_lettergrades(s,activity)
-
-        # save grade
-        member_found = False
-        for letter_grade in letter_grade_list:
-            if letter_grade.member == s:
-                member_found = True     
-                if letter_grade.flag != "CALC":
-                    ignored += 1
-                elif result != letter_grade.letter_grade or letter_grade.flag != "CALC":
-                    # ignore manually-set grades; only save when the value changes
-                    letter_grade.letter_grade = result
-                    letter_grade.flag = "CALC"
-                    letter_grade.save(newsitem=False, entered_by=None)
-                break
-        if not member_found:
-            letter_grade = LetterGrade(activity=activity, member=s,
-                                         letter_grade=result, flag='CALC')
-            letter_grade.save(newsitem=False, entered_by=None)
-    return ignored
+    results = dict((s.id, generate_lettergrades(s, activity)) for s in student_list)
+    return save_calculated_grades(LetterGrade, activity, results, 'letter_grade')
 
 def generate_lettergrades(s,activity):
 
@@ -604,43 +699,44 @@ def calculate_numeric_grade(course, activity, student=None):
     except ValidationError as e:
         raise ValidationError('Formula Error: ' + e.args[0])
 
+    visible = activity.status=="RLS"
+
     if student != None: # calculate for one student
         if not isinstance(student, Member):
             raise TypeError('Member type is required')
-        student_list = [student]
-        numeric_grade_list = NumericGrade.objects.filter(activity=activity, member=student)
-    else: # calculate for all student
-        student_list = Member.objects.filter(offering=course, role='STUD')
-        numeric_grade_list = NumericGrade.objects.filter(activity = activity).select_related('member')
-
-    ignored = 0
-    visible = activity.status=="RLS"
-    for s in student_list:
-        # calculate grade
         try:
-            result = eval_parse(parsed_expr, activity, act_dict, s, visible)
+            result = eval_parse(parsed_expr, activity, act_dict, student, visible)
             result = decimal.Decimal(str(result)) # convert to decimal
         except EvalException:
-            raise EvalException("Formula Error: Can not evaluate formula for student: '%s'" % s.person.name())
+            raise EvalException("Formula Error: Can not evaluate formula for student: '%s'" % student.person.name())
 
         # save grade
-        member_found = False
-        for numeric_grade in numeric_grade_list:
-            if numeric_grade.member == s:
-                member_found = True     
-                if numeric_grade.flag != "CALC":
-                    # ignore manually-set grades
-                    ignored += 1
-                elif result != numeric_grade.value:
-                    # only save when the value changes
-                    numeric_grade.value = result
-                    numeric_grade.flag = "CALC"
-                    numeric_grade.save(newsitem=False, entered_by=None)
-                break
-        if not member_found:
-            numeric_grade = NumericGrade(activity=activity, member=s,
+        numeric_grade = NumericGrade.objects.filter(activity=activity, member=student).first()
+        if not numeric_grade:
+            numeric_grade = NumericGrade(activity=activity, member=student,
                                          value=str(result), flag='CALC')
             numeric_grade.save(newsitem=False, entered_by=None)
+        elif numeric_grade.flag == "CALC" and result != numeric_grade.value:
+            # ignore manually-set grades; only save when the value changes
+            numeric_grade.value = result
+            numeric_grade.save(newsitem=False, entered_by=None)
+
+    else: # calculate for all student
+        student_list = list(Member.objects.filter(offering=course, role='STUD').select_related('person'))
+        # evaluate for the whole class at once, instead of querying each student's grades separately
+        try:
+            results = eval_parse_all(parsed_expr, activity, act_dict, student_list, visible)
+        except EvalException:
+            # find the student with the problem so we can report it
+            for s in student_list:
+                try:
+                    eval_parse(parsed_expr, activity, act_dict, s, visible)
+                except EvalException:
+                    raise EvalException("Formula Error: Can not evaluate formula for student: '%s'" % s.person.name())
+            raise
+
+        results = dict((member_id, _round_calculated(result)) for member_id, result in results.items())
+        ignored = save_calculated_grades(NumericGrade, activity, results, 'value')
 
     uses_unreleased = True in (act_dict[c].status != 'RLS' for c in cols_used(parsed_expr))
     hiding_info = visible and uses_unreleased and not activity.calculation_leak()
@@ -649,3 +745,98 @@ def calculate_numeric_grade(course, activity, student=None):
         return StudentActivityInfo(student, activity, FLAGS['CALC'], numeric_grade.value, None).display_grade_staff(), hiding_info
     else:
         return ignored, hiding_info
+
+
+def _calculated_graph_key(course):
+    return 'grades-calc-graph-%i' % (course.id)
+
+def calculated_activity_graph(course):
+    """
+    Dependency graph of the course's calculated activities: dictionary of activity.id -> list of ids of the
+    calculated activities that use its grades directly (including [[activitytotal]] references).
+
+    Cached: invalidated by invalidate_calculated_activity_graph when any of the offering's activities is saved.
+    Formulas that can't be parsed are ignored.
+    """
+    key = _calculated_graph_key(course)
+    graph = cache.get(key)
+    if graph is not None:
+        return graph
+
+    graph = {}
+    act_dict = activities_dictionary(NumericActivity.objects.filter(offering=course, deleted=False))
+    for calc in CalNumericActivity.objects.filter(offering=course, deleted=False):
+        try:
+            parsed_expr = parse(calc.formula, course, calc)
+        except ParseException:
+            continue
+        used = set(act_dict[c].id for c in cols_used(parsed_expr) if c in act_dict)
+        for act_id in used:
+            graph.setdefault(act_id, []).append(calc.id)
+
+    for calc in CalLetterActivity.objects.filter(offering=course, deleted=False):
+        for act_id in set([calc.numeric_activity_id, calc.exam_activity_id]):
+            if act_id is not None:
+                graph.setdefault(act_id, []).append(calc.id)
+
+    cache.set(key, graph, 3600)
+    return graph
+
+def invalidate_calculated_activity_graph(course):
+    cache.delete(_calculated_graph_key(course))
+
+def dependent_calculated_activities(course, activity):
+    """
+    Calculated activities that (directly or indirectly) use this activity's grades, in an order where each comes after
+    everything it depends on.
+    """
+    graph = calculated_activity_graph(course)
+    order = []
+    visited = set([activity.id])
+    def visit(act_id):
+        for dep_id in graph.get(act_id, []):
+            if dep_id not in visited:
+                visited.add(dep_id)
+                visit(dep_id)
+                order.append(dep_id)
+    visit(activity.id)
+    order.reverse()
+
+    # fetch the activities as their most specific class
+    calc_acts = dict((a.id, a) for a in CalNumericActivity.objects.filter(id__in=order, deleted=False))
+    calc_acts.update((a.id, a) for a in CalLetterActivity.objects.filter(id__in=order, deleted=False))
+    return [calc_acts[act_id] for act_id in order if act_id in calc_acts]
+
+def recalculate_dependent_grades(activity, members):
+    """
+    Recalculate these students' grades on the calculated activities that depend on the activity, after their grades
+    on it changed.
+
+    Only activities the instructor has already calculated (i.e. that have some grades) are updated; as with
+    "calculate all", manually-set grades are left alone. Formulas that can't be evaluated are skipped: the problem will
+    be reported when the instructor calculates.
+
+    Each formula is parsed once, and only these students' grades are fetched, so the work is proportional to the number
+    of students changed, not the size of the class.
+    """
+    course = activity.offering
+    numeric_activities = list(NumericActivity.objects.filter(offering=course, deleted=False))
+    act_dict = activities_dictionary(numeric_activities)
+    member_ids = [m.id for m in members]
+    for calc in dependent_calculated_activities(course, activity):
+        if not calc.GradeClass.objects.filter(activity=calc).exists():
+            continue
+
+        if isinstance(calc, CalNumericActivity):
+            try:
+                parsed_expr = parse_and_validate_formula(calc.formula, course, calc, numeric_activities)
+                evaluate = compile_parse(parsed_expr, calc, act_dict, calc.status == "RLS")
+                grades = grade_matrix(set(act_dict[label] for label in cols_used(parsed_expr)), member_ids)
+                values = evaluate(member_ids, grades)
+            except (ValidationError, EvalException):
+                continue
+            results = dict((member_id, _round_calculated(v)) for member_id, v in zip(member_ids, values))
+            save_calculated_grades(NumericGrade, calc, results, 'value')
+        else:
+            results = dict((m.id, generate_lettergrades(m, calc)) for m in members)
+            save_calculated_grades(LetterGrade, calc, results, 'letter_grade')
@@ -20,6 +20,7 @@ from coredata.models import Member, CourseOffering, Person, Semester, Role
 from courselib.auth import ForbiddenResponse, NotFoundResponse, is_course_student_by_slug
 from courselib.auth import is_course_staff_by_slug, requires_course_staff_by_slug
 from courselib.search import find_member
+from courselib.streaming import streaming_csv_response, streaming_zip_response, ZipStream
 from forum.models import Forum
 
 from grades.models import all_activities_filter
@@ -31,6 +32,7 @@ from grades.forms import NumericActivityForm, LetterActivityForm, CalNumericActi
 from grades.forms import ActivityFormEntry, FormulaFormEntry, StudentSearchForm, FORMTYPE
 from grades.forms import GROUP_STATUS_MAP, CourseConfigForm, CalLetterActivityForm, CutoffForm
 from grades.formulas import EvalException, activities_dictionary, eval_parse
+from grades.gradebook import GradebookMatrix
 from grades.utils import reorder_course_activities
 from grades.utils import ORDER_TYPE, FormulaTesterActivityEntry, FakeActivity, FakeEvalActivity
 from grades.utils import generate_numeric_activity_stat,generate_letter_activity_stat
@@ -1171,95 +1173,58 @@ def add_letter_activity(request, course_slug):
 @requires_course_staff_by_slug
 def all_grades(request, course_slug):
     course = get_object_or_404(CourseOffering, slug=course_slug)
-    activities = all_activities_filter(offering=course)
-    students = Member.objects.filter(offering=course, role="STUD").select_related('person', 'offering')
-    
-    # get grade data into a format we can work with
-    grades = {}
-    for a in activities:
-        grades[a.slug] = {}
-        if hasattr(a, 'numericgrade_set'):
-            gs = a.numericgrade_set.all().select_related('member', 'member__person')
-        else:
-            gs = a.lettergrade_set.all().select_related('member', 'member__person')
-        for g in gs:
-            grades[a.slug][g.member.person.userid] = g
+    gradebook = GradebookMatrix(course)
+    gradebook.load_comments()
 
-    context = {'course': course, 'students': students, 'activities': activities, 'grades': grades}
+    context = {'course': course, 'activities': gradebook.activities, 'rows': gradebook.rows()}
     return render(request, 'grades/all_grades.html', context)
 
 
-def _all_grades_output(response, course):
-    activities = all_activities_filter(offering=course)
-    students = Member.objects.filter(offering=course, role="STUD").select_related('person')
+def _all_grades_rows(course):
+    """
+    Generate the rows of the all-grades CSV
+    """
+    gradebook = GradebookMatrix(course)
+    activities = gradebook.activities
 
-    # get grade data into a format we can work with
     labtut = course.labtut
-    grades = {}
-    for a in activities:
-        grades[a.slug] = {}
-        if hasattr(a, 'numericgrade_set'):
-            gs = a.numericgrade_set.all().select_related('member', 'member__person')
-        else:
-            gs = a.lettergrade_set.all().select_related('member', 'member__person')
-        for g in gs:
-            grades[a.slug][g.member.person.userid] = g
-    
-    # output results
-    writer = csv.writer(response)
     row = ['Last name', 'First name', Person.userid_header(), Person.emplid_header()]
     if labtut:
         row.append('Lab/Tutorial')
     for a in activities:
         row.append(a.short_name)
-    writer.writerow(row)
+    yield row
     
-    for s in students:
+    for s, cells in gradebook.rows():
         row = [s.person.last_name, s.person.first_with_pref(), s.person.userid, s.person.emplid]
         if labtut:
             row.append(s.labtut_section or '')
-        for a in activities:
-            try:
-                gr = grades[a.slug][s.person.userid]
-                if gr.flag=='NOGR':
-                    g = ''
-                else:
-                    if a.is_numeric():
-                        g = gr.value
-                    else:
-                        g = gr.letter_grade
-            except KeyError:
-                g = ''
-            row.append(g)
-        writer.writerow(row)
+        for cell in cells:
+            row.append(cell.export_value() if cell else '')
+        yield row
+
+
+def _all_grades_output(response, course):
+    writer = csv.writer(response)
+    writer.writerows(_all_grades_rows(course))
+
 
 @requires_course_staff_by_slug
 def all_grades_csv(request, course_slug):
     course = get_object_or_404(CourseOffering, slug=course_slug)
-    
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="%s.csv"' % (course_slug)
-    
-    _all_grades_output(response, course)        
-    return response
+    return streaming_csv_response(_all_grades_rows(course), '%s.csv' % (course_slug))
 
 
-@requires_course_staff_by_slug
-def grade_history(request, course_slug):
-    """
-    Dump all GradeHistory for the offering to a CSV
-    """
-    offering = get_object_or_404(CourseOffering, slug=course_slug)
+# number of GradeHistory objects to fetch from the database at once
+HISTORY_CHUNK_SIZE = 2000
 
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'inline; filename="%s-history.csv"' % (course_slug,)
-    writer = csv.writer(response)
-    writer.writerow(['Date/Time', 'Activity', 'Student', 'Entered By', 'Numeric Grade', 'Letter Grade', 'Status', 'Group'])
+def _grade_history_rows(offering):
+    yield ['Date/Time', 'Activity', 'Student', 'Entered By', 'Numeric Grade', 'Letter Grade', 'Status', 'Group']
 
     grade_histories = GradeHistory.objects.filter(activity__offering=offering, status_change=False) \
         .select_related('entered_by', 'activity', 'member__person', 'group')
-    for gh in grade_histories:
-        writer.writerow([
+    for gh in grade_histories.iterator(chunk_size=HISTORY_CHUNK_SIZE):
+        yield [
             gh.timestamp,
             gh.activity.short_name,
             gh.member.person.userid_or_emplid(),
@@ -1268,9 +1233,16 @@ def grade_history(request, course_slug):
             gh.letter_grade,
             FLAGS.get(gh.grade_flag, None),
             gh.group.slug if gh.group else None,
-        ])
+        ]
 
-    return response
+
+@requires_course_staff_by_slug
+def grade_history(request, course_slug):
+    """
+    Dump all GradeHistory for the offering to a CSV
+    """
+    offering = get_object_or_404(CourseOffering, slug=course_slug)
+    return streaming_csv_response(_grade_history_rows(offering), '%s-history.csv' % (course_slug,), disposition='inline')
 
 
 @requires_course_staff_by_slug
@@ -1482,58 +1454,51 @@ def export_all(request, course_slug):
     """
     Export everything we can about this offering
     """
-    import io, tempfile, zipfile, os, json
-    from django.http import StreamingHttpResponse
-    from wsgiref.util import FileWrapper
+    import io, os, json
     from marking.views import _mark_export_data, _DecimalEncoder
     from discuss.models import DiscussionTopic
 
     course = get_object_or_404(CourseOffering, slug=course_slug)
-
-    handle, filename = tempfile.mkstemp('.zip')
-    os.close(handle)
-    z = zipfile.ZipFile(filename, 'w')
+    # the archive is built as it's sent: each part is generated when the download gets to it
+    z = ZipStream()
 
     # add all grades CSV
-    allgrades = io.StringIO()
-    _all_grades_output(allgrades, course)    
-    z.writestr("grades.csv", allgrades.getvalue())
-    allgrades.close()
-    
+    def add_grades():
+        allgrades = io.StringIO()
+        _all_grades_output(allgrades, course)
+        z.writestr("grades.csv", allgrades.getvalue())
+    z.defer(add_grades)
+
     # add marking data
-    acts = all_activities_filter(course)
-    for a in acts:
+    def add_marking(a):
         if ActivityComponent.objects.filter(numeric_activity_id=a.id):
             markingdata = _mark_export_data(a)
             markout = io.StringIO()
             json.dump({'marks': markingdata}, markout, cls=_DecimalEncoder, indent=1)
             z.writestr(a.slug + "-marking.json", markout.getvalue())
-            del markout, markingdata
-    
-    # add submissions
+
     acts = all_activities_filter(course)
     for a in acts:
+        z.defer(add_marking, a)
+
+    # add submissions
+    def add_submissions(a):
         submission_info = SubmissionInfo.for_activity(a)
         submission_info.get_all_components()
         submission_info.generate_submission_contents(z, prefix=a.slug+'-submissions' + os.sep, always_summary=False)
 
+    for a in acts:
+        z.defer(add_submissions, a)
+
     # add discussion
-    if course.discussion():
+    def add_discussion():
         topics = DiscussionTopic.objects.filter(offering=course).order_by('-pinned', '-last_activity_at')
         discussion_data = [t.exportable() for t in topics]
         discussout = io.StringIO()
         json.dump(discussion_data, discussout, indent=1)
         z.writestr("discussion.json", discussout.getvalue())
-        del discussion_data, discussout
-
-    # return the zip file
-    z.close()
-    zipdata = open(filename, 'rb')
-    response = StreamingHttpResponse(FileWrapper(zipdata), content_type='application/zip')
-    response['Content-Length'] = os.path.getsize(filename)    
-    response['Content-Disposition'] = 'attachment; filename="' + course.slug + '.zip"'
-    try:
-        os.remove(filename)
-    except OSError:
-        pass
-    return response
+
+    if course.discussion():
+        z.defer(add_discussion)
+
+    return streaming_zip_response(z, course.slug + '.zip')
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from pages.models import Page, PageVersion, KEYFRAME_INTERVAL
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the stored versions of pages so every old version is one diff from a full-text keyframe.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--offering', help='slug of the offering to repack (default: all)')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        pages = Page.objects.order_by('id')
+        if options['offering']:
+            pages = pages.filter(offering__slug=options['offering'])
+
+        for page in pages.iterator():
+            versions = PageVersion.objects.filter(page=page).exclude(wikitext='', diff_from__isnull=True) \
+                .order_by('-created_at')
+            if options['dry_run']:
+                chained = versions.filter(diff_from__isnull=False, diff_from__diff_from__isnull=False).count()
+                if chained:
+                    self.stdout.write("%s: %i versions in diff chains" % (page, chained))
+                continue
+
+            with transaction.atomic():
+                keyframe = None
+                count = 0
+                diffs = 0
+                # newest to oldest, as PageVersion.diff_to would have built them
+                for v in versions:
+                    if count + 1 >= KEYFRAME_INTERVAL:
+                        keyframe.set_depth(count)
+                        keyframe.save(minor_change=True)
+                        keyframe = None
+                    if v.repack_as(keyframe):
+                        count += 1
+                        diffs += 1
+                    else:
+                        if keyframe is not None:
+                            keyframe.set_depth(count)
+                            keyframe.save(minor_change=True)
+                        keyframe = v
+                        count = 0
+                if keyframe is not None:
+                    keyframe.set_depth(count)
+                    keyframe.save(minor_change=True)
+            self.stdout.write("%s: %i versions, %i stored as diffs" % (page, versions.count(), diffs))
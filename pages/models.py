@@ -4,7 +4,7 @@ from django.utils.safestring import mark_safe
 from django.core.cache import cache
 from django.urls import reverse
 from coredata.models import CourseOffering, Member, Person
-from grades.models import Activity
+from grades.models import connect_activity_signal
 
 from courselib.json_fields import JSONField
 from courselib.json_fields import getter_setter
@@ -12,7 +12,7 @@ from courselib.text import normalize_newlines
 from courselib.storage import UploadedFileStorage, upload_path
 from courselib.markup import markup_to_html, ensure_sanitary_markup
 import pytz
-import os, datetime, re, difflib, json, uuid
+import os, datetime, re, difflib, json, uuid, time, zlib, base64
 
 WRITE_ACL_CHOICES = [
     ('NONE', 'nobody'),
@@ -41,6 +41,7 @@ ACL_ROLES = { # reverse of MEMBER_ROLES: what ACLs is this Member allowed to acc
         }
 
 MACRO_LABEL = 'MACROS' # special page that contain macro expansions for other pages
+KEYFRAME_INTERVAL = 10 # store full text for (at least) every this-many versions of a page
 
 label_re = re.compile(r"^[\w\-_\.]+$")
 macroline_re = re.compile(r"^(?P<key>\w+):\s*(?P<value>.*)\s*$")
@@ -50,6 +51,56 @@ def attachment_upload_to(instance, filename):
     return upload_path(instance.page.offering.slug, '_pagefiles', filename)
 
 
+def _offering_generation_key(offering_id):
+    return "page-generation-%i" % (offering_id,)
+
+def offering_cache_generation(offering_id):
+    """
+    The current generation of the offering's cached page content: it's part of the cache keys, so incrementing it
+    expires everything cached for the offering's pages at once.
+    """
+    key = _offering_generation_key(offering_id)
+    gen = cache.get(key)
+    if gen is None:
+        # start from the clock, so a counter that has been evicted from the cache doesn't reuse old generations
+        gen = int(time.time() * 1000)
+        if not cache.add(key, gen, None):
+            gen = cache.get(key, gen)
+    return gen
+
+def expire_offering_pages(offering_id):
+    """
+    Expire all cached HTML and macros for the offering's pages: one cache operation, however many pages there are.
+    """
+    key = _offering_generation_key(offering_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # no generation yet: nothing cached under it
+        cache.add(key, int(time.time() * 1000), None)
+
+
+COMPRESSED_DIFF_PREFIX = 'z:'
+
+def encode_diff(diff):
+    """
+    Compact encoding of a JSON list of changes for PageVersion.diff: zlib-compressed and base64-encoded if that's
+    shorter than the JSON itself.
+    """
+    compressed = COMPRESSED_DIFF_PREFIX + base64.b64encode(zlib.compress(diff.encode('utf-8'), 9)).decode('ascii')
+    if len(compressed) < len(diff):
+        return compressed
+    return diff
+
+def decode_changes(diff):
+    """
+    Decode a PageVersion.diff produced by encode_diff (or stored as plain JSON by older code) to a list of changes.
+    """
+    if diff.startswith(COMPRESSED_DIFF_PREFIX):
+        diff = zlib.decompress(base64.b64decode(diff[len(COMPRESSED_DIFF_PREFIX):])).decode('utf-8')
+    return json.loads(diff)
+
+
 class Page(models.Model):
     """
     A page in this courses "web site". Actual data is versioned in PageVersion objects.
@@ -114,16 +165,13 @@ class Page(models.Model):
         return "page-curver-" + str(self.id)
 
     def macro_cache_key(self):
-        return "MACROS-" + str(self.offering_id)
+        return "MACROS-%i-%i" % (self.offering_id, offering_cache_generation(self.offering_id))
 
     def expire_offering_cache(self):
         # invalidate cache for all pages in this offering: makes sure current page, and all <<filelist>> are up to date
-        for pv in PageVersion.objects.filter(page__offering=self.offering):
-            cache.delete(pv.html_cache_key())
-            cache.delete(pv.wikitext_cache_key())
+        expire_offering_pages(self.offering_id)
         # other cache cleanup
         cache.delete(self.version_cache_key())
-        cache.delete(self.macro_cache_key())
 
     def label_okay(self, label):
         """
@@ -210,7 +258,7 @@ class PageVersion(models.Model):
         # p.config['math']: page uses MathJax? (boolean)
         # p.config['syntax']: page uses SyntaxHighlighter? (boolean) -- no longer used with highlight.js
         # p.config['brushes']: used SyntaxHighlighter brushes (list of strings) -- no longer used with highlight.js
-        # p.config['depth']: max depth of diff pages below me (to keep it within reason)
+        # p.config['depth']: number of versions stored as diffs based on me (if I'm a keyframe)
         # p.config['redirect_reason']: if present, how this redirect got here: 'rename' or 'delete'.
 
     defaults = {
@@ -224,7 +272,10 @@ class PageVersion(models.Model):
     redirect_reason, set_redirect_reason = getter_setter('redirect_reason')
 
     def html_cache_key(self):
-        return "page-html-" + str(self.id)
+        if self.page_id:
+            return "page-html-%s-%i" % (self.id, offering_cache_generation(self.page.offering_id))
+        else:
+            return "page-html-" + str(self.id)
     def wikitext_cache_key(self):
         return "page-wikitext-" + str(self.id)
 
@@ -232,17 +283,17 @@ class PageVersion(models.Model):
         """
         Return this version's markup (reconstructing from diffs if necessary).
         
-        Caches when reconstructing from diffs
+        Diffs are based on a keyframe version that has its full text, so that's one lookup (unless the page has old
+        chains of diffs that haven't been repacked). Caches when reconstructing from diffs.
         """
-        if self.diff_from:
+        if self.diff_from_id:
             key = self.wikitext_cache_key()
             wikitext = cache.get(key)
             if wikitext:
                 return str(wikitext)
             else:
                 src = self.diff_from
-                diff = json.loads(self.diff)
-                wikitext = src.apply_changes(diff)
+                wikitext = src.apply_changes(decode_changes(self.diff))
                 cache.set(key, wikitext, 24*3600) # no need to expire: shouldn't change for a version
                 return str(wikitext)
 
@@ -270,8 +321,12 @@ class PageVersion(models.Model):
         is a tuple containing:
           (type flag, position of change, [other info need to reconstrut original])
         """
-        lines1 = self.get_wikitext().split("\n")
-        lines2 = other.get_wikitext().split("\n")
+        return PageVersion._text_changes(self.get_wikitext(), other.get_wikitext())
+
+    @staticmethod
+    def _text_changes(text1, text2):
+        lines1 = text1.split("\n")
+        lines2 = text2.split("\n")
         
         matcher = difflib.SequenceMatcher()
         matcher.set_seqs(lines1, lines2)
@@ -292,6 +347,16 @@ class PageVersion(models.Model):
         
         return changes
 
+    @staticmethod
+    def _text_diff(text1, text2):
+        """
+        Encoded diff to get from text1 to text2, or None if it's a big change and not worth storing as a diff.
+        """
+        diff = json.dumps(PageVersion._text_changes(text1, text2), separators=(',',':'))
+        if len(diff) > len(text2):
+            return None
+        return encode_diff(diff)
+
     def apply_changes(self, changes):
         """
         Apply changes to this wikitext
@@ -319,33 +384,80 @@ class PageVersion(models.Model):
     def diff_to(self, other):
         """
         Turn this version into a diff based on the other version (if apprpriate).
+
+        Versions that were diffs based on this one are re-based on other, so every version is at most one diff from
+        a keyframe with its full text. Once KEYFRAME_INTERVAL versions would share a keyframe, this version is left
+        alone to be the next keyframe.
+
+        Doesn't expire the offering's page cache: the caller (i.e. other.save) does that once for the whole edit.
         """
         if not self.wikitext or self.diff_from:
             # must already be a diff: don't repeat ourselves
             return
-        if self.depth() > 10:
-            # don't let the chain of diffs get too long
+        based = list(PageVersion.objects.filter(diff_from=self))
+        if len(based) + 1 >= KEYFRAME_INTERVAL:
+            # enough versions depend on this one: keep it as a keyframe
             return
-                
+
         oldw = self.wikitext
+        neww = other.get_wikitext()
 
-        diff = json.dumps(other.changes(self), separators=(',',':'))
-        if len(diff) > len(oldw):
+        diff = PageVersion._text_diff(neww, oldw)
+        if diff is None:
             # if it's a big change, don't bother.
             return
 
+        depth = 1
+        for v in based:
+            w = v.get_wikitext()
+            d = PageVersion._text_diff(neww, w)
+            if d is None:
+                # drifted too far from other: store the full text instead
+                v.wikitext = w
+                v.diff = None
+                v.diff_from = None
+            else:
+                v.diff = d
+                v.diff_from = other
+                depth += 1
+        # texts and diffs were produced by get_wikitext/_text_diff, so don't need save()'s normalizing and sanitizing
+        PageVersion.objects.bulk_update(based, ['diff', 'diff_from', 'wikitext'])
+
         self.diff = diff
         self.diff_from = other
         self.wikitext = ''
-        self.save(check_diff=False) # save but don't go back for more diffing
+        self.set_depth(0)
+        self.save(check_diff=False, expire_cache=False) # save but don't go back for more diffing
+
+        other.set_depth(depth)
+        other.save(minor_change=True, expire_cache=False)
 
-        other.set_depth(max(self.depth()+1, other.depth()))
-        other.save(minor_change=True)
+        assert oldw == self.get_wikitext()
+
+    def repack_as(self, keyframe):
+        """
+        Store this version as a diff based on keyframe (or as full text if keyframe is None or a diff would be too big).
+        Returns True if it was stored as a diff.
 
-        neww = self.get_wikitext()
-        assert oldw==neww
+        Used to rebuild the keyframes for pages with older chains of diffs (by the repack_pages management command).
+        """
+        text = self.get_wikitext()
+        diff = None
+        if keyframe is not None:
+            diff = PageVersion._text_diff(keyframe.get_wikitext(), text)
+
+        if diff is None:
+            self.wikitext = text
+            self.diff = None
+            self.diff_from = None
+        else:
+            self.wikitext = ''
+            self.diff = diff
+            self.diff_from = keyframe
+        self.save(check_diff=False)
+        return diff is not None
 
-    def save(self, check_diff=True, minor_change=False, *args, **kwargs):
+    def save(self, check_diff=True, minor_change=False, expire_cache=True, *args, **kwargs):
         # check coherence of the data model: exactly one of full text, diff text, file, redirect.
         if not minor_change:
             # minor_change flag set when .diff_to has changed the .config only
@@ -371,7 +483,8 @@ class PageVersion(models.Model):
             if prev:
                 prev.diff_to(self)
 
-        self.page.expire_offering_cache()
+        if expire_cache:
+            self.page.expire_offering_cache()
 
     def __str__(self):
         return str(self.page) + '@' + str(self.created_at)
@@ -450,17 +563,12 @@ def clear_offering_cache(instance, **kwargs):
     Saving an activity might change HTML contents of any PageVersion, since they might
     contain <<duedate>> macros: invalidate all cached copies to be safe.
     """
-    if not isinstance(instance, Activity):
-        return
-    if not hasattr(instance, 'offering'):
+    if not instance.offering_id:
         # doesn't have an offering set yet: can't be a problem. Right?
         return
+    expire_offering_pages(instance.offering_id)
 
-    for pv in PageVersion.objects.filter(page__offering=instance.offering):
-        key = pv.html_cache_key()
-        cache.delete(key)
-
-models.signals.post_save.connect(clear_offering_cache)
+connect_activity_signal(models.signals.post_save, clear_offering_cache)
 
 
 class PagePermission(models.Model):
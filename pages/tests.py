@@ -2,12 +2,18 @@
 from django.test import TestCase
 from django.urls import reverse
 from django.utils.safestring import mark_safe, SafeText
-from pages.models import Page, PageVersion, MACRO_LABEL, PagePermission
+from pages.models import Page, PageVersion, MACRO_LABEL, PagePermission, KEYFRAME_INTERVAL
 from coredata.models import CourseOffering, Member, Person
-from grades.models import Activity
+from grades.models import Activity, NumericActivity
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from courselib.testing import TEST_COURSE_SLUG, Client, test_views
 from courselib.markup import ParserFor, markup_to_html
-import re
+from io import StringIO
+import re, json
+from unittest import mock
 
 wikitext = """Some Python code:
 {{{ [python]
@@ -151,6 +157,69 @@ class PagesTest(TestCase):
         self.assertEqual(v3.wikitext, contents3)
         self.assertEqual(v3.diff_from, None)
 
+    def test_version_keyframes(self):
+        "Test that old versions are all one diff from a keyframe, and the repack_pages command."
+        cache.clear()
+        crs = CourseOffering.objects.get(slug=TEST_COURSE_SLUG)
+        memb = Member.objects.get(offering=crs, person__userid="ggbaker")
+        p = Page(offering=crs, label="Test")
+        p.save()
+        lines = ["Line %i of a long enough page that diffs are worthwhile." % (i) for i in range(20)]
+        contents = []
+        for i in range(25):
+            lines[i % 20] += " Edited."
+            contents.append("\n".join(lines))
+            PageVersion(page=p, title="T%i" % (i), wikitext=contents[-1], editor=memb, comment="edit").save()
+
+        cache.clear()
+        versions = list(PageVersion.objects.filter(page=p).order_by('created_at').select_related('diff_from'))
+        self.assertEqual([v.get_wikitext() for v in versions], contents)
+        keyframes = [v for v in versions if not v.diff_from]
+        self.assertEqual(len(keyframes), 3)
+        self.assertEqual(keyframes[-1], versions[-1])
+        for v in versions:
+            if v.diff_from:
+                self.assertEqual(v.diff_from.diff_from, None)
+        self.assertTrue(all(len([v for v in versions if v.diff_from == k]) < KEYFRAME_INTERVAL for k in keyframes))
+
+        # older chains of diffs (with JSON encoding) still work, and can be repacked
+        for prev, v, text, newtext in zip(versions, versions[1:], contents, contents[1:]):
+            prev.wikitext = ''
+            prev.diff = json.dumps(PageVersion._text_changes(newtext, text))
+            prev.diff_from = v
+        for v in versions[:-1]:
+            v.save(check_diff=False)
+        cache.clear()
+        versions = list(PageVersion.objects.filter(page=p).order_by('created_at'))
+        self.assertEqual([v.get_wikitext() for v in versions], contents)
+
+        call_command('repack_pages', offering=crs.slug, stdout=StringIO())
+        cache.clear()
+        versions = list(PageVersion.objects.filter(page=p).order_by('created_at').select_related('diff_from'))
+        self.assertEqual([v.get_wikitext() for v in versions], contents)
+        self.assertEqual(len([v for v in versions if not v.diff_from]), 3)
+        self.assertTrue(all(v.diff_from.diff_from is None for v in versions if v.diff_from))
+
+        # an edit re-bases the older versions in one UPDATE, and expires the page cache once
+        p = Page(offering=crs, label="Test2")
+        p.save()
+        for i in range(4):
+            lines[i] += " Edited again."
+            PageVersion(page=p, title="T%i" % (i), wikitext="\n".join(lines), editor=memb, comment="edit").save()
+        head = PageVersion.objects.filter(page=p).latest('created_at')
+        self.assertEqual(PageVersion.objects.filter(diff_from=head).count(), 3)
+
+        lines[4] += " Edited again."
+        with CaptureQueriesContext(connection) as queries, \
+                mock.patch('pages.models.Page.expire_offering_cache') as expire_offering_cache:
+            PageVersion(page=p, title="T4", wikitext="\n".join(lines), editor=memb, comment="edit").save()
+        expire_offering_cache.assert_called_once()
+        updates = [q for q in queries.captured_queries if q['sql'].startswith('UPDATE "pages_pageversion"')]
+        self.assertEqual(len(updates), 3) # re-based versions, the newly-diffed version, and the new keyframe's depth
+        self.assertEqual(PageVersion.objects.filter(page=p, diff_from__diff_from__isnull=False).count(), 0)
+        cache.clear()
+        self.assertEqual(PageVersion.objects.filter(page=p).latest('created_at').get_wikitext(), "\n".join(lines))
+
     def test_api(self):
         crs = CourseOffering.objects.get(slug=TEST_COURSE_SLUG)
         memb = Member.objects.get(offering=crs, person__userid="ggbaker")
@@ -384,6 +453,32 @@ class PagesTest(TestCase):
         self.assertEqual(p.current_version().html_contents().strip(), "<p>one +two+ three +four+</p>")
 
 
+    def test_cache_expiry(self):
+        """
+        Test that saving an activity expires the offering's cached HTML, without touching each version
+        """
+        crs = CourseOffering.objects.get(slug=TEST_COURSE_SLUG)
+        memb = Member.objects.get(offering=crs, person__userid="ggbaker")
+        p = Page(offering=crs, label="Index")
+        p.save()
+        v = PageVersion(page=p, title="Index Page", wikitext="one two", editor=memb)
+        v.save()
+        html = v.html_contents()
+        key = v.html_cache_key()
+        self.assertEqual(cache.get(key), html)
+
+        # other models don't matter
+        memb.save()
+        self.assertEqual(v.html_cache_key(), key)
+
+        a = NumericActivity.objects.filter(offering=crs).first()
+        with CaptureQueriesContext(connection) as queries:
+            a.save()
+        self.assertFalse([q for q in queries if 'pages_pageversion' in q['sql']])
+        self.assertNotEqual(v.html_cache_key(), key)
+        self.assertIsNone(cache.get(v.html_cache_key()))
+        self.assertEqual(v.html_contents(), html)
+
     def test_redirect(self):
         """
         Redirecting with redirect stub
@@ -230,7 +230,9 @@ def page_history(request, course_slug, page_label):
     if not member:
         return _forbidden_response(request, page.get_can_write_display())
     
-    versions = PageVersion.objects.filter(page=page).order_by('-created_at')
+    # diffs are based on a keyframe with full text, so fetching it with each version is enough to reconstruct them
+    versions = PageVersion.objects.filter(page=page).order_by('-created_at') \
+        .select_related('editor__person', 'diff_from')
     
     context = {'offering': offering, 'page': page, 'versions': versions}
     return render(request, 'pages/page_history.html', context)
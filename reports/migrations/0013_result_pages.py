@@ -0,0 +1,27 @@
+# Generated by Django 4.2.23 on 2026-10-17 12:44
+
+import courselib.json_fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0012_trivial_migration_updates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResultPage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField()),
+                ('rows', courselib.json_fields.JSONField(default=list)),
+                ('result', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='reports.result')),
+            ],
+            options={
+                'unique_together': {('result', 'number')},
+            },
+        ),
+    ]
@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction, connection
 from django.conf import settings
 from coredata.models import Role, Person, Unit, ROLE_CHOICES
 from courselib.json_fields import JSONField
@@ -9,17 +9,20 @@ from django.urls import reverse
 from .cache import clear_cache
 
 import datetime
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 import os
 import sys
-import copy
 import traceback
 import string
 import importlib
 
 from .reportlib import DB2_Query
+from .reportlib.query import shared_queries
 from .reportlib.table import Table
 
 REPORT_LOCATION = os.path.join( settings.BASE_DIR, 'reports', 'reportlib', 'reports' )
+RESULT_PAGE_SIZE = 1000 # rows per ResultPage, and per page when viewing a result
 
 class Report(models.Model):
     """ 
@@ -55,10 +58,11 @@ class Report(models.Model):
         queries = Query.objects.filter(report=self)
 
         runs = []
-        for report in hardcoded_reports:
-            runs.append(report.run(manual=manual))
-        for query in queries:
-            runs.append(query.run(manual=manual))
+        with shared_queries():
+            for report in hardcoded_reports:
+                runs.append(report.run(manual=manual))
+            for query in queries:
+                runs.append(query.run(manual=manual))
         
         for rule in self.expired_schedule_rules():
             rule.set_next_run()
@@ -151,11 +155,7 @@ class HardcodedReport(models.Model):
             report_object.run()
             for artifact in report_object.artifacts:
                 artifact.convert_to_unicode()
-                try:
-                    result = Result(run=r, name=artifact.title, table=artifact.to_dict() )
-                except AttributeError:
-                    result = Result(run=r, table=artifact.to_dict() ) 
-                result.save()
+                Result.create(run=r, table=artifact, name=getattr(artifact, 'title', None))
             r.success = True
             r.save()
         except Exception as e:
@@ -186,8 +186,7 @@ class Query(models.Model):
             q.query = string.Template(self.query)
             artifact = q.result()
             artifact.convert_to_unicode()
-            result = Result(run=r, name=self.name, table=artifact.to_dict() )
-            result.save()
+            Result.create(run=r, table=artifact, name=self.name)
             r.success = True
             r.save()
         except Exception as e:
@@ -319,12 +318,40 @@ class ScheduleRule(models.Model):
                 self.set_next_run()
 
 
+def _run_report_in_thread(report, shared):
+    try:
+        with shared_queries(shared):
+            return report.run()
+    finally:
+        # this thread's database connection won't be used again
+        connection.close()
+
+
+def run_reports(reports, workers=None):
+    """
+    Run the reports, up to settings.REPORT_WORKERS at a time, each in its own thread. Identical queries made by
+    different reports are only run once.
+    """
+    if workers is None:
+        workers = getattr(settings, 'REPORT_WORKERS', 4)
+    with shared_queries() as shared:
+        if workers <= 1 or len(reports) <= 1:
+            for report in reports:
+                report.run()
+            return
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_run_report_in_thread, report, shared) for report in reports]
+        for f in futures:
+            # re-raise any exception that escaped a report's run
+            f.result()
+
+
 def schedule_ping():
-    rules = ScheduleRule.objects.filter(next_run__lte=datetime.datetime.now())
+    rules = ScheduleRule.objects.filter(next_run__lte=datetime.datetime.now()).select_related('report')
     reports = [rule.report for rule in rules]
     set_of_reports_that_need_to_be_run = set(reports)
-    for report in set_of_reports_that_need_to_be_run:
-        report.run()
+    run_reports(sorted(set_of_reports_that_need_to_be_run, key=lambda r: r.id))
     clear_cache()
 
 
@@ -383,17 +410,79 @@ class Result(models.Model):
     cached_table = None
     cached_summary = None
 
+    @classmethod
+    @transaction.atomic
+    def create(cls, run, table, name=None):
+        """
+        Store the reportlib.table.Table as a new Result: the headers and row count in self.table, and the rows in
+        ResultPages of RESULT_PAGE_SIZE rows.
+        """
+        result = cls(run=run)
+        if name is not None:
+            result.name = name
+        result.table = {'headers': list(table.headers), 'row_count': len(table)}
+        result.save()
+
+        rows = table.iter_rows()
+        number = 0
+        while True:
+            page = [list(r) for r in itertools.islice(rows, RESULT_PAGE_SIZE)]
+            if not page:
+                break
+            ResultPage(result=result, number=number, rows=page).save()
+            number += 1
+        return result
+
+    @property
+    def headers(self):
+        return self.table['headers']
+
+    @property
+    def row_count(self):
+        if 'rows' in self.table:
+            # stored before results were paged: all rows are in self.table
+            return len(self.table['rows'])
+        return self.table['row_count']
+
+    @property
+    def page_count(self):
+        return max(1, -(-self.row_count // RESULT_PAGE_SIZE))
+
+    def page_rows(self, number):
+        """ The rows on page number (counting from 0) of the result. """
+        if 'rows' in self.table:
+            return self.table['rows'][number*RESULT_PAGE_SIZE:(number+1)*RESULT_PAGE_SIZE]
+        rows = ResultPage.objects.filter(result=self, number=number).values_list('rows', flat=True).first()
+        return rows or []
+
+    def iter_rows(self):
+        """ Iterate through all of the rows in the result, loading them a page at a time. """
+        if 'rows' in self.table:
+            yield from self.table['rows']
+            return
+        for n in range(self.page_count):
+            yield from self.page_rows(n)
+
     def table_rendered(self):
         """ Return the result as a reportlib.table.Table """
         if not self.cached_table:
-            self.cached_table = Table.from_dict(self.table)
+            self.cached_table = Table.from_rows(self.headers, self.iter_rows())
         return self.cached_table
     
     def table_summary(self):
         """ Return the result as a reportlib.table.Table, but with only 5 rows. """
-        if not self.cached_table:
-            self.cached_table = Table.from_dict(self.table)
         if not self.cached_summary:
-            self.cached_summary = copy.deepcopy(self.cached_table)
-            self.cached_summary.rows = self.cached_summary.rows[0:5]
+            self.cached_summary = Table.from_rows(self.headers, self.page_rows(0)[:5])
         return self.cached_summary
+
+
+class ResultPage(models.Model):
+    """
+    A page of RESULT_PAGE_SIZE rows of a Result.
+    """
+    result = models.ForeignKey(Result, on_delete=models.CASCADE)
+    number = models.PositiveIntegerField()
+    rows = JSONField(null=False, blank=False, default=list)
+
+    class Meta:
+        unique_together = [('result', 'number')]
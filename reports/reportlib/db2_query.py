@@ -4,6 +4,7 @@ from coredata.queries import SIMSProblem
 
 from . import semester
 import datetime
+import threading
 
 class Unescaped(str):
     """ This string won't be escaped when used as an argument.
@@ -28,7 +29,8 @@ class NotConnected(Exception):
 
 class DB2_Query(Query):
     
-    db = False
+    # each thread has its own connection (set by connect): connections can't be shared between threads
+    _connection = threading.local()
     
     @staticmethod
     def connect():
@@ -44,13 +46,14 @@ class DB2_Query(Query):
         import pyodbc
         dbconn = pyodbc.connect("DRIVER={FreeTDS};SERVER=%s;PORT=1433;DATABASE=%s;Trusted_Connection=Yes"
                                 % (settings.SIMS_DB_SERVER, settings.SIMS_DB_NAME))
-        DB2_Query.db = dbconn
+        DB2_Query._connection.db = dbconn
 
 
     def __init__(self, query_args={}):
-        if not self.db:
+        db = getattr(DB2_Query._connection, 'db', None)
+        if not db:
             raise NotConnected("Please call DB2_Query.connect before creating any DB2 query objects.")
-        super(DB2_Query, self).__init__(self.db, DB2_Query.clean_input, DB2_Query.clean_output, query_args)
+        super(DB2_Query, self).__init__(db, DB2_Query.clean_input, DB2_Query.clean_output, query_args)
 
     def result(self):
         return super(DB2_Query, self).result()
@@ -1,6 +1,9 @@
 import time 
+import contextlib
+import contextvars
 import copy
-import json
+import hashlib
+import threading
 import datetime
 import pytz
 import os
@@ -12,6 +15,11 @@ from django.conf import settings
 
 no_function = lambda x: x
 
+CACHE_EXTENSION = ".table"
+DEFAULT_CACHE_MAX_SIZE = 1024**3
+# temporary files (from Table.to_binary) untouched for this long (in seconds) were abandoned by a writer that crashed
+STALE_TMP_AGE = 3600
+
 class DefaultLog(object):
     def __init__(self):
         pass
@@ -19,6 +27,62 @@ class DefaultLog(object):
         pass
         #print x
 
+class ThreadLog(object):
+    """ Passes log messages to the logger set (by BaseQuery.set_logger) in the current thread, so reports running at
+        the same time in different threads each log to their own Run. """
+    def __init__(self):
+        self.local = threading.local()
+    def set_logger(self, logger):
+        self.local.logger = logger
+    def log(self, x):
+        getattr(self.local, 'logger', DefaultLog()).log(x)
+
+
+class SharedQueries(object):
+    """ The results of queries run while running a batch of reports, so that when several reports run the same query
+        (with the same arguments) at the same time, it is only run once.
+
+        A result is only kept while some report is waiting for it: reports that ask later find it in the file cache. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # cache_key -> [lock held while loading, result or None, number of reports using the entry]
+        self.entries = {}
+
+    @contextlib.contextmanager
+    def entry(self, key):
+        """ Context manager: the entry for this key, locked so only one report loads it. """
+        with self.lock:
+            entry = self.entries.setdefault(key, [threading.Lock(), None, 0])
+            entry[2] += 1
+        try:
+            with entry[0]:
+                yield entry
+        finally:
+            with self.lock:
+                entry[2] -= 1
+                if entry[2] == 0:
+                    del self.entries[key]
+
+_shared_queries = contextvars.ContextVar('shared_queries', default=None)
+
+@contextlib.contextmanager
+def shared_queries(shared=None):
+    """ Context manager: within it, CachedQuery results are shared by their cache_key, with the other reports in the
+        batch. Threads running reports for the batch must be given its SharedQueries (as yielded by the outermost
+        shared_queries()): others, like concurrent web requests, have their own. """
+    if shared is None:
+        shared = _shared_queries.get()
+        if shared is not None:
+            # already sharing: join the outer batch
+            yield shared
+            return
+        shared = SharedQueries()
+    token = _shared_queries.set(shared)
+    try:
+        yield shared
+    finally:
+        _shared_queries.reset(token)
+
 class BaseQuery(object):
     """ The base class for queries. Performs a simple DB query. """
 
@@ -28,11 +92,11 @@ class BaseQuery(object):
         """)
     default_arguments = { } 
     filename="query"
-    logger = DefaultLog()
+    logger = ThreadLog()
 
     @classmethod
     def set_logger(cls, logger):
-        BaseQuery.logger = logger
+        BaseQuery.logger.set_logger(logger)
 
     def __init__(self, db, input_clean_function=no_function, output_clean_function=no_function, query_args={}):
         """ 
@@ -72,15 +136,14 @@ class BaseQuery(object):
 
         BaseQuery.logger.log( str(self.elapsed_time) + " seconds" )
 
-        results_table = Table()
-        
-        for col in cursor.description:
-            results_table.append_column( col[0] )
-
-        row = cursor.fetchone()
-        while row:
-            results_table.append_row( [self.output_clean_function(i) for i in row] )
+        def fetched_rows():
             row = cursor.fetchone()
+            while row:
+                yield [self.output_clean_function(i) for i in row]
+                row = cursor.fetchone()
+
+        headers = [ col[0] for col in cursor.description ]
+        results_table = Table.from_rows( headers, fetched_rows() )
 
         self.rows_fetched = len(results_table) 
 
@@ -88,8 +151,13 @@ class BaseQuery(object):
 
         return results_table
 
+    @property
+    def cache_key(self):
+        """ A hash of the query: the same in every process (unlike hash()), so cached results can be shared. """
+        return hashlib.sha256( self.complete_query.encode('utf-8') ).hexdigest()
+
     def __hash__(self):
-        return hash(self.complete_query )
+        return int( self.cache_key[:16], 16 )
 
 def force_dir( path ):
     """ Forces an empty directory to exist at path (if possible.) """
@@ -102,6 +170,9 @@ class CachedQuery(BaseQuery):
     
         Children of CachedQuery can modify how long the query is cached for 
         by altering the 'expires' variable. The default is '1 day'. 
+
+        Results are stored in REPORT_CACHE_LOCATION in Table's binary format, with the query's details in its
+        metadata. When the files there total more than REPORT_CACHE_MAX_SIZE bytes, the least recently used are removed.
     """ 
 
     expires = datetime.datetime.now() + datetime.timedelta(1) 
@@ -113,89 +184,141 @@ class CachedQuery(BaseQuery):
         return settings.REPORT_CACHE_LOCATION
     
     @property
-    def query_filename(self):
+    def cache_filename(self):
         force_dir(CachedQuery.cache_location())
-        return os.path.join(CachedQuery.cache_location(),  self.filename + str(hash(self)) + ".query")
-    @property
-    def result_filename(self):
-        force_dir(CachedQuery.cache_location())
-        return os.path.join(CachedQuery.cache_location(), self.filename + str(hash(self)) + ".result")
+        return os.path.join(CachedQuery.cache_location(), self.filename + "-" + self.cache_key + CACHE_EXTENSION)
+
+    @staticmethod
+    def cache_file_expired(filename):
+        """ True if the result in the cache file has expired, or isn't something we can read. Raises OSError if the
+            file can't be opened. """
+        try:
+            obj = Table.binary_metadata( filename )
+        except ValueError:
+            return True
+        expires = datetime.datetime.fromisoformat(obj['expires'])
+        return pytz.UTC.localize(datetime.datetime.now()) >= expires
 
     def is_cached_on_file(self):
-        if os.path.exists( self.query_filename ):
-            with open(self.query_filename, 'r') as f:
-                obj = json.loads( f.read() ) 
-                expires = datetime.datetime.fromisoformat(obj['expires'])
-                if pytz.UTC.localize(datetime.datetime.now()) < expires:
-                    return True
-                BaseQuery.logger.log("Cache expired.")
+        try:
+            if not CachedQuery.cache_file_expired( self.cache_filename ):
+                return True
+        except OSError:
+            # missing
+            return False
+        BaseQuery.logger.log("Cache expired.")
         return False
     
-    def serialize_query(self):
+    def query_metadata(self):
         obj = {}
         obj['query'] = self.query.template
         obj['args'] = self.arguments
         obj['expires'] = pytz.UTC.localize(self.expires).isoformat()
         obj['elapsed_time'] = self.elapsed_time
         obj['rows_fetched'] = self.rows_fetched
-        return json.dumps(obj, indent=4) 
-
-    def load_query(self):
-        with open(self.query_filename, 'r') as f:
-            obj = json.loads( f.read() ) 
-            self.elapsed_time = obj['elapsed_time']
-            self.rows_fetched = obj['rows_fetched']
-
-    def save_query(self):
-        with open(self.query_filename, 'w') as f:
-            f.write( self.serialize_query() )
+        return obj
 
     def save_result(self):
-        self.cached_result.to_csv(self.result_filename)
+        self.cached_result.to_binary( self.cache_filename, self.query_metadata() )
 
     def load_result(self):
-        self.cached_result = Table.from_csv(self.result_filename)
+        filename = self.cache_filename
+        obj = Table.binary_metadata( filename )
+        self.elapsed_time = obj['elapsed_time']
+        self.rows_fetched = obj['rows_fetched']
+        self.cached_result = Table.from_binary( filename )
+        # mark it as recently used, for evict_from_cache
+        os.utime( filename )
 
     def return_cached_result(self):
-        return copy.deepcopy( self.cached_result )
+        # copy-on-write: the result can be changed by the caller without affecting the cached copy
+        return self.cached_result.copy()
     
     def result(self):
         """ Wraps the 'result' function in caching code."""
         if hasattr(self, 'cached_result'):
             CachedQuery.logger.log( " -- Loading from cache -- " )
             return self.return_cached_result()
+
+        start_time = time.time()
+        shared = _shared_queries.get()
+        if shared is None:
+            source = self.load_cached_result()
+        else:
+            with shared.entry(self.cache_key) as entry:
+                if entry[1] is not None:
+                    self.cached_result, self.elapsed_time, self.rows_fetched = entry[1]
+                    source = "shared with another report"
+                else:
+                    source = self.load_cached_result()
+                    entry[1] = (self.cached_result, self.elapsed_time, self.rows_fetched)
+
+        CachedQuery.logger.log( "Query %s: %.3f seconds, %i rows, from %s." % (self.filename, time.time() - start_time,
+                                                                             len(self.cached_result), source) )
+        return self.return_cached_result()
+
+    def load_cached_result(self):
+        """ Set self.cached_result from the cache file if possible, or by running the query. Returns where it came
+            from, for the log. """
         if self.is_cached_on_file():
             CachedQuery.logger.log( "With arguments: " + str(self.arguments) )
-            CachedQuery.logger.log( " -- Loading from file: " + str(self.query_filename) + " --" )
-            self.load_query()
-            self.load_result()
-            return self.return_cached_result()
-        else:
-            self.cached_result = super(CachedQuery, self).result()
-            self.save_query()
-            self.save_result()
-            return self.return_cached_result()
+            CachedQuery.logger.log( " -- Loading from file: " + str(self.cache_filename) + " --" )
+            try:
+                self.load_result()
+                return "cache file"
+            except OSError:
+                # evicted since we checked: fall back to the database
+                CachedQuery.logger.log( " -- Cache file is gone --" )
+
+        self.cached_result = super(CachedQuery, self).result()
+        self.save_result()
+        return "database"
     
     @staticmethod
-    def clear_expired_members_from_cache():
-        """ Remove any files from the cache if they've expired. """
+    def _remove_from_cache(path):
+        CachedQuery.logger.log( "Deleting from cache: " + path )
+        try:
+            os.remove( path )
+        except FileNotFoundError:
+            # another process got to it first
+            pass
 
+    @staticmethod
+    def evict_from_cache():
+        """ Clean up the cache: remove expired results and temporary files abandoned by crashed writers, then the least
+        recently used files until it's under REPORT_CACHE_MAX_SIZE.
+        """
         cache_location = CachedQuery.cache_location() 
-        CachedQuery.logger.log( "Looking for expired cache members in " + cache_location )
-        if not os.path.isdir(cache_location):
-            CachedQuery.logger.log( "Cache directory not found.")
-            return
-        for cache_file in os.listdir(cache_location):
-            cache_file = os.path.join(cache_location, cache_file )
-            if cache_file.endswith('.query') and os.path.isfile( cache_file ):
-                with open(cache_file, 'r') as f:
-                    obj = json.loads( f.read() ) 
-                    expires = datetime.datetime.fromisoformat(obj['expires'])
-                    if not pytz.UTC.localize(datetime.datetime.now()) < expires:
-                        result_file = cache_file.replace('.query', '.result')
-                        os.remove( cache_file ) 
-                        os.remove( result_file )
-                        CachedQuery.logger.log( "Deleting expired cache: " + cache_file + ", " + result_file )
+        max_size = getattr(settings, 'REPORT_CACHE_MAX_SIZE', DEFAULT_CACHE_MAX_SIZE)
+        now = time.time()
+
+        files = []
+        for entry in os.scandir(cache_location):
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                if entry.name.endswith('.tmp'):
+                    # still being written, unless it has been left for a long time
+                    if now - stat.st_mtime > STALE_TMP_AGE:
+                        CachedQuery._remove_from_cache( entry.path )
+                    continue
+                if entry.name.endswith(CACHE_EXTENSION) and CachedQuery.cache_file_expired( entry.path ):
+                    CachedQuery._remove_from_cache( entry.path )
+                    continue
+            except FileNotFoundError:
+                # removed by another process while we looked
+                continue
+            files.append( (stat.st_mtime, stat.st_size, entry.path) )
+
+        total_size = sum( size for _, size, _ in files )
+        CachedQuery.logger.log( "Report cache is %i bytes in %i files." % (total_size, len(files)) )
+        files.sort()
+        for _, size, path in files:
+            if total_size <= max_size:
+                break
+            CachedQuery._remove_from_cache( path )
+            total_size -= size
 
 class Query(CachedQuery):
     pass
@@ -219,15 +342,11 @@ class LocalDBQuery(Query):
         pass
 
     def result(self):
-        results_table = Table()
         qs = list(self.query_values)
 
         cols = list(qs[0].keys())
-        for k in cols:
-            results_table.append_column(self.field_map.get(k, k))
-
-        for row in qs:
-            results_table.append_row( [self.output_clean_function(row[c]) for c in cols] )
+        results_table = Table.from_rows( [self.field_map.get(k, k) for k in cols],
+                                         [[self.output_clean_function(row[c]) for c in cols] for row in qs] )
 
         self.results_table = results_table
         self.post_process()
@@ -10,7 +10,7 @@ class Report():
         self.logger = logger
         DB2_Query.set_logger(logger)
         DB2_Query.connect()
-        DB2_Query.clear_expired_members_from_cache()
+        DB2_Query.evict_from_cache()
         pass
 
     def run(self):
@@ -44,11 +44,11 @@ class Ensc150And250ButNot215StudentReport( Report ):
         cmpt_250_emplids = emplids_in_course('CMPT', '250')
         ensc_215_emplids = emplids_in_course('ENSC', '215')
 
-        students.compute_column('HAS_ENSC_150', lambda x: x['EMPLID'] in ensc_150_emplids)
-        students.compute_column('HAS_CMPT_150', lambda x: x['EMPLID'] in cmpt_150_emplids)
-        students.compute_column('HAS_ENSC_250', lambda x: x['EMPLID'] in ensc_250_emplids)
-        students.compute_column('HAS_CMPT_250', lambda x: x['EMPLID'] in cmpt_250_emplids)
-        students.compute_column('HAS_ENSC_215', lambda x: x['EMPLID'] in ensc_215_emplids)
+        students.map_column('HAS_ENSC_150', 'EMPLID', lambda e: e in ensc_150_emplids)
+        students.map_column('HAS_CMPT_150', 'EMPLID', lambda e: e in cmpt_150_emplids)
+        students.map_column('HAS_ENSC_250', 'EMPLID', lambda e: e in ensc_250_emplids)
+        students.map_column('HAS_CMPT_250', 'EMPLID', lambda e: e in cmpt_250_emplids)
+        students.map_column('HAS_ENSC_215', 'EMPLID', lambda e: e in ensc_215_emplids)
 
         email_query = EmailQuery()
         email = email_query.result()
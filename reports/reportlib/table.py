@@ -1,13 +1,170 @@
 import pprint 
 import csv
+import itertools
+import array
+import datetime
+import decimal
+import json
+import mmap
+import os
+import struct
+import sys
+
+
+ROW_CHUNK_SIZE = 10000
+BINARY_MAGIC = b'RTB1'
+
+
+def _shared_strings(values, seen=None):
+    """ Return the list of values, with equal strings replaced by a single shared object (from the seen dict, if
+    given, so it can be shared between calls).
+
+    Query results repeat the same few strings (program codes, semesters, flags) in every row: sharing them saves most of
+    a large table's memory.
+    """
+    if seen is None:
+        seen = {}
+    return [seen.setdefault(v, v) if type(v) is str else v for v in values]
+
+
+def _encode_value(value):
+    """ A JSON-able representation of a table value, for the binary format. """
+    if value is None or type(value) in (str, int, float, bool):
+        return value
+    if isinstance(value, decimal.Decimal):
+        return {'decimal': str(value)}
+    if isinstance(value, datetime.datetime):
+        return {'datetime': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'date': value.isoformat()}
+    return str(value)
+
+
+def _decode_value(value):
+    if type(value) is not dict:
+        return value
+    if 'decimal' in value:
+        return decimal.Decimal(value['decimal'])
+    if 'datetime' in value:
+        return datetime.datetime.fromisoformat(value['datetime'])
+    return datetime.date.fromisoformat(value['date'])
+
+
+def _padding(length):
+    return b'\0' * (-length % 8)
+
 
 class Table():
+    """ A table of data, stored column-by-column.
+
+    self.columns[i] is the list of values in the column named self.headers[i]. Rows are only assembled when asked for
+    (by row_map, row_maps, rows, etc).
+
+    Indexes (column value -> first row with that value) are built by find() when first needed, and are kept up to date
+    as rows are appended. Operations that remove or reorder rows discard them, to be rebuilt when next needed.
+    """
     EMPTY = "" 
 
     def __init__(self):
-        self.headers = []
-        self.rows = []
+        self._headers = []
+        self.columns = []
         self.indices = {}
+        # are the column lists shared with another table (by copy()), so must be copied before changing in place?
+        self._shared_columns = False
+
+    @property
+    def headers(self):
+        return self._headers
+
+    @headers.setter
+    def headers(self, headers):
+        """ Rename the columns. """
+        headers = list(headers)
+        if len(self) == 0 and not self.columns:
+            self.columns = [[] for _ in headers]
+        elif len(headers) != len(self.columns):
+            raise ValueError("Table has %i columns, but %i headers given." % (len(self.columns), len(headers)))
+        self._headers = headers
+        self.indices = {}
+
+    @property
+    def rows(self):
+        """ The table's data as a list of rows (each a list). The list is built on each access: changing it doesn't
+        change the table, but assigning to self.rows replaces the table's data.
+        """
+        return [list(row) for row in zip(*self.columns)]
+
+    @rows.setter
+    def rows(self, rows):
+        rows = list(rows)
+        for row in rows:
+            if len(row) != len(self.headers):
+                raise ValueError("Table has %i columns, but row has %i values." % (len(self.headers), len(row)))
+        if rows:
+            self.columns = [list(column) for column in zip(*rows)]
+        else:
+            self.columns = [[] for _ in self.headers]
+        self.indices = {}
+
+    @staticmethod
+    def from_rows(headers, rows):
+        """ Create a table with these headers, from a list (or iterable) of rows.
+
+        >>> Table.from_rows( ["FirstName", "LastName"], [["Curtis", "Lassam"], ["Jonathan", "Lassam"]] )
+        FirstName | LastName
+        Curtis | Lassam
+        Jonathan | Lassam
+
+        """
+        table = Table()
+        table.headers = headers
+        shared = [ {} for _ in table.headers ]
+        rows = iter(rows)
+        # transpose a chunk at a time, so a large result is never held as rows and columns at once
+        while True:
+            chunk = list( itertools.islice(rows, ROW_CHUNK_SIZE) )
+            if not chunk:
+                break
+            for row in chunk:
+                if len(row) != len(table.headers):
+                    raise ValueError("Table has %i columns, but row has %i values." % (len(table.headers), len(row)))
+            for column, seen, values in zip(table.columns, shared, zip(*chunk)):
+                column.extend( _shared_strings(values, seen) )
+        return table
+
+    def copy(self):
+        """ A copy of this table. The column lists are shared until either table changes them (copy-on-write), so
+        this is cheap however large the table is.
+        """
+        t = Table()
+        t._headers = list(self.headers)
+        t.columns = list(self.columns)
+        t._shared_columns = True
+        self._shared_columns = True
+        return t
+
+    def _own_columns(self):
+        """ Called before changing column lists in place: copy them if they are shared with another table. """
+        if getattr(self, '_shared_columns', False):
+            self.columns = [ list(column) for column in self.columns ]
+            self._shared_columns = False
+
+    def iter_rows(self):
+        """ Iterate through the table's rows, as tuples. """
+        return zip(*self.columns)
+
+    def _column(self, column_name):
+        """ The values in the column named column_name. If the name is repeated, the last one (as in a row_map). """
+        for header, column in zip(reversed(self.headers), reversed(self.columns)):
+            if header == column_name:
+                return column
+        raise ValueError("%r is not in list" % (column_name,))
+
+    def _keep_rows(self, keep):
+        """ Keep only the rows whose positions are in the (sorted) list keep. """
+        if len(keep) != len(self):
+            self.columns = [[column[i] for i in keep] for column in self.columns]
+            self.indices = {}
 
     def append_column(self, column_name, column_fill=None):
         """ Add an empty column with name 'column_name' to the table
@@ -22,8 +179,7 @@ class Table():
             column_fill = Table.EMPTY
 
         self.headers.append( column_name )
-        for row in self.rows:
-            row.append( column_fill )
+        self.columns.append( [column_fill] * len(self) )
     
     def append_row(self, row):
         """ Add a new row to the table.
@@ -36,11 +192,20 @@ class Table():
         FirstName | LastName
         Curtis | Lassam
         """
-        self.rows.append( row ) 
+        if len(row) != len(self.columns):
+            raise ValueError("Table has %i columns, but row has %i values." % (len(self.columns), len(row)))
+        self._own_columns()
+        position = len(self)
+        if self.indices:
+            row_map = dict( zip(self.headers, row) )
+        for column, value in zip(self.columns, row):
+            column.append( value )
+        for key_column, index in self.indices.items():
+            index.setdefault( row_map[key_column], position )
 
     @property
     def is_very_large(self):
-        return len(self.rows) > 100000;
+        return len(self) > 100000
 
     def compute_column( self, column_name, column_function):
         """ Compute a new column, row by row, using the function provided. 
@@ -59,13 +224,34 @@ class Table():
         Jonathan | Lassam | Jonathan Lassam
        
         """
+        values = [ column_function(row_map) for row_map in self.row_maps() ]
         if column_name in self.headers:
             self.remove_column(column_name)
 
-        for i in range( 0, len(self.rows) ):
-            self.rows[i].append( column_function( self.row_map(i) ) )
+        self.headers.append( column_name )
+        self.columns.append( values )
+
+    def map_column( self, column_name, source_column, column_function ):
+        """ Compute a new column from the values in one other column: like compute_column, but without building a
+        row_map for every row.
+
+        >>> t = Table()
+        >>> t.append_column("FirstName")
+        >>> t.append_row( ["Curtis"] )
+        >>> t.append_row( ["Jonathan"] )
+        >>> t.map_column( "Initial", "FirstName", lambda x: x[0] )
+        >>> print t
+        FirstName | Initial
+        Curtis | C
+        Jonathan | J
+
+        """
+        values = [ column_function(value) for value in self._column(source_column) ]
+        if column_name in self.headers:
+            self.remove_column(column_name)
 
         self.headers.append( column_name )
+        self.columns.append( values )
 
     def remove_column( self, column_name ):
         """ Remove a column from the table
@@ -84,8 +270,8 @@ class Table():
         """
         index_to_remove = self.headers.index(column_name)
         del self.headers[index_to_remove]
-        for row in self.rows:
-            del row[index_to_remove]
+        del self.columns[index_to_remove]
+        self.indices.pop( column_name, None )
 
     def column_as_list( self, column_name ):
         """ Retrieve a column from the table as a list.
@@ -99,22 +285,24 @@ class Table():
         ['Curtis', 'Jonathan']
 
         """
-        index = self.headers.index(column_name)
-        return [ row[index] for row in self.rows ]
+        return list( self.columns[self.headers.index(column_name)] )
 
     def subset( self, list_of_columns ):
         """ Produce a new table, containing only the listed columns. """
 
         t = Table()
-        for row_map in self.row_maps():
-            new_row = []
-            for column in list_of_columns:
-                new_row.append( row_map[column] ) 
-            t.append_row( new_row )
         for column in list_of_columns:
-            t.headers.append(column) 
+            t.headers.append( column )
+            t.columns.append( list(self._column(column)) )
 
         return t
+
+    def head( self, n ):
+        """ Produce a new table, containing only the first n rows. """
+        t = Table()
+        t.headers = self.headers
+        t.columns = [ column[:n] for column in self.columns ]
+        return t
             
     def row_map( self, i ):
         """ For the i-th row in the table, return a column-name to data map 
@@ -132,11 +320,7 @@ class Table():
         {'LastName': 'Lassam', 'FirstName': 'Jonathan'}
 
         """
-        row = self.rows[i]
-        obj = {}
-        for i in range( 0, len(self.headers) ):
-            obj[self.headers[i]] = row[i]
-        return obj
+        return { header: column[i] for header, column in zip(self.headers, self.columns) }
 
     def row_maps( self ):
         """ Iterate through the table, returning a row_map for every row. 
@@ -154,8 +338,9 @@ class Table():
         [{'LastName': 'Lassam', 'FirstName': 'Curtis'}, {'LastName': 'Lassam', 'FirstName': 'Jonathan'}]
 
         """
-        for i in range( 0, len(self.rows) ):
-            yield self.row_map(i) 
+        headers = self.headers
+        for row in self.iter_rows():
+            yield dict( zip(headers, row) )
 
     def filter( self, filter_function ):
         """ Remove any row objects that do not match the filter function. 
@@ -183,9 +368,25 @@ class Table():
         Peter | Ox-Hands
 
         """
-        for i in range( len(self.rows)-1, -1, -1 ):
-            if not filter_function( self.row_map(i) ):
-                del self.rows[i]
+        self._keep_rows( [ i for i, row_map in enumerate(self.row_maps()) if filter_function(row_map) ] )
+        return self
+
+    def filter_column( self, column_name, filter_function ):
+        """ Remove any rows whose value in column_name does not match the filter function: like filter, but without
+        building a row_map for every row.
+
+        >>> t = Table()
+        >>> t.append_column("FirstName")
+        >>> t.append_column("LastName")
+        >>> t.append_row( ["Curtis", "Lassam"] )
+        >>> t.append_row( ["Jonathan", "Lassam"] )
+        >>> t.filter_column( "FirstName", lambda x: x != "Curtis" )
+        FirstName | LastName
+        Jonathan | Lassam
+
+        """
+        column = self._column(column_name)
+        self._keep_rows( [ i for i, value in enumerate(column) if filter_function(value) ] )
         return self
 
     def find( self, key_column, value ):
@@ -206,17 +407,16 @@ class Table():
         """
         
         # Indexed search.  O(1)
-        if key_column in self.indices:
+        if key_column not in self.indices:
             try:
-                return self.indices[key_column][value]
-            except KeyError:
-                return -1
-        
-        # Linear search. O(n)
-        for i in range( 0, len(self.rows) ):
-            if self.row_map(i)[key_column] == value:
-                return i
-        return -1
+                self.generate_index( key_column )
+            except TypeError:
+                # unhashable values in the column: linear search. O(n)
+                try:
+                    return self._column(key_column).index(value)
+                except ValueError:
+                    return -1
+        return self.indices[key_column].get( value, -1 )
 
     def contains( self, key_column, value):
         """ Return True if the table contains 'value' in 'column', false otherwise. 
@@ -253,15 +453,11 @@ class Table():
         >>> t.find( "FirstName", "Randall")
         -1
 
-        Note that, for now, the index is not modified when a new row is added.
-        That's a definite TODO.
+        The index is kept up to date as rows are added. (find creates the
+        index if it doesn't exist, so calling this is optional.)
 
         >>> t.append_row( ["Randall", "Mouthharp"] )
         >>> t.find( "FirstName", "Randall" )
-        -1
-
-        >>> t.generate_index( "FirstName" )
-        >>> t.find( "FirstName", "Randall" )
         2
 
         It's also important to note that the find operation still must always
@@ -272,12 +468,9 @@ class Table():
         0
 
         """
-        self.indices[key_column] = {}
-        for i in range( 0, len(self.rows) ):
-            row_map = self.row_map(i) 
-            key = self.row_map(i)[key_column]
-            if key not in self.indices[key_column]:
-                self.indices[key_column][key] = i
+        column = self._column(key_column)
+        # reversed, so the first appearance of each key is the one that remains
+        self.indices[key_column] = dict( zip(reversed(column), range(len(column)-1, -1, -1)) )
 
     def compute_key( self, key_name, column_names ):
         """ Creates an indexed key out of multiple tables.
@@ -328,23 +521,10 @@ class Table():
         12 | Goofus | $150,000
 
         """
-        self.generate_index(key_column)
-        other_table.generate_index(key_column) 
-
-        for i in range( len(self.rows)-1, -1, -1 ): 
-            key = self.row_map(i)[key_column]
-            loc = other_table.find(key_column, key)
-            if loc == -1:
-                del self.rows[i]
-            else:
-                other_row = other_table.rows[loc]
-                self.rows[i].extend(other_row)
-        for header in other_table.headers:
-            if header in self.headers:
-                header = header + "_JOIN"
-            self.headers.append( header )
-
-        self.remove_column( key_column + "_JOIN" )
+        locations = other_table._locations( self._column(key_column), key_column )
+        keep = [ i for i, loc in enumerate(locations) if loc != -1 ]
+        self._keep_rows( keep )
+        self._join_columns( other_table, key_column, [ locations[i] for i in keep ] )
     
     def left_join( self, other_table, key_column ):
         """ left joins 'other_table' to this table on key_column, 
@@ -372,25 +552,35 @@ class Table():
         13 | Gallant | 
 
         """
-        self.generate_index(key_column)
-        other_table.generate_index(key_column) 
-
-        blank_row = ["" for x in other_table.headers]
-
-        for i in range( len(self.rows)-1, -1, -1 ): 
-            key = self.row_map(i)[key_column]
-            loc = other_table.find(key_column, key)
-            if loc == -1:
-                self.rows[i].extend(blank_row)
-            else:
-                other_row = other_table.rows[loc]
-                self.rows[i].extend(other_row)
+        locations = other_table._locations( self._column(key_column), key_column )
+        self._join_columns( other_table, key_column, locations )
+
+    def _locations( self, keys, key_column ):
+        """ The position of each of the keys in this table's key_column (or -1 if it's not there). """
+        if key_column not in self.indices:
+            self.generate_index( key_column )
+        index = self.indices[key_column]
+        return [ index.get(key, -1) for key in keys ]
+
+    def _join_columns( self, other_table, key_column, locations ):
+        """ Add other_table's columns to this one: for each row here, the values from the other table's row at that
+        position in locations (or blank if it's -1).
+        """
+        new_headers = []
         for header in other_table.headers:
             if header in self.headers:
                 header = header + "_JOIN"
-            self.headers.append( header )
+            new_headers.append( header )
 
-        self.remove_column( key_column + "_JOIN" )
+        for header, column in zip(new_headers, other_table.columns):
+            if header == key_column + "_JOIN":
+                continue
+            if -1 in locations:
+                values = [ column[loc] if loc != -1 else "" for loc in locations ]
+            else:
+                values = [ column[loc] for loc in locations ]
+            self.headers.append( header )
+            self.columns.append( values )
 
     def flatten(self, key_column):
         """ If there are duplicate items in key_column, merge them into a single
@@ -417,31 +607,36 @@ class Table():
         """ 
         key_index = self.headers.index(key_column)
         assert( key_index != -1) 
-        delete_rows = []
-        self.generate_index(key_column)
-        for i in range( 0, len(self.rows) ):
-            key = self.rows[i][key_index]
-            first_appearance_of_key = self.find(key_column, key)
+        first_appearances = {}
+        merges = [] # (row to merge, first row with that key)
+        for i, key in enumerate(self.columns[key_index]):
+            first_appearance_of_key = first_appearances.setdefault(key, i)
             if first_appearance_of_key != i:
-                this_row = self.rows[i]
-                target_row = self.rows[first_appearance_of_key]
-                # merge this row with the first row.
-                for j in range( 0, len(self.rows[i])):
-                    if this_row[j] == target_row[j]:
-                        pass
-                    elif this_row[j] == Table.EMPTY:
-                        pass
-                    elif target_row[j] == Table.EMPTY:
-                        target_row[j] = this_row[j]
-                    elif this_row[j] + "," in target_row[j] or ", " + this_row[j] in target_row[j]:
-                        pass
-                    else:
-                        target_row[j] = str(target_row[j]) + ", " + str(this_row[j])
-                delete_rows.append(i)
-
-        delete_rows.reverse()
-        for row_index in delete_rows:
-            del self.rows[row_index]
+                merges.append( (i, first_appearance_of_key) )
+
+        if not merges:
+            return self
+
+        # merge each row with the first row, column by column.
+        self._own_columns()
+        for column in self.columns:
+            for i, target in merges:
+                this_value = column[i]
+                target_value = column[target]
+                if this_value == target_value:
+                    pass
+                elif this_value == Table.EMPTY:
+                    pass
+                elif target_value == Table.EMPTY:
+                    column[target] = this_value
+                elif this_value + "," in target_value or ", " + this_value in target_value:
+                    pass
+                else:
+                    column[target] = str(target_value) + ", " + str(this_value)
+
+        delete_rows = set( i for i, _ in merges )
+        self._keep_rows( [ i for i in range(len(self)) if i not in delete_rows ] )
+        self.indices = {}
         
         return self
 
@@ -479,12 +674,7 @@ class Table():
         Jonathan | Lassam
         
         """
-        table = Table()
-        for header in obj['headers']:
-            table.append_column( header )
-        for row in obj['rows']:
-            table.append_row( row )
-        return table
+        return Table.from_rows( obj['headers'], obj['rows'] )
 
     def __repr__(self):
         """ Return a string representation of the data. 
@@ -494,7 +684,7 @@ class Table():
         """
         list_of_strings = []
         list_of_strings.append( " | ".join( self.headers ) )
-        for row in self.rows:
+        for row in self.iter_rows():
             list_of_strings.append( " | ".join( [Table.asciify(x) for x in row] ))
 
         return "\n".join(list_of_strings)
@@ -563,31 +753,122 @@ class Table():
         """
         writer = csv.writer( open(location, 'wt', encoding='utf8') )
         writer.writerow( self.headers )
-        for row in self.rows:
-            writer.writerow(row)
+        writer.writerows( self.iter_rows() )
     
     @staticmethod
     def from_csv(location):
         """ Load the table from a csv file. """
         reader = csv.reader( open(location, 'rt', encoding='utf8') )
         
-        new_table = Table()
-        
-        for row in reader:
-            for column in row:
-                new_table.append_column( column )
-            break
+        headers = next(reader, [])
+        return Table.from_rows( headers, reader )
+
+    def to_binary(self, location, metadata=None):
+        """ Write the table to a file in a compact binary format, that from_binary can read back quickly.
 
-        app = new_table.rows.append
-        [ app( row ) for row in reader ]
+        Each column is stored as the list of its distinct values (in a JSON header, along with the metadata dict)
+        and an array of 1, 2 or 4 byte codes indexing into that list, one per row. Values keep their types (str, int,
+        float, bool, None, Decimal, date, datetime); any others are stored as strings.
 
-        return new_table
+        The file is written under a temporary name and moved into place, so readers never see a partial file.
+
+        >>> t = Table()
+        >>> t.append_column("FirstName")
+        >>> t.append_column("LastName")
+        >>> t.append_row( ["Curtis", "Lassam"] )
+        >>> t.append_row( ["Jonathan", "Lassam"] )
+        >>> t.to_binary("/tmp/example.table", {'note': 'example'})
+        >>> print Table.from_binary( "/tmp/example.table" )
+        FirstName | LastName
+        Curtis | Lassam
+        Jonathan | Lassam
+        >>> Table.binary_metadata( "/tmp/example.table" )
+        {'note': 'example'}
+
+        """
+        columns = []
+        blocks = []
+        offset = 0
+        for column in self.columns:
+            codes_by_key = {}
+            values = []
+            codes = []
+            for value in column:
+                # the key keeps values that compare equal but aren't the same (1, 1.0, True, Decimal('1.00')) apart
+                key = value if type(value) is str else (type(value), repr(value))
+                code = codes_by_key.setdefault(key, len(values))
+                if code == len(values):
+                    values.append(value)
+                codes.append(code)
+
+            typecode = 'B' if len(values) <= 0x100 else 'H' if len(values) <= 0x10000 else 'I'
+            block = array.array(typecode, codes).tobytes()
+            block += _padding(len(block))
+            columns.append({'values': [_encode_value(v) for v in values], 'typecode': typecode, 'offset': offset})
+            blocks.append(block)
+            offset += len(block)
+
+        header = json.dumps({'metadata': metadata or {}, 'headers': self.headers, 'rows': len(self),
+                             'byteorder': sys.byteorder, 'columns': columns}).encode('utf-8')
+        tmp = '%s.%i.tmp' % (location, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(BINARY_MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            f.write(_padding(len(header)))
+            for block in blocks:
+                f.write(block)
+        os.replace(tmp, location)
+
+    @staticmethod
+    def _read_binary_header(f):
+        if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise ValueError("Not a binary table file.")
+        length, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(length).decode('utf-8'))
+        data_start = len(BINARY_MAGIC) + 8 + length + len(_padding(length))
+        return header, data_start
+
+    @staticmethod
+    def binary_metadata(location):
+        """ The metadata dict stored with a table by to_binary, without reading the table itself. """
+        with open(location, 'rb') as f:
+            header, _ = Table._read_binary_header(f)
+        return header['metadata']
+
+    @staticmethod
+    def from_binary(location):
+        """ Load the table from a file written by to_binary.
+
+        The file is memory-mapped and each column's codes are read directly from the mapping, so the only copy of the
+        data made is the table itself.
+        """
+        with open(location, 'rb') as f:
+            header, data_start = Table._read_binary_header(f)
+            if header['byteorder'] != sys.byteorder:
+                raise ValueError("Binary table file was written with a different byte order.")
+            n = header['rows']
+
+            table = Table()
+            table.headers = header['headers']
+            if n == 0:
+                return table
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as view:
+                    for i, column in enumerate(header['columns']):
+                        values = [ _decode_value(v) for v in column['values'] ]
+                        start = data_start + column['offset']
+                        itemsize = array.array(column['typecode']).itemsize
+                        with view[start:start + n*itemsize].cast(column['typecode']) as codes:
+                            table.columns[i] = list( map(values.__getitem__, codes) )
+        return table
 
     def convert_to_unicode(self):
         """ Convert the entire contents of the table to unicode. 
 
         Reasonably expensive, don't call unless you are about to render the table."""
-        self.rows = [[Table.to_unicode(column) for column in row] for row in self.rows  ]
+        self.columns = [ _shared_strings([Table.to_unicode(value) for value in column]) for column in self.columns ]
+        self.indices = {}
     
     @staticmethod
     def to_unicode(thing):
@@ -599,6 +880,8 @@ class Table():
             return str( thing )
     
     def __len__(self):
-        return len(self.rows)
+        if self.columns:
+            return len(self.columns[0])
+        return 0
 
 
@@ -6,6 +6,25 @@ Replace this with more appropriate tests for your application.
 """
 
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from coredata.models import Person
+from courselib.testing import Client, basic_page_tests
+from privacy.models import PRIVACY_VERSION
+from reports.models import Report, Run, Result, ResultPage, HardcodedReport, ScheduleRule, schedule_ping
+from reports.reportlib.query import CachedQuery, shared_queries
+from reports.reportlib.table import Table
+
+import datetime
+import decimal
+import os
+import shutil
+import string
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
 
 class SimpleTest(TestCase):
@@ -14,3 +33,263 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class TableTest(TestCase):
+    def _table(self):
+        t = Table()
+        t.append_column("EMPLID")
+        t.append_column("PROG")
+        t.append_row(["1", "CMPT"])
+        t.append_row(["2", "ENSC"])
+        t.append_row(["1", "MSE"])
+        return t
+
+    def test_find_index(self):
+        t = self._table()
+        self.assertEqual(t.find("EMPLID", "1"), 0)
+        self.assertEqual(t.find("EMPLID", "3"), -1)
+        # the index built by find is maintained as rows are added...
+        t.append_row(["3", "CMPT"])
+        self.assertEqual(t.find("EMPLID", "3"), 3)
+        self.assertEqual(t.find("EMPLID", "1"), 0)
+        # ... and discarded when rows are removed
+        t.filter_column("PROG", lambda p: p != "CMPT")
+        self.assertEqual(t.find("EMPLID", "1"), 1)
+        self.assertEqual(t.find("EMPLID", "3"), -1)
+
+    def test_joins(self):
+        other = Table.from_rows(["EMPLID", "PROG", "GPA"], [["2", "ENSC", "3.5"], ["1", "CMPT", "2.0"], ["1", "CMPT", "1.0"]])
+        t = self._table()
+        t.left_join(other, "EMPLID")
+        t.append_row(["4", "MSE", "", ""])
+        self.assertEqual(t.headers, ["EMPLID", "PROG", "PROG_JOIN", "GPA"])
+        self.assertEqual(t.rows, [["1", "CMPT", "CMPT", "2.0"], ["2", "ENSC", "ENSC", "3.5"], ["1", "MSE", "CMPT", "2.0"],
+                                  ["4", "MSE", "", ""]])
+        t.inner_join(other.subset(["EMPLID", "GPA"]), "EMPLID")
+        self.assertEqual(len(t), 3)
+        self.assertEqual(t.column_as_list("GPA_JOIN"), ["2.0", "3.5", "2.0"])
+
+        t.flatten("EMPLID")
+        self.assertEqual(t.rows, [["1", "CMPT, MSE", "CMPT", "2.0", "2.0"], ["2", "ENSC", "ENSC", "3.5", "3.5"]])
+
+    def test_columns(self):
+        t = self._table()
+        t.compute_column("LABEL", lambda r: r["PROG"] + r["EMPLID"])
+        t.map_column("LOWER", "PROG", str.lower)
+        t.remove_column("PROG")
+        self.assertEqual(t.row_map(2), {"EMPLID": "1", "LABEL": "MSE1", "LOWER": "mse"})
+        t.headers = ["ID", "LABEL", "LOWER"]
+        self.assertEqual(list(t.row_maps())[1], {"ID": "2", "LABEL": "ENSC2", "LOWER": "ensc"})
+        with self.assertRaises(ValueError):
+            t.append_row(["3"])
+
+        copy = Table.from_dict(t.to_dict())
+        self.assertEqual((copy.headers, copy.rows), (t.headers, t.rows))
+        self.assertEqual(t.head(2).rows, t.rows[:2])
+        # equal strings loaded from storage share one object
+        self.assertIs(copy.columns[0][0], copy.columns[0][2])
+
+
+class FakeCursor(object):
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, query):
+        self.connection.executed.append(query)
+        time.sleep(self.connection.delay)
+        self.description = [('EMPLID',), ('GPA',), ('ADMIT_DATE',)]
+        self.results = list(self.connection.rows)
+
+    def fetchone(self):
+        return self.results.pop(0) if self.results else None
+
+
+class FakeConnection(object):
+    rows = [('301000001', decimal.Decimal('3.50'), datetime.date(2020, 9, 8)), ('301000002', None, datetime.date(2021, 1, 5))]
+
+    def __init__(self, delay=0):
+        self.executed = []
+        self.delay = delay
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+class GPAQuery(CachedQuery):
+    query = string.Template("SELECT EMPLID, GPA, ADMIT_DATE FROM GPAS WHERE STRM=$strm")
+    filename = "gpa_query"
+
+
+class CachedQueryTest(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def test_cache(self):
+        with override_settings(REPORT_CACHE_LOCATION=self.cache_dir):
+            conn = FakeConnection()
+            q = GPAQuery(conn, query_args={'strm': '1234'})
+            res = q.result()
+            self.assertEqual(res.rows, [list(r) for r in FakeConnection.rows])
+            self.assertEqual(len(conn.executed), 1)
+
+            # changing the result doesn't change what's cached
+            res.append_row(['301000003', 1, None])
+            res.filter_column('EMPLID', lambda e: e != '301000001')
+            self.assertEqual(len(q.result()), 2)
+
+            # the cache key is stable, so a new query object (e.g. in another process) finds the file
+            q2 = GPAQuery(conn, query_args={'strm': '1234'})
+            self.assertEqual(q2.cache_filename, q.cache_filename)
+            self.assertEqual(q2.result().rows, [list(r) for r in FakeConnection.rows])
+            self.assertEqual(len(conn.executed), 1)
+            self.assertEqual(q2.rows_fetched, 2)
+
+            GPAQuery(conn, query_args={'strm': '1237'}).result()
+            self.assertEqual(len(conn.executed), 2)
+
+    def test_eviction(self):
+        with override_settings(REPORT_CACHE_LOCATION=self.cache_dir):
+            conn = FakeConnection()
+            queries = [GPAQuery(conn, query_args={'strm': str(strm)}) for strm in range(1000, 1004)]
+            for i, q in enumerate(queries):
+                q.result()
+                os.utime(q.cache_filename, (i, i))
+            size = os.path.getsize(queries[0].cache_filename)
+
+            with override_settings(REPORT_CACHE_MAX_SIZE=size * 2):
+                CachedQuery.evict_from_cache()
+            self.assertEqual([os.path.exists(q.cache_filename) for q in queries], [False, False, True, True])
+
+            # expired results and abandoned temporary files go first, whatever the size
+            expired = GPAQuery(conn, query_args={'strm': '1010'})
+            expired.expires = datetime.datetime.now() - datetime.timedelta(hours=1)
+            expired.result()
+            stale_tmp = queries[3].cache_filename + '.1.tmp'
+            new_tmp = queries[3].cache_filename + '.2.tmp'
+            for tmp in [stale_tmp, new_tmp]:
+                with open(tmp, 'wb') as f:
+                    f.write(b'partial')
+            os.utime(stale_tmp, (0, 0))
+            CachedQuery.evict_from_cache()
+            self.assertEqual([os.path.exists(f) for f in [expired.cache_filename, stale_tmp, new_tmp]],
+                             [False, False, True])
+            self.assertEqual([os.path.exists(q.cache_filename) for q in queries], [False, False, True, True])
+
+            # a result evicted between checking for it and loading it is fetched again
+            q = GPAQuery(conn, query_args={'strm': '1003'})
+            executed = len(conn.executed)
+            with mock.patch.object(GPAQuery, 'is_cached_on_file', return_value=True):
+                os.remove(q.cache_filename)
+                self.assertEqual(len(q.result()), 2)
+            self.assertEqual(len(conn.executed), executed + 1)
+            self.assertTrue(os.path.exists(q.cache_filename))
+
+    def test_shared_queries(self):
+        """
+        Identical queries from reports running at the same time are run once, and logged to each report's own log.
+        """
+        class ListLog(list):
+            log = list.append
+
+        conn = FakeConnection(delay=0.2)
+        def run_report(strm, shared):
+            log = ListLog()
+            CachedQuery.set_logger(log)
+            with shared_queries(shared):
+                res = GPAQuery(conn, query_args={'strm': strm}).result()
+            return log, len(res)
+
+        with override_settings(REPORT_CACHE_LOCATION=self.cache_dir), shared_queries() as shared:
+            with ThreadPoolExecutor(max_workers=3) as pool:
+                results = list(pool.map(run_report, ['1234', '1234', '1237'], [shared] * 3))
+
+            # results are only held while a report is waiting for them
+            self.assertEqual(shared.entries, {})
+
+            # other threads (e.g. a report run from a web request) aren't part of the batch
+            other = ListLog()
+            def run_alone():
+                CachedQuery.set_logger(other)
+                with shared_queries() as alone:
+                    GPAQuery(conn, query_args={'strm': '1234'}).result()
+                    return alone
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                self.assertIsNot(pool.submit(run_alone).result(), shared)
+
+        self.assertEqual(len(conn.executed), 2)
+        self.assertEqual([n for _, n in results], [2, 2, 2])
+        sources = sorted(log[-1].split(' from ')[1] for log, _ in results)
+        self.assertEqual(sources, ['database.', 'database.', 'shared with another report.'])
+        self.assertEqual(other[-1].split(' from ')[1], 'cache file.')
+
+
+class ResultTest(TestCase):
+    fixtures = ['basedata', 'coredata']
+
+    def test_result_pages(self):
+        report = Report(name="Big Report")
+        report.save()
+        run = Run(report=report, name="run")
+        run.save()
+        table = Table.from_rows(["EMPLID", "N"], [[str(i), i] for i in range(2500)])
+        result = Result.create(run=run, table=table, name="All Students")
+
+        self.assertEqual(ResultPage.objects.filter(result=result).count(), 3)
+        result = Result.objects.get(id=result.id)
+        self.assertEqual(result.row_count, 2500)
+        self.assertEqual(result.page_count, 3)
+        self.assertEqual(result.page_rows(2)[0], ["2000", 2000])
+        self.assertEqual(result.table_summary().rows, [[str(i), i] for i in range(5)])
+        self.assertEqual(list(result.iter_rows()), table.rows)
+
+        # results stored before paging still work
+        old = Result(run=run, name="Old", table={'headers': ['A'], 'rows': [['1'], ['2']]})
+        old.save()
+        self.assertEqual((old.row_count, old.page_count, old.page_rows(0)), (2, 1, [['1'], ['2']]))
+
+        admin = Person.objects.get(userid="ggbaker")
+        admin.config["privacy_signed"] = True
+        admin.config["privacy_date"] = datetime.date.today()
+        admin.config["privacy_version"] = PRIVACY_VERSION
+        admin.save()
+        client = Client()
+        client.login_user("ggbaker")
+        kwargs = {'report': report.slug, 'run': run.slug, 'result': result.slug}
+        url = reverse('reports:view_result', kwargs=kwargs)
+        response = basic_page_tests(self, client, url + '?page=2')
+        self.assertEqual(response.context['rows'][0], ["1000", 1000])
+        self.assertContains(response, 'Rows 1001&ndash;2000 of 2500')
+        basic_page_tests(self, client, reverse('reports:view_run', kwargs={'report': report.slug, 'run': run.slug}))
+
+        response = client.get(reverse('reports:csv_result', kwargs=kwargs))
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual((len(lines), lines[0], lines[-1]), (2501, 'EMPLID,N', '2499,2499'))
+
+        response = client.get(reverse('reports:xls_result', kwargs=kwargs))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/vnd.ms-excel')
+
+        # too many rows for .xls: refused, not truncated
+        with mock.patch('reports.views.XLS_MAX_ROWS', 2500):
+            response = client.get(reverse('reports:xls_result', kwargs=kwargs))
+        self.assertRedirects(response, url)
+
+    def test_scheduled_runs(self):
+        reports = []
+        for name in ["Fake One", "Fake Two"]:
+            report = Report(name=name)
+            report.save()
+            HardcodedReport(report=report, file_location='fake_report.py').save()
+            ScheduleRule(report=report, schedule_type='DAI', next_run=datetime.datetime.now() - datetime.timedelta(hours=1)).save()
+            reports.append(report)
+
+        with override_settings(REPORT_WORKERS=1):
+            schedule_ping()
+        for report in reports:
+            run = Run.objects.get(report=report)
+            self.assertTrue(run.success)
+            self.assertEqual(Result.objects.get(run=run).row_count, 4)
+            self.assertTrue(ScheduleRule.objects.get(report=report).next_run > datetime.datetime.now())
@@ -26,4 +26,5 @@ report_patterns = [
     url(r'^type/' + REPORT_SLUG + '/run/delete/' + RUN_SLUG + '$', reports_views.delete_run, name='delete_run'),
     url(r'^type/' + REPORT_SLUG + '/run/' + RUN_SLUG + '/' + RESULT_SLUG + "$", reports_views.view_result, name='view_result'),
     url(r'^type/' + REPORT_SLUG + '/run/' + RUN_SLUG + '/' + RESULT_SLUG + "/csv$", reports_views.csv_result, name='csv_result'),
+    url(r'^type/' + REPORT_SLUG + '/run/' + RUN_SLUG + '/' + RESULT_SLUG + "/xls$", reports_views.xls_result, name='xls_result'),
 ]
@@ -1,4 +1,5 @@
 # Python
+import itertools
 import json
 
 # Django
@@ -7,21 +8,21 @@ from django.shortcuts import render, get_object_or_404
 from django.urls import reverse
 from django.contrib import messages
 
-# Third-Party
-import csv
-
 # Local
 from privacy.models import needs_privacy_signature, privacy_redirect
+from courselib.streaming import streaming_csv_response
 from courselib.auth import requires_role, has_role, HttpResponseRedirect, \
                     ForbiddenResponse
 
 # App
 from .models import Report, HardcodedReport, Result, Run, RunLine, \
-                    Query, AccessRule, ScheduleRule
+                    Query, AccessRule, ScheduleRule, RESULT_PAGE_SIZE
 from .forms import ReportForm, HardcodedReportForm, QueryForm, \
                     AccessRuleForm, ScheduleRuleForm
 from .cache import clear_cache
 
+XLS_MAX_ROWS = 65536 # the .xls format's limit
+
 def _has_access(request, report):
     try:
         return (has_role('SYSA', request) or
@@ -340,8 +341,18 @@ def view_result(request, report, run, result):
     run = get_object_or_404(Run, slug=run, report__slug=report)
     report = run.report
     result = get_object_or_404(Result, slug=result, run=run)
-    
-    return render(request, 'reports/view_result.html', {'report':report, 'run': run, 'result':result})
+
+    try:
+        page = int(request.GET.get('page', '1'))
+    except ValueError:
+        page = 1
+    page = min(max(page, 1), result.page_count)
+    rows = result.page_rows(page - 1)
+    first_row = (page - 1) * RESULT_PAGE_SIZE + 1
+
+    context = {'report':report, 'run': run, 'result':result, 'rows': rows, 'page': page,
+               'first_row': first_row, 'last_row': first_row + len(rows) - 1}
+    return render(request, 'reports/view_result.html', context)
 
 
 @requires_report_access()
@@ -351,14 +362,38 @@ def csv_result(request, report, run, result):
     result = get_object_or_404(Result, slug=result, run=run)
 
     filename = str(report.slug) + '-' + result.autoslug() + '.csv'
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'inline; filename=%s'% filename
-    csvWriter = csv.writer(response)
-
-    table = result.table_rendered()
-    csvWriter.writerow(table.headers)
-    for row in table.rows: 
-        csvWriter.writerow(row)
-    
-    return response
+    rows = itertools.chain([result.headers], result.iter_rows())
+    return streaming_csv_response(rows, filename, disposition='inline')
 
+
+@requires_report_access()
+def xls_result(request, report, run, result):
+    run = get_object_or_404(Run, slug=run, report__slug=report)
+    report = run.report
+    result = get_object_or_404(Result, slug=result, run=run)
+
+    if result.row_count >= XLS_MAX_ROWS:
+        # a truncated spreadsheet would look complete: send them to the CSV instead.
+        messages.error(request, "This result has %i rows, which is more than an Excel file can hold. Please use the "
+                                "CSV download instead." % (result.row_count,))
+        return HttpResponseRedirect(reverse('reports:view_result',
+                                            kwargs={'report': report.slug, 'run': run.slug, 'result': result.slug}))
+
+    import xlwt
+    book = xlwt.Workbook(encoding='utf-8')
+    sheet = book.add_sheet('Result')
+    hdrstyle = xlwt.easyxf('font: bold on')
+    for j, hdr in enumerate(result.headers):
+        sheet.write(0, j, hdr, hdrstyle)
+    for i, row in enumerate(result.iter_rows()):
+        for j, value in enumerate(row):
+            sheet.write(i + 1, j, value)
+        if i % RESULT_PAGE_SIZE == 0:
+            # written rows can be flushed from memory: they won't be changed
+            sheet.flush_row_data()
+
+    filename = str(report.slug) + '-' + result.autoslug() + '.xls'
+    response = HttpResponse(content_type='application/vnd.ms-excel')
+    response['Content-Disposition'] = 'attachment; filename="%s"' % (filename,)
+    book.save(response)
+    return response
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from submission.models import ALL_TYPE_CLASSES, SubmittedComponent
+from courselib.storage import deduplicate_file, remove_unreferenced_content
+import os
+
+
+class Command(BaseCommand):
+    help = 'Record the sha256 hash of submitted files, and move them into the content-addressed store so identical ' \
+           'files share their storage.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hash-only', action='store_true', help="record missing hashes, but don't link files")
+        parser.add_argument('--gc', action='store_true', help='remove stored contents that no file refers to')
+
+    def handle(self, *args, **options):
+        hashed = linked = missing = 0
+        saved = 0
+        for Type in ALL_TYPE_CLASSES:
+            SC = Type.SubmittedComponent
+            if SC.get_fieldfile is SubmittedComponent.get_fieldfile:
+                # this type never has a file
+                continue
+
+            for sc in SC.objects.order_by('id').iterator(chunk_size=1000):
+                f = sc.get_fieldfile()
+                if not f:
+                    continue
+                if not os.path.exists(f.path):
+                    missing += 1
+                    continue
+                if sc.file_sha256 is None:
+                    sc.store_file_hash()
+                    hashed += 1
+                if not options['hash_only']:
+                    if deduplicate_file(f.path, sc.file_sha256):
+                        linked += 1
+                        saved += os.stat(f.path).st_size
+
+        self.stdout.write("%i hashes recorded, %i files missing" % (hashed, missing))
+        if not options['hash_only']:
+            self.stdout.write("%i duplicate files linked to stored contents, saving %.1f MB" % (linked, saved / 1e6))
+        if options['gc']:
+            removed, freed = remove_unreferenced_content()
+            self.stdout.write("%i unreferenced stored files removed, freeing %.1f MB" % (removed, freed / 1e6))
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-17 12:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('submission', '0009_merge_20250902_1700'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submittedcomponent',
+            name='file_sha256',
+            field=models.CharField(blank=True, db_index=True, editable=False, help_text='sha256 hex digest of the submitted file (if there is one)', max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-17 12:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('submission', '0010_submittedcomponent_file_sha256'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='similarityresult',
+            name='generator',
+            field=models.CharField(choices=[('MOSS', 'MOSS'), ('WINN', 'Built-in')], help_text='tool that generated the similarity results', max_length=4),
+        ),
+    ]
@@ -1,21 +1,15 @@
-import threading
-import zipfile
-import tempfile
 import os
 import errno
 import io
 import csv
 from shlex import quote
 from datetime import datetime
-from typing import List
-
-from wsgiref.util import FileWrapper
-from django.http import StreamingHttpResponse
 
 from .base import SubmissionComponent, Submission, StudentSubmission, GroupSubmission, SubmittedComponent
 from coredata.models import Person
 from groups.models import GroupMember
 from courselib.branding import help_email
+from courselib.streaming import ZipStream, streaming_zip_response
 
 from .url import URL
 from .archive import Archive
@@ -330,46 +324,18 @@ class SubmissionInfo(object):
             self.get_most_recent_components()
             compsub = self.components_and_submitted()
 
-        handle, filename = tempfile.mkstemp('.zip')
-        os.close(handle)
-        z = zipfile.ZipFile(filename, 'w')
-
+        z = ZipStream()
         self._add_to_zip(z, self.activity, compsub, self.submissions[0].created_at,
                 slug=self.submissions[0].file_slug(), multi=multi)
-
-        z.close()
-
-        file = open(filename, 'rb')
-        response = StreamingHttpResponse(FileWrapper(file), content_type='application/zip')
-        response['Content-Disposition'] = 'attachment; filename="%s_%s.zip"' % (
-                self.submissions[0].file_slug(), self.activity.slug)
-        try:
-            os.remove(filename)
-        except OSError:
-            pass
-
-        return response
+        return streaming_zip_response(z, "%s_%s.zip" % (self.submissions[0].file_slug(), self.activity.slug))
 
     def generate_activity_zip(self):
         """
-        Create ZIP file for this activity
+        Create ZIP file for this activity: streamed to the client as the submitted files are read.
         """
-        handle, filename = tempfile.mkstemp('.zip')
-        os.close(handle)
-
-        z = zipfile.ZipFile(filename, 'w')
+        z = ZipStream()
         self.generate_submission_contents(z, prefix='')
-        z.close()
-
-        file = open(filename, 'rb')
-        response = StreamingHttpResponse(FileWrapper(file), content_type='application/zip')
-        response['Content-Disposition'] = 'attachment; filename="%s.zip"' % (self.activity.slug)
-        try:
-            os.remove(filename)
-        except OSError:
-            pass
-
-        return response
+        return streaming_zip_response(z, "%s.zip" % (self.activity.slug))
 
     @staticmethod
     def _add_to_zip(zipf, activity, components_and_submitted, created_at, prefix='', slug=None, multi=False):
@@ -430,15 +396,6 @@ class SubmissionInfo(object):
 
         return found, individual_subcomps, last_submission
 
-    @staticmethod
-    def hash_all(subcomps: List[SubmittedComponent]):
-        """
-        Calculate the hash of all files, discarding the results. Calling this should pre-fetch files from disk, in an
-        effort to speed up building the .zip.
-        """
-        for sc in subcomps:
-            sc.file_hash()
-
     def generate_submission_contents(self, z, prefix='', always_summary=True):
         """
         Assemble submissions and put in ZIP file.
@@ -456,14 +413,8 @@ class SubmissionInfo(object):
         # get SubmittedComponents and metadata
         found, individual_subcomps, last_submission = self.most_recent_submissions()
 
-        # start a thread to pre-fetch the second half of the files
-        subcomps_items = list(individual_subcomps.items())
-        all_subcomps = [sc for _, subcomps in subcomps_items for _, sc in subcomps]
-        t = threading.Thread(target=self.hash_all, args=(all_subcomps[len(all_subcomps)//2:],))
-        t.start()
-
-        # Now add them to the ZIP
-        for slug, subcomps in subcomps_items:
+        # Now add them to the ZIP (which reads the files ahead of writing them, if it's a ZipStream)
+        for slug, subcomps in individual_subcomps.items():
             lastsub = last_submission[slug]
             p = os.path.join(prefix, slug)
             self._add_to_zip(z, self.activity, subcomps, lastsub.created_at,
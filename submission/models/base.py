@@ -17,7 +17,7 @@ import os.path
 from django.conf import settings
 from django.utils.safestring import mark_safe
 from courselib.slugs import make_slug
-from courselib.storage import upload_path, UploadedFileStorage
+from courselib.storage import upload_path, UploadedFileStorage, deduplicate_file
 from courselib.json_fields import JSONField, config_property
 
 
@@ -159,6 +159,8 @@ class SubmittedComponent(models.Model):
     """
     submission = models.ForeignKey(Submission, on_delete=models.PROTECT)
     submit_time = models.DateTimeField(auto_now_add = True)
+    file_sha256 = models.CharField(max_length=64, null=True, blank=True, db_index=True, editable=False,
+                                   help_text='sha256 hex digest of the submitted file (if there is one)')
     def get_time(self):
         "return the submit time of the component"
         return self.submit_time.strftime("%Y-%m-%d %H:%M:%S")
@@ -171,6 +173,16 @@ class SubmittedComponent(models.Model):
             return time
     def delete(self, *args, **kwargs):
         raise NotImplementedError("This object cannot be deleted because it is used as a foreign key.")
+    def save(self, *args, **kwargs):
+        super(SubmittedComponent, self).save(*args, **kwargs)
+        if self.file_sha256 is None and self.get_fieldfile():
+            # record the hash of the newly-stored file, and share its storage with identical files if we're doing that
+            self.store_file_hash()
+            if self.file_sha256 and getattr(settings, 'SUBMISSION_DEDUP', False):
+                try:
+                    deduplicate_file(self.get_fieldfile().path, self.file_sha256)
+                except OSError:
+                    pass
     def __lt__(self, other):
         return other.submit_time < self.submit_time
     class Meta:
@@ -232,8 +244,29 @@ class SubmittedComponent(models.Model):
         h = hashlib.sha256()
         for data in fh:
             h.update(data)
+        fh.close()
         return h
 
+    def store_file_hash(self):
+        """
+        Calculate the sha256 hash of the file and record it in self.file_sha256 (and the database).
+        """
+        h = self.file_hash()
+        if h is None:
+            return None
+        self.file_sha256 = h.hexdigest()
+        SubmittedComponent.objects.filter(id=self.id).update(file_sha256=self.file_sha256)
+        return self.file_sha256
+
+    def sha256(self):
+        """
+        sha256 hex digest of the submitted file contents (or None if there is no file): recorded when the file was
+        submitted, so the file doesn't have to be read again.
+        """
+        if self.file_sha256 is None and self.get_fieldfile():
+            return self.store_file_hash()
+        return self.file_sha256
+
 
 # adapted from http://stackoverflow.com/questions/849142/how-to-limit-the-maximum-value-of-a-numeric-field-in-a-django-model
 class FileSizeField(models.PositiveIntegerField):
@@ -254,6 +287,7 @@ class FileSizeField(models.PositiveIntegerField):
 
 GENERATOR_CHOICES = [ # first elements must be URL-safe slug-like things
     ('MOSS', 'MOSS'),
+    ('WINN', 'Built-in'),
 ]
 
 
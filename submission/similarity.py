@@ -0,0 +1,217 @@
+"""
+Built-in code similarity checker: an alternative to MOSS (submission.moss) that doesn't need the external service.
+
+Code files are fingerprinted with submission.winnowing (in parallel worker processes) and pairs are ranked by the
+fingerprints they share. Results are stored as SimilarityData with the same labels the MOSS results use, so they are
+displayed the same way. Fingerprints are cached by file contents, so re-running a report or comparing against past
+offerings only fingerprints files that haven't been seen before.
+"""
+
+import multiprocessing
+import os.path
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+from django import forms
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files import File
+from django.db import transaction
+from django.utils.html import escape
+import io
+
+from grades.models import Activity
+from submission.models.base import SimilarityResult, SimilarityData
+from submission.models.codefile import SubmittedCodefile
+from submission.models import SubmissionInfo
+from submission.moss import MOSS, MOSSError, MOSS_LANGUAGES, MOSS_LANGUAGES_CHOICES
+from submission.winnowing import fingerprint_file, rank_pairs, NOISE_K, WINDOW
+
+FINGERPRINT_CACHE_TIMEOUT = 30*24*3600
+MAX_MATCHES = 250 # number of pairs to report (as MOSS's -n default)
+COMMON_FRACTION = 0.1 # ignore fingerprints found in more than this fraction of the files (as MOSS's -m option)
+PARALLEL_MIN_FILES = 20 # don't bother starting worker processes for fewer files than this
+
+
+def _fingerprint_key(sha256, language):
+    return 'similarity-fp-%s-%s-%i-%i' % (sha256, language, NOISE_K, WINDOW)
+
+
+def fingerprint_files(paths_hashes, language):
+    """
+    Fingerprints for the files, given a list of (path, sha256) pairs: from the cache, or calculated in a pool of
+    worker processes (settings.SIMILARITY_PROCESSES, default the number of CPUs).
+    """
+    keys = [_fingerprint_key(sha256, language) for _, sha256 in paths_hashes]
+    cached = cache.get_many(keys)
+    missing = [(i, path) for i, (path, _) in enumerate(paths_hashes) if keys[i] not in cached]
+
+    processes = getattr(settings, 'SIMILARITY_PROCESSES', None) or os.cpu_count() or 1
+    # daemonic processes (like Celery's workers) can't start their own
+    if len(missing) >= PARALLEL_MIN_FILES and processes > 1 and not multiprocessing.current_process().daemon:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            found = list(pool.map(fingerprint_file, [p for _, p in missing], [language] * len(missing), chunksize=8))
+    else:
+        found = [fingerprint_file(p, language) for _, p in missing]
+
+    new = {}
+    for (i, _), fps in zip(missing, found):
+        cached[keys[i]] = fps
+        new[keys[i]] = fps
+    if new:
+        cache.set_many(new, FINGERPRINT_CACHE_TIMEOUT)
+    return [cached[k] for k in keys]
+
+
+def _matched_lines(fps, hashes):
+    """
+    Set of line numbers covered by fingerprints with these hashes.
+    """
+    lines = set()
+    for h, first, last in fps:
+        if h in hashes:
+            lines.update(range(first, last + 1))
+    return lines
+
+
+def _line_ranges(lines):
+    """
+    Sorted line numbers -> list of (first, last) runs.
+    """
+    ranges = []
+    for l in sorted(lines):
+        if ranges and ranges[-1][1] == l - 1:
+            ranges[-1][1] = l
+        else:
+            ranges.append([l, l])
+    return ranges
+
+
+def _code_html(path, lines):
+    """
+    <pre> of the file, with the lines that match highlighted and anchored (as #lineN) for the top frame's links.
+    """
+    with open(path, 'rb') as fh:
+        text = fh.read().decode('utf-8', errors='replace')
+    out = []
+    for n, line in enumerate(text.split('\n'), start=1):
+        line = escape(line)
+        if n in lines:
+            line = '<mark>%s</mark>' % (line,)
+        out.append('<a id="line%i"></a>%s' % (n, line))
+    return '<pre>' + '\n'.join(out) + '</pre>'
+
+
+def _top_html(match, fns, ranges):
+    """
+    Table of the matching line ranges, linking to them in the side-by-side frames.
+    """
+    rows = ['<table><tr><th>%s</th><th>%s</th></tr>' % (escape(fns[0]), escape(fns[1]))]
+    for row in range(max(len(ranges[0]), len(ranges[1]))):
+        cells = []
+        for side in (0, 1):
+            if row < len(ranges[side]):
+                rng = ranges[side][row]
+                cells.append('<td><a href="match%s-%i.html#line%i" target="%i">%i-%i</a></td>'
+                             % (match, side, rng[0], side, rng[0], rng[1]))
+            else:
+                cells.append('<td></td>')
+        rows.append('<tr>%s</tr>' % (''.join(cells)))
+    rows.append('</table>')
+    return ''.join(rows)
+
+
+@transaction.atomic
+def run_similarity(main_activity: Activity, activities: List[Activity], language: str, result: SimilarityResult) -> SimilarityResult:
+    """
+    Find similar code in the main_activity's submissions.
+    ... comparing past submission from everything in the activities list.
+    ... looking only at the given programming language.
+    ... storing the results in result.
+    """
+    assert language in MOSS_LANGUAGES
+    assert main_activity in activities
+
+    offering_slug = main_activity.offering.slug
+    extension = '.' + MOSS_LANGUAGES[language]
+    files = [] # (display filename, path, SubmittedCodefile)
+    for a in activities:
+        si = SubmissionInfo.for_activity(a)
+        si.get_all_components()
+        _, individual_subcomps, _ = si.most_recent_submissions()
+        for userid, components in individual_subcomps.items():
+            prefix = os.path.join(a.offering.slug, userid)
+            for comp, sub in components:
+                if not isinstance(sub, SubmittedCodefile):
+                    # we can only deal with Codefile components
+                    continue
+                fn = sub.file_filename(sub.code, prefix)
+                if not fn.endswith(extension):
+                    # we only handle one language at a time
+                    continue
+                if not os.path.isfile(sub.code.path):
+                    continue
+                files.append((fn, sub.code.path, sub))
+
+    if not files:
+        raise MOSSError('No files found for that language to analyze.')
+    files.sort(key=lambda f: f[0])
+
+    fingerprints = fingerprint_files([(path, sub.sha256()) for _, path, sub in files], language)
+    candidates = set(i for i, (fn, _, _) in enumerate(files) if fn.startswith(offering_slug + '/'))
+    max_files = max(2, int(len(files) * COMMON_FRACTION))
+    pairs = rank_pairs(fingerprints, candidates, max_files)[:MAX_MATCHES]
+
+    index_data = []
+    for match, (n, i, j) in enumerate(pairs):
+        shared = set(h for h, _, _ in fingerprints[i]) & set(h for h, _, _ in fingerprints[j])
+        fns = [files[i][0], files[j][0]]
+        lines = [_matched_lines(fingerprints[k], shared) for k in (i, j)]
+        percents = ['(%i%%)' % (round(100 * n / len(set(h for h, _, _ in fingerprints[k])))) for k in (i, j)]
+        index_data.append([('match%i.html' % (match), fns[side], percents[side]) for side in (0, 1)])
+
+        top = _top_html(match, fns, [_line_ranges(l) for l in lines])
+        SimilarityData(result=result, label='match%i-top.html' % (match), config={},
+                       file=File(file=io.BytesIO(top.encode('utf8')), name='match%i-top.html' % (match))).save()
+        for side, k in enumerate((i, j)):
+            label = 'match%i-%i.html' % (match, side)
+            html = _code_html(files[k][1], lines[side])
+            SimilarityData(result=result, label=label, submission_id=files[k][2].submission_id, config={},
+                           file=File(file=io.BytesIO(html.encode('utf8')), name=label)).save()
+
+    data = SimilarityData(result=result, label='index.html', file=None, config={})
+    data.config['index_data'] = index_data
+    data.save()
+
+    result.config['complete'] = True
+    result.config['file_count'] = len(files)
+    result.save()
+    return result
+
+
+@transaction.atomic
+def run_similarity_as_task(activities: List[Activity], language: str) -> SimilarityResult:
+    """
+    Start run_similarity() in a Celery task.
+
+    The activities arg: list of all activities to compare with activities[0] being the "main" one for this course.
+    """
+    # save the results, removing any previous results on this activity
+    activity = activities[0]
+    SimilarityResult.objects.filter(activity=activity, generator='WINN').delete()
+    result = SimilarityResult(activity=activity, generator='WINN', config={'language': language, 'complete': False})
+    result.save()
+
+    from submission.tasks import run_similarity_task
+    run_similarity_task.delay(activity.id, [a.id for a in activities], language, result.id)
+    return result
+
+
+class Winnowing(MOSS):
+    """
+    Display of the built-in checker's results: stored in the same form as MOSS's.
+    """
+    class CreationForm(forms.Form):
+        language = forms.ChoiceField(label='Language', choices=MOSS_LANGUAGES_CHOICES)
+        other_offering_activities = forms.MultipleChoiceField(widget=forms.CheckboxSelectMultiple, required=False,
+            help_text='Also compare against submissions for these activities from other sections')
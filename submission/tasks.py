@@ -3,6 +3,7 @@ from courselib.celerytasks import task
 from grades.models import Activity
 from submission.models.base import SimilarityResult
 from submission.moss import run_moss, MOSSError
+from submission.similarity import run_similarity
 
 
 @task()
@@ -16,3 +17,15 @@ def run_moss_task(activity_id: int, activity_ids: List[int], language: str, resu
         result.config['error'] = str(e)
         result.config['extra'] = getattr(e, 'extra', None)
         result.save()
+
+
+@task()
+def run_similarity_task(activity_id: int, activity_ids: List[int], language: str, result_id: int):
+    activities = Activity.objects.filter(id__in=activity_ids)
+    activity = Activity.objects.get(id=activity_id)
+    result = SimilarityResult.objects.get(id=result_id)
+    try:
+        run_similarity(activity, list(activities), language, result)
+    except MOSSError as e:
+        result.config['error'] = str(e)
+        result.save()
@@ -1,7 +1,11 @@
 #from django.test import TestCase
 from django.test import TestCase
 
-from submission.models import URL, Archive, Code, StudentSubmission, select_all_components, ALL_TYPE_CLASSES
+from submission.models import URL, Archive, Code, Codefile, StudentSubmission, select_all_components, ALL_TYPE_CLASSES
+from submission.models.base import SimilarityResult, SimilarityData
+from submission.similarity import run_similarity
+from submission import winnowing
+from unittest import mock
 from submission.models.code import SubmittedCode
 from submission.forms import filetype
 from grades.models import NumericActivity, Activity
@@ -10,9 +14,15 @@ from coredata.tests import create_offering, validate_content
 from coredata.models import Member, Person, CourseOffering
 from django.urls import reverse
 from courselib.testing import Client, test_views, basic_page_tests, TEST_COURSE_SLUG
-import datetime, tempfile, os
-
-import base64, io
+from courselib.streaming import ZipStream
+from courselib.storage import content_store_path, content_references, UploadedFileStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import override_settings
+from django.conf import settings
+import datetime, tempfile, os, functools
+
+import base64, io, zipfile, hashlib
 TGZ_FILE = base64.b64decode('H4sIAI7Wr0sAA+3OuxHCMBAE0CtFJUjoVw8BODfQP3bgGSKIcPResjO3G9w9/i9vRmt7ltnzZx6ilNrr7PVS9vscbUTKJ/wWr8fzuqYUy3pbvu1+9QAAAAAAAAAAAHCiNyHUDpAAKAAA')
 GZ_FILE = base64.b64decode('H4sICIjWr0sAA2YAAwAAAAAAAAAAAA==')
 ZIP_FILE = base64.b64decode('UEsDBAoAAAAAAMB6fDwAAAAAAAAAAAAAAAABABwAZlVUCQADiNavSzTYr0t1eAsAAQToAwAABOgDAABQSwECHgMKAAAAAADAenw8AAAAAAAAAAAAAAAAAQAYAAAAAAAAAAAApIEAAAAAZlVUBQADiNavS3V4CwABBOgDAAAE6AMAAFBLBQYAAAAAAQABAEcAAAA7AAAAAAA=')
@@ -65,6 +75,16 @@ OUM3QjREMTIyQ0YzQjNGMDA+XQo+PgpzdGFydHhyZWYKMjE1OQolJUVPRgo=""")
 
 
 
+def temporary_submission_path(test):
+    "Run the test with its submitted files stored in a new, empty, temporary SUBMISSION_PATH."
+    @functools.wraps(test)
+    def wrapper(self):
+        with tempfile.TemporaryDirectory() as tmpdir, override_settings(SUBMISSION_PATH=tmpdir), \
+                mock.patch.object(UploadedFileStorage, 'location', tmpdir):
+            return test(self)
+    return wrapper
+
+
 class SubmissionTest(TestCase):
     fixtures = ['basedata', 'coredata']
     
@@ -238,6 +258,7 @@ class SubmissionTest(TestCase):
         self.assertContains(response, "You haven't made a submission for this component.")
 
 
+    @temporary_submission_path
     def test_upload(self):
         _, course = create_offering()
         a1 = NumericActivity(name="Assignment 1", short_name="A1", status="RLS", offering=course, position=2, max_grade=15, due_date=datetime.datetime.now() + datetime.timedelta(hours=1), group=False)
@@ -290,7 +311,125 @@ class SubmissionTest(TestCase):
         code.code.open()
         self.assertEqual(code.code.read(), codecontents)
         code.code.close()
+        self.assertEqual(code.file_sha256, hashlib.sha256(codecontents).hexdigest())
+
+        # download the ZIP of everything as the instructor: streamed, and a valid archive
+        client.login_user("ggbaker")
+        url = reverse('offering:submission:download_activity_files', kwargs={'course_slug': course.slug, 'activity_slug': a1.slug})
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        z = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(z.testzip(), None)
+        names = z.namelist()
+        self.assertIn('summary.csv', names)
+        codename = [n for n in names if n.startswith('0aaa0/')][0]
+        self.assertEqual(z.read(codename), codecontents)
+        self.assertEqual(z.getinfo(codename).compress_type, zipfile.ZIP_DEFLATED)
+
+        # with deduplication, the same file from another student shares its storage
+        self.assertEqual(content_references(code.file_sha256), 0)
+        with override_settings(SUBMISSION_DEDUP=True):
+            client.login_user("0aaa1")
+            url = reverse('offering:submission:show_components', kwargs={'course_slug': course.slug, 'activity_slug': a1.slug})
+            response = client.post(url, {"%i-code" % (c.id): SimpleUploadedFile('other.py', codecontents)})
+            self.assertEqual(response.status_code, 302)
+        code2 = SubmittedCode.objects.exclude(id=code.id).get()
+        self.assertEqual(code2.file_sha256, code.file_sha256)
+        self.assertEqual(code2.sha256(), code.file_sha256)
+        self.assertEqual(os.path.basename(code2.code.name), 'other.py')
+        self.assertTrue(os.path.samefile(code2.code.path, content_store_path(code.file_sha256)))
+        self.assertTrue(code2.code.path.startswith(settings.SUBMISSION_PATH))
+        self.assertEqual(content_references(code.file_sha256), 1)
+
+        # ... and the existing one can be moved into the store
+        call_command('dedup_submissions', stdout=io.StringIO())
+        self.assertTrue(os.path.samefile(code.code.path, code2.code.path))
+        self.assertEqual(content_references(code.file_sha256), 2)
             
+    def test_zip_stream(self):
+        "ZipStream: files read ahead in parallel, but archived in order"
+        tmpdir = tempfile.TemporaryDirectory()
+        contents = []
+        z = ZipStream(read_ahead=3, read_threads=2)
+        for i in range(10):
+            fn = os.path.join(tmpdir.name, 'file%i.%s' % (i, 'png' if i % 2 else 'txt'))
+            contents.append(('file%i' % (i) * 1000).encode('ascii'))
+            with open(fn, 'wb') as fh:
+                fh.write(contents[-1])
+            z.write(fn, 'dir/' + os.path.basename(fn))
+            if i == 4:
+                z.defer(lambda: z.writestr('deferred.txt', 'hello'))
+
+        data = b''.join(z)
+        zf = zipfile.ZipFile(io.BytesIO(data))
+        self.assertEqual(zf.namelist()[:6], ['dir/file0.txt', 'dir/file1.png', 'dir/file2.txt', 'dir/file3.png',
+                                             'dir/file4.txt', 'deferred.txt'])
+        self.assertEqual([zf.read('dir/file%i.%s' % (i, 'png' if i % 2 else 'txt')) for i in range(10)], contents)
+        self.assertEqual(zf.read('deferred.txt'), b'hello')
+        self.assertEqual(zf.getinfo('dir/file1.png').compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(zf.getinfo('dir/file2.txt').compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(z.stats['files'], 11)
+        self.assertEqual(z.stats['bytes'], sum(len(c) for c in contents) + 5)
+        tmpdir.cleanup()
+
+    @temporary_submission_path
+    def test_similarity(self):
+        "The built-in similarity checker"
+        original = "def total(items):\n    # add them up\n    s = 0\n    for x in items:\n        if x > 0:\n" \
+                   "            s = s + x * 2\n    return s\n\nprint(total([1, 2, 3]))\n"
+        renamed = "def add_all(values):\n    result = 0\n    for v in values:\n        if v > 0:\n" \
+                  "            result = result + v * 2\n    return result\n\nprint(add_all([4, 5, 6]))\n"
+        different = "import sys\n\nclass Thing(object):\n    pass\n\nwhile True:\n    line = sys.stdin.readline()\n" \
+                    "    if not line:\n        break\n    print(line.upper(), end='')\n"
+
+        # renaming identifiers and removing comments doesn't hide the match
+        fp1 = winnowing.fingerprint(original, 'python')
+        fp2 = winnowing.fingerprint(renamed, 'python')
+        fp3 = winnowing.fingerprint(different, 'python')
+        self.assertTrue(fp1)
+        self.assertEqual(set(h for h, _, _ in fp1), set(h for h, _, _ in fp2))
+        self.assertFalse(set(h for h, _, _ in fp1) & set(h for h, _, _ in fp3))
+        pairs = winnowing.rank_pairs([fp1, fp3, fp2], {0, 1, 2}, 3)
+        self.assertEqual([(i, j) for _, i, j in pairs], [(0, 2)])
+
+        _, course = create_offering()
+        a1 = NumericActivity(name="Assignment 1", short_name="A1", status="RLS", offering=course, position=2, max_grade=15)
+        a1.save()
+        c = Codefile.Component(activity=a1, title="Code", position=1, max_size=2000, filename='.py', filename_type='EXT')
+        c.save()
+        for userid, code in [('0aaa0', original), ('0aaa1', renamed), ('0aaa2', different)]:
+            m = Member(person=Person.objects.get(userid=userid), offering=course, role="STUD", credits=3, career="UGRD", added_reason="UNK")
+            m.save()
+            sub = StudentSubmission(activity=a1, member=m)
+            sub.save()
+            Codefile.SubmittedComponent(component=c, submission=sub,
+                                        code=SimpleUploadedFile('code.py', code.encode('utf8'))).save()
+
+        result = SimilarityResult(activity=a1, generator='WINN', config={'language': 'python', 'complete': False})
+        result.save()
+        run_similarity(a1, [a1], 'python', result)
+        self.assertTrue(result.config['complete'])
+        index = SimilarityData.objects.get(result=result, label='index.html')
+        self.assertEqual(len(index.config['index_data']), 1)
+        (label, fn0, perc0), (_, fn1, perc1) = index.config['index_data'][0]
+        self.assertEqual((label, fn0, fn1, perc0, perc1), ('match0.html', course.slug + '/0aaa0/code.py', course.slug + '/0aaa1/code.py', '(100%)', '(100%)'))
+        left = SimilarityData.objects.get(result=result, label='match0-0.html')
+        self.assertIn('<mark>            s = s + x * 2</mark>', left.file.read().decode('utf8'))
+
+        # fingerprints are cached by file contents: a second run doesn't read the files
+        with mock.patch('submission.similarity.fingerprint_file') as fingerprint_file:
+            SimilarityData.objects.filter(result=result).delete()
+            run_similarity(a1, [a1], 'python', result)
+            fingerprint_file.assert_not_called()
+
+        client = Client()
+        client.login_user("ggbaker")
+        Member(person=Person.objects.get(userid="ggbaker"), offering=course, role="INST", career="NONS", added_reason="UNK").save()
+        test_views(self, client, 'grades:similarity:', ['similarity'], {'course_slug': course.slug, 'activity_slug': a1.slug})
+        basic_page_tests(self, client, reverse('grades:similarity:similarity_result', kwargs={'course_slug': course.slug,
+                         'activity_slug': a1.slug, 'result_slug': 'WINN', 'path': ''}))
+
     def test_pages(self):
         "Test a bunch of page views"
         offering = CourseOffering.objects.get(slug=TEST_COURSE_SLUG)
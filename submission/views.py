@@ -15,6 +15,7 @@ from courselib.auth import is_course_staff_by_slug, is_course_member_by_slug
 from submission.models import StudentSubmission, GroupSubmission, SubmissionComponent
 from submission.models import select_all_components, SubmissionInfo, get_component, find_type_by_label, ALL_TYPE_CLASSES
 from submission.moss import MOSS, MOSSError, run_moss_as_task
+from submission.similarity import Winnowing, run_similarity_as_task
 from django.urls import reverse
 from django.contrib import messages
 from groups.models import Group, GroupMember
@@ -479,18 +480,27 @@ def similarity(request, course_slug, activity_slug):
         .select_related('offering', 'offering__semester')
     other_activity_choices = [(a.id, str(a)) for a in activities]
 
+    moss_form = MOSS.CreationForm()
+    builtin_form = Winnowing.CreationForm(prefix='builtin')
     if request.method == 'POST':
-        moss_form = MOSS.CreationForm(request.POST)
-        moss_form.fields['other_offering_activities'].choices = other_activity_choices
-        if moss_form.is_valid():
+        if request.POST.get('generator') == 'WINN':
+            form = builtin_form = Winnowing.CreationForm(request.POST, prefix='builtin')
+            run_as_task = run_similarity_as_task
+            name = 'similarity'
+        else:
+            form = moss_form = MOSS.CreationForm(request.POST)
+            run_as_task = run_moss_as_task
+            name = 'MOSS'
+        form.fields['other_offering_activities'].choices = other_activity_choices
+        if form.is_valid():
             try:
-                other_ids = moss_form.cleaned_data['other_offering_activities']
+                other_ids = form.cleaned_data['other_offering_activities']
                 other_activities = Activity.objects.filter(id__in=other_ids)
                 activities = [activity] + list(other_activities)
-                result = run_moss_as_task(activities=activities, language=moss_form.cleaned_data['language'])
-                messages.add_message(request, messages.SUCCESS, 'MOSS report started.')
+                result = run_as_task(activities=activities, language=form.cleaned_data['language'])
+                messages.add_message(request, messages.SUCCESS, '%s report started.' % (name[0].upper() + name[1:]))
                 l = LogEntry(userid=request.user.username,
-                             description=("ran MOSS for %s in %s") % (activity, offering),
+                             description=("ran %s for %s in %s") % (name, activity, offering),
                              related_object=activity)
                 l.save()
                 return HttpResponseRedirect(
@@ -499,15 +509,15 @@ def similarity(request, course_slug, activity_slug):
                             ))
             except MOSSError as e:
                 messages.add_message(request, messages.ERROR, str(e))
-    else:
-        moss_form = MOSS.CreationForm()
-        moss_form.fields['other_offering_activities'].choices = other_activity_choices
+    moss_form.fields['other_offering_activities'].choices = other_activity_choices
+    builtin_form.fields['other_offering_activities'].choices = other_activity_choices
 
     context = {
         'offering': offering,
         'activity': activity,
         'results': results,
         'moss_form': moss_form,
+        'builtin_form': builtin_form,
     }
     return render(request, "submission/similarity.html", context)
 
@@ -523,6 +533,8 @@ def similarity_result(request: HttpRequest, course_slug, activity_slug, result_s
 
     if result.generator == 'MOSS':
         helper = MOSS(offering, activity, result)
+    elif result.generator == 'WINN':
+        helper = Winnowing(offering, activity, result)
     else:
         raise NotImplementedError()
 
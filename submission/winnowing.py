@@ -0,0 +1,153 @@
+"""
+Winnowing fingerprints of source code (Schleimer, Wilkerson, Aiken, "Winnowing: Local Algorithms for Document
+Fingerprinting", the technique behind MOSS), for the built-in similarity checker in submission.similarity.
+
+Nothing here depends on Django, so the functions can run in worker processes.
+"""
+
+import bisect
+import re
+import zlib
+
+# fingerprints are hashes of NOISE_K consecutive tokens, and at least one is kept from every WINDOW consecutive
+# hashes: any match of NOISE_K + WINDOW - 1 tokens or more is guaranteed to be found.
+NOISE_K = 12
+WINDOW = 8
+
+_C_COMMENTS = r'//[^\n]*|/\*[\s\S]*?\*/'
+_HASH_COMMENTS = r'#[^\n]*'
+_STRINGS = r'"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\''
+
+# language (as in submission.moss.MOSS_LANGUAGES): (comment regex, extra string regex, keywords)
+_LANGUAGES = {
+    'c': (_C_COMMENTS, None,
+          'auto break case char const continue default do double else enum extern float for goto if int long '
+          'register return short signed sizeof static struct switch typedef union unsigned void volatile while'),
+    'cc': (_C_COMMENTS, None,
+           'auto bool break case catch char class const continue default delete do double else enum explicit extern '
+           'false float for friend goto if inline int long namespace new operator private protected public return '
+           'short signed sizeof static struct switch template this throw true try typedef typename union unsigned '
+           'using virtual void volatile while'),
+    'java': (_C_COMMENTS, None,
+             'abstract boolean break byte case catch char class continue default do double else enum extends final '
+             'finally float for if implements import instanceof int interface long new package private protected '
+             'public return short static super switch synchronized this throw throws try void while'),
+    'csharp': (_C_COMMENTS, None,
+               'abstract bool break byte case catch char class const continue default do double else enum false '
+               'finally float for foreach if in int interface internal is long namespace new null object out '
+               'override private protected public readonly ref return static string struct switch this throw true '
+               'try using var virtual void while'),
+    'javascript': (_C_COMMENTS, r'`(?:\\.|[^`\\])*`',
+                   'async await break case catch class const continue default delete do else export extends false '
+                   'finally for function if import in instanceof let new null return super switch this throw true '
+                   'try typeof undefined var void while yield'),
+    'python': (_HASH_COMMENTS, r'"""[\s\S]*?"""|\'\'\'[\s\S]*?\'\'\'',
+               'and as assert async await break class continue def del elif else except False finally for from '
+               'global if import in is lambda None nonlocal not or pass raise return True try while with yield'),
+    'ruby': (_HASH_COMMENTS, None,
+             'begin break case class def do else elsif end ensure false for if in module next nil not or redo '
+             'rescue retry return self super then true unless until when while yield'),
+    'haskell': (r'--[^\n]*|\{-[\s\S]*?-\}', None,
+                'case class data deriving do else if import in infix infixl infixr instance let module newtype of '
+                'then type where'),
+    'ml': (r'\(\*[\s\S]*?\*\)', None,
+           'and as begin do done else end exception false for fun function if in let match module mutable of open '
+           'rec struct then to true try type val when while with'),
+}
+
+_token_res = {}
+
+
+def _token_re(language):
+    if language not in _token_res:
+        comments, strings, _ = _LANGUAGES[language]
+        strings = strings + '|' + _STRINGS if strings else _STRINGS
+        _token_res[language] = re.compile(
+            r'(?P<comment>%s)|(?P<string>%s)|(?P<number>\d[\w.]*)|(?P<word>[A-Za-z_]\w*)|(?P<punct>[^\sA-Za-z0-9_])'
+            % (comments, strings))
+    return _token_res[language]
+
+
+def tokenize(text, language):
+    """
+    Normalized tokens of the source code, as a list of (token, line number) pairs: comments are dropped, and
+    identifiers, numbers and string literals are replaced by placeholders, so renaming things doesn't hide a match.
+    """
+    keywords = set(_LANGUAGES[language][2].split())
+    line_starts = [0] + [m.end() for m in re.finditer('\n', text)]
+    tokens = []
+    for m in _token_re(language).finditer(text):
+        kind = m.lastgroup
+        if kind == 'comment':
+            continue
+        elif kind == 'string':
+            tok = 'S'
+        elif kind == 'number':
+            tok = 'N'
+        elif kind == 'word':
+            tok = m.group() if m.group() in keywords else 'V'
+        else:
+            tok = m.group()
+        tokens.append((tok, bisect.bisect_right(line_starts, m.start())))
+    return tokens
+
+
+def fingerprint(text, language, k=NOISE_K, window=WINDOW):
+    """
+    Winnowed fingerprints of the source: list of (hash, first line, last line) for the selected k-grams of tokens.
+    """
+    tokens = tokenize(text, language)
+    if len(tokens) < k:
+        return []
+    words = [t for t, _ in tokens]
+    hashes = [zlib.crc32('\x00'.join(words[i:i+k]).encode('utf-8')) for i in range(len(tokens) - k + 1)]
+
+    # keep the (rightmost) minimum hash in each window
+    selected = []
+    last = -1
+    for start in range(max(1, len(hashes) - window + 1)):
+        win = hashes[start:start+window]
+        low = min(win)
+        pos = start + len(win) - 1 - win[::-1].index(low)
+        if pos != last:
+            selected.append((hashes[pos], tokens[pos][1], tokens[pos+k-1][1]))
+            last = pos
+    return selected
+
+
+def fingerprint_file(path, language):
+    """
+    fingerprint() of the file's contents (for calling in a worker process).
+    """
+    with open(path, 'rb') as fh:
+        text = fh.read().decode('utf-8', errors='replace')
+    return fingerprint(text, language)
+
+
+def rank_pairs(fingerprints, candidates, max_files):
+    """
+    Find the pairs of documents that share fingerprints, through an index of fingerprint -> documents.
+
+    fingerprints is a list of fingerprint() results; only pairs including a document whose index is in candidates are
+    considered. Fingerprints found in more than max_files documents (starter code, boilerplate) are ignored.
+
+    Returns a list of (shared fingerprints, i, j) with i < j, most shared first.
+    """
+    index = {}
+    for i, fps in enumerate(fingerprints):
+        for h in set(h for h, _, _ in fps):
+            index.setdefault(h, []).append(i)
+
+    shared = {}
+    for docs in index.values():
+        if len(docs) < 2 or len(docs) > max_files:
+            continue
+        for a in range(len(docs)):
+            i = docs[a]
+            for j in docs[a+1:]:
+                if i in candidates or j in candidates:
+                    shared[(i, j)] = shared.get((i, j), 0) + 1
+
+    pairs = [(n, i, j) for (i, j), n in shared.items()]
+    pairs.sort(key=lambda p: (-p[0], p[1], p[2]))
+    return pairs